@@ -0,0 +1,181 @@
+import numpy as np
+from typing import Iterable
+
+# Number of copy() calls, and how many of those copies had to be made for real. Kept outside the class because
+# writing to a class attribute slows down every method lookup on the class.
+COPY_STATS = {'copies': 0, 'materialized': 0}
+
+class ArrayPool:
+    # Drop-in replacement for DicePool backed by a contiguous count array.
+    # counts[i] is the number of dice showing offset+i. The pool's length and sum are kept up to date on every change,
+    # so C and S don't have to scan the pool.
+    # Like DicePool, copies share counts until one of them is changed, with shared counting the pools holding it.
+    def __init__(self, dice:Iterable[int]=None, init_pool=None):
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.offset = 0
+        self.n      = 0
+        self.total  = 0
+        self.shared = None
+        if init_pool is not None:
+            self.addCounts(init_pool)
+        if dice is not None:
+            self.addDice(dice)
+    @classmethod
+    def fromCounts(cls, offset:int, counts:np.ndarray):
+        rval = cls()
+        rval.setCounts(offset, counts)
+        return rval
+    def setCounts(self, offset:int, counts:np.ndarray, shared:list=None):
+        # shared is the holder count of the array counts is a view of, if it might be shared
+        if shared is not self.shared:
+            self.detach()
+        self.counts = counts
+        self.shared = shared
+        self.offset = offset
+        self.n      = int(counts.sum())
+        self.total  = int(counts @ np.arange(offset, offset + len(counts)))
+    @property
+    def vals(self):
+        # Value->count view, so code written against DicePool.vals keeps working
+        return {self.offset + int(i): int(self.counts[i]) for i in np.flatnonzero(self.counts)}
+    def own(self):
+        if self.shared is not None:
+            if self.shared[0] > 1:
+                self.counts = self.counts.copy()
+                COPY_STATS['materialized'] += 1
+            self.detach()
+    def detach(self):
+        if self.shared is not None:
+            self.shared[0] -= 1
+            self.shared = None
+    def widen(self, low:int, high:int):
+        # Makes sure counts covers low..high, and that this pool owns it
+        if len(self.counts) == 0:
+            self.detach()
+            self.counts = np.zeros(high - low + 1, dtype=np.int64)
+            self.offset = low
+            return
+        cur_high = self.offset + len(self.counts) - 1
+        if low >= self.offset and high <= cur_high:
+            self.own()
+            return
+        new_low, new_high = min(low, self.offset), max(high, cur_high)
+        counts = np.zeros(new_high - new_low + 1, dtype=np.int64)
+        counts[self.offset - new_low:self.offset - new_low + len(self.counts)] = self.counts
+        self.detach()
+        self.counts = counts
+        self.offset = new_low
+    def clear(self):
+        self.detach()
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.offset = self.n = self.total = 0
+    def addDie(self, val:int):
+        self.widen(val, val)
+        self.counts[val - self.offset] += 1
+        self.n     += 1
+        self.total += val
+    def addDice(self, vals:Iterable[int]):
+        vals = np.asarray(vals if isinstance(vals, np.ndarray) else list(vals), dtype=np.int64)
+        if len(vals) == 0:
+            return
+        low, high = int(vals.min()), int(vals.max())
+        self.widen(low, high)
+        start = low - self.offset
+        self.counts[start:start + high - low + 1] += np.bincount(vals - low, minlength=high - low + 1)
+        self.n     += len(vals)
+        self.total += int(vals.sum())
+    def addPool(self, other):
+        if isinstance(other, ArrayPool):
+            if other.n == 0:
+                return
+            self.widen(other.offset, other.offset + len(other.counts) - 1)
+            start = other.offset - self.offset
+            self.counts[start:start + len(other.counts)] += other.counts
+            self.n     += other.n
+            self.total += other.total
+            return
+        self.addCounts(other.vals)
+    def addCounts(self, vals):
+        # Add a value->count mapping, like DicePool.vals
+        for k, v in vals.items():
+            if v:
+                self.widen(k, k)
+                self.counts[k - self.offset] += v
+                self.n     += v
+                self.total += k*v
+    def subPool(self, other):
+        if not isinstance(other, ArrayPool):
+            other = ArrayPool(init_pool=other.vals)
+        if other.n == 0:
+            return
+        self.widen(other.offset, other.offset + len(other.counts) - 1)
+        start = other.offset - self.offset
+        self.counts[start:start + len(other.counts)] -= other.counts
+        if (self.counts[start:start + len(other.counts)] < 0).any():
+            raise RuntimeError("Can't remove an X from a dice pool without X in it!")
+        self.n     -= other.n
+        self.total -= other.total
+    def mulInt(self, factor:int):
+        self.own()
+        self.counts *= factor
+        self.n      *= factor
+        self.total  *= factor
+    def __len__(self):
+        return self.n
+    def __iter__(self):
+        for i in np.flatnonzero(self.counts):
+            for j in range(self.counts[i]):
+                yield self.offset + int(i)
+    def sum(self):
+        return self.total
+    def __repr__(self):
+        used = np.flatnonzero(self.counts)
+        if len(used) == 0:
+            return "Empty pool"
+        return ' - '.join('%d:%d'%(self.offset + i, self.counts[i]) for i in range(used[0], used[-1]+1))
+    def sliced(self, start:int, stop:int):
+        # Sub-pool of the values offset+start .. offset+stop-1
+        start, stop = max(start, 0), min(stop, len(self.counts))
+        if start >= stop:
+            return ArrayPool()
+        return ArrayPool.fromCounts(self.offset + start, self.counts[start:stop].copy())
+    def getGeqSubset(self, thresh):
+        return self.sliced(thresh - self.offset, len(self.counts))
+    def getLeqSubset(self, thresh):
+        return self.sliced(0, thresh - self.offset + 1)
+    def getEqSubset(self, val):
+        return self.sliced(val - self.offset, val - self.offset + 1)
+    @staticmethod
+    def keepFirst(counts:np.ndarray, count:int)->np.ndarray:
+        # Keep the first count dice, scanning from index 0 upwards
+        before = np.cumsum(counts) - counts
+        return np.minimum(counts, np.maximum(count - before, 0))
+    def getTop(self, count):
+        return ArrayPool.fromCounts(self.offset, self.keepFirst(self.counts[::-1], count)[::-1].copy())
+    def getBottom(self, count):
+        return ArrayPool.fromCounts(self.offset, self.keepFirst(self.counts, count))
+    # In-place versions of the filters, for callers that don't need the original pool any more
+    def keepGeq(self, thresh):
+        # Slicing gives a view, which stays shared if the array was
+        start = max(thresh - self.offset, 0)
+        self.setCounts(self.offset + start, self.counts[start:], self.shared)
+    def keepLeq(self, thresh):
+        self.setCounts(self.offset, self.counts[:max(thresh - self.offset + 1, 0)], self.shared)
+    def keepTop(self, count):
+        self.setCounts(self.offset, self.keepFirst(self.counts[::-1], count)[::-1].copy())
+    def keepBottom(self, count):
+        self.setCounts(self.offset, self.keepFirst(self.counts, count))
+    def getCountOfVal(self, val):
+        i = val - self.offset
+        return int(self.counts[i]) if 0 <= i < len(self.counts) else 0
+    def copy(self):
+        COPY_STATS['copies'] += 1
+        rval = ArrayPool()
+        if self.shared is None:
+            self.shared = [1]
+        self.shared[0] += 1
+        rval.counts, rval.offset, rval.n, rval.total = self.counts, self.offset, self.n, self.total
+        rval.shared = self.shared
+        return rval
+    def asList(self):
+        return np.repeat(np.arange(self.offset, self.offset + len(self.counts)), self.counts).tolist()
@@ -0,0 +1,159 @@
+import numpy as np
+from collections import defaultdict
+from typing import List
+from DicePool import DicePool
+
+# Upper bound on reps x faces cells in a single batch. Anything bigger falls back to the per-rep interpreter.
+MAX_BATCH_CELLS = 1 << 24
+
+class BatchUnsupported(Exception):
+    pass
+
+class BatchPool:
+    # One dice pool per rep, stored as a reps x faces matrix of counts.
+    # Column i holds the count of value offset+i for every rep.
+    def __init__(self, counts:np.ndarray, offset:int=0):
+        self.counts = counts
+        self.offset = offset
+    @staticmethod
+    def checkSize(rows:int, width:int):
+        if rows * width > MAX_BATCH_CELLS:
+            raise BatchUnsupported("Batch of %d reps x %d faces is too large"%(rows, width))
+    @classmethod
+    def empty(cls, rows:int):
+        return cls(np.zeros((rows, 0), dtype=np.int64))
+    @classmethod
+    def fromPool(cls, pool:DicePool, rows:int):
+        keys = [k for k, v in pool.vals.items() if v]
+        if len(keys) == 0:
+            return cls.empty(rows)
+        low, high = min(keys), max(keys)
+        cls.checkSize(rows, high - low + 1)
+        row = np.zeros(high - low + 1, dtype=np.int64)
+        for k in keys:
+            row[k - low] = pool.vals[k]
+        return cls(np.tile(row, (rows, 1)), low)
+    @classmethod
+    def fromValues(cls, columns:List[np.ndarray]):
+        # Every rep gets one die per column, with the value held in that column
+        rows = len(columns[0])
+        if rows == 0:
+            return cls.empty(0)
+        vals = np.stack(columns, axis=1)
+        low, high = int(vals.min()), int(vals.max())
+        cls.checkSize(rows, high - low + 1)
+        counts = np.zeros((rows, high - low + 1), dtype=np.int64)
+        row_idx = np.arange(rows)
+        for col in columns:
+            counts[row_idx, col - low] += 1
+        return cls(counts, low)
+    @classmethod
+    def fromRolls(cls, n_dice:np.ndarray, n_sides:np.ndarray, rng):
+        rows = len(n_dice)
+        width = int(n_sides.max()) if rows else 0
+        cls.checkSize(rows, width)
+        total = int(n_dice.sum())
+        if total == 0:
+            return cls.empty(rows)
+        if (n_sides == n_sides[0]).all() and rng.useCounts(total / rows, width):
+            return cls(rng.rollCounts(n_dice, width).astype(np.int64, copy=False), 1)
+        rolls = rng.rollRows(n_dice, n_sides)
+        row_idx = np.repeat(np.arange(rows), n_dice)
+        counts = np.bincount(row_idx*width + rolls - 1, minlength=rows*width)
+        return cls(counts.reshape(rows, width).astype(np.int64, copy=False), 1)
+    @property
+    def rows(self)->int:
+        return self.counts.shape[0]
+    @property
+    def width(self)->int:
+        return self.counts.shape[1]
+    def values(self)->np.ndarray:
+        return np.arange(self.offset, self.offset + self.width)
+    def copy(self):
+        return BatchPool(self.counts.copy(), self.offset)
+    def clear(self):
+        self.counts = np.zeros((self.rows, 0), dtype=np.int64)
+        self.offset = 0
+    def widen(self, low:int, high:int):
+        # Make sure columns exist for every value in low..high
+        if self.width == 0:
+            self.checkSize(self.rows, high - low + 1)
+            self.counts = np.zeros((self.rows, high - low + 1), dtype=np.int64)
+            self.offset = low
+            return
+        cur_high = self.offset + self.width - 1
+        if low >= self.offset and high <= cur_high:
+            return
+        new_low, new_high = min(low, self.offset), max(high, cur_high)
+        self.checkSize(self.rows, new_high - new_low + 1)
+        counts = np.zeros((self.rows, new_high - new_low + 1), dtype=np.int64)
+        counts[:, self.offset - new_low:self.offset - new_low + self.width] = self.counts
+        self.counts = counts
+        self.offset = new_low
+    def trim(self):
+        # Drop empty columns from either end
+        used = np.flatnonzero(self.counts.any(axis=0))
+        if len(used) == 0:
+            self.clear()
+        elif used[0] != 0 or used[-1] != self.width - 1:
+            self.counts = self.counts[:, used[0]:used[-1] + 1]
+            self.offset += int(used[0])
+        return self
+    def addValues(self, vals:np.ndarray):
+        if self.rows == 0:
+            return
+        self.widen(int(vals.min()), int(vals.max()))
+        self.counts[np.arange(self.rows), vals - self.offset] += 1
+    def addPool(self, other):
+        if other.width == 0:
+            return
+        self.widen(other.offset, other.offset + other.width - 1)
+        start = other.offset - self.offset
+        self.counts[:, start:start + other.width] += other.counts
+    def subPool(self, other):
+        if other.width == 0:
+            return
+        self.widen(other.offset, other.offset + other.width - 1)
+        start = other.offset - self.offset
+        self.counts[:, start:start + other.width] -= other.counts
+        if (self.counts < 0).any():
+            raise RuntimeError("Can't remove an X from a dice pool without X in it!")
+    def mulInt(self, factors:np.ndarray):
+        self.counts *= factors[:, None]
+    def count(self)->np.ndarray:
+        return self.counts.sum(axis=1)
+    def sum(self)->np.ndarray:
+        return self.counts @ self.values()
+    def getGeqSubset(self, thresh:np.ndarray):
+        mask = self.values()[None, :] >= thresh[:, None]
+        return BatchPool(self.counts * mask, self.offset).trim()
+    def getLeqSubset(self, thresh:np.ndarray):
+        mask = self.values()[None, :] <= thresh[:, None]
+        return BatchPool(self.counts * mask, self.offset).trim()
+    @staticmethod
+    def keepFirst(counts:np.ndarray, n:np.ndarray)->np.ndarray:
+        # Keep the first n dice of each row, scanning columns left to right
+        before = np.cumsum(counts, axis=1) - counts
+        return np.minimum(counts, np.maximum(n[:, None] - before, 0))
+    def getTop(self, n:np.ndarray):
+        kept = self.keepFirst(self.counts[:, ::-1], n)[:, ::-1]
+        return BatchPool(np.ascontiguousarray(kept), self.offset).trim()
+    def getBottom(self, n:np.ndarray):
+        return BatchPool(self.keepFirst(self.counts, n), self.offset).trim()
+    def repeatRows(self, reps:np.ndarray):
+        # Row i is repeated reps[i] times, giving one row per sub-block rep
+        self.checkSize(int(reps.sum()), self.width)
+        return BatchPool(np.repeat(self.counts, reps, axis=0), self.offset)
+    def reduceRows(self, reps:np.ndarray):
+        # Inverse of repeatRows: sum each run of reps[i] rows back into row i
+        cumulative = np.zeros((self.rows + 1, self.width), dtype=np.int64)
+        np.cumsum(self.counts, axis=0, out=cumulative[1:])
+        ends = np.cumsum(reps)
+        return BatchPool(cumulative[ends] - cumulative[ends - reps], self.offset)
+    def totals(self, pool_class=DicePool):
+        # Aggregate every rep into a single pool
+        ss = defaultdict(int)
+        for i, v in enumerate(self.counts.sum(axis=0).tolist()):
+            if v:
+                ss[self.offset + i] = v
+        return pool_class(init_pool=ss)
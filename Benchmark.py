@@ -0,0 +1,244 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from typing import *
+import numpy
+import DiceRNG
+import Graph
+import Codegen
+import Runtime
+from Checkpoint import Checkpointer
+from Compiler import Compiler
+from Optimizer import made, mapBlocks, optimize
+from Runtime import BatchExecState, ExecState, RunnableUnit
+
+# Benchmark suite for the compiler and runtime. Every case is compiled and run separately, each under a fixed seed
+# so the same dice get rolled every time. For each case it records:
+#   compile_s   best compile time over the repeats
+#   run_s       best run time over the repeats, after optimisation
+#   compile_spread_s, run_spread_s  how far the slowest repeat was from the best one
+#   instructions  instructions dispatched in one run, counting a batched instruction once per rep it handles
+#   peak_bytes  peak traced memory of one run
+# With --checkpoint the runs save checkpoints (see Checkpoint.py) as they go, and each case also records how many
+# were saved per run and the time spent saving them, which is included in run_s.
+# --save writes the results as a baseline and --compare checks a run against one. A time only counts as a regression
+# when it grew by more than the threshold and by more than the spread of the repeats in either run, so cases that run
+# in about a millisecond don't flag scheduler noise. Repeats take turns across the cases so that noise is shared out.
+
+SEED = 1234
+
+CASES = {
+    # One case per opcode
+    'D'            : '10000{ 10D6 S }',
+    'filter+'      : '10000{ 10D6 4+ C }',
+    'filter-'      : '10000{ 10D6 3- C }',
+    'plusX'        : '10000{ 3D6 +6 S }',
+    'minusX'       : '10000{ 3D6 -2 S }',
+    'H'            : '10000{ 4D6 H3 S }',
+    'L'            : '10000{ 4D6 L1 S }',
+    'mult'         : '10000{ 3D6 *3 S }',
+    'nested{}'     : '100{ 100{ 2D6 S } S }',
+    '[]'           : '10000{ 10D6 [3-] C }',
+    '[]{}'         : '10000{ 10D6 [1-]{CD6} [6+]{*2} C }',
+    'big pool'     : '10{ 100000D6 [1-]{CD6} 4+ C }',
+    'many faces'   : '100{ 100D1000000 S }',
+    # The examples from README.txt
+    'readme 2D6'   : '1000 { 2D6 S }',
+    'readme 3D6H2' : '1000 { 3D6 H2 S }',
+    'readme warhammer': """V2
+        6{1D3+1 S}
+        SD6
+        [6+]{*2}
+        5+
+        CD6
+        [[6+]]{CD6}
+        6+
+        CD6
+        [5+]
+        *2
+        CD6
+        [6+]
+        C""",
+    'readme reroll': """10000{
+        {2D6S}
+        [7-]{C{2D6S}}
+        }""",
+}
+
+TEST_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test.txt')
+
+class CountedUnit(RunnableUnit):
+    # Stands in for an instruction and counts how often it is dispatched
+    def __init__(self, inst:RunnableUnit, counter:list):
+        self.inst = inst
+        self.counter = counter
+    def run(self, estate:ExecState, *args):
+        self.counter[0] += 1
+        self.inst.run(estate, *args)
+    def runBatch(self, bstate:BatchExecState, *args):
+        self.counter[0] += bstate.pool.rows
+        self.inst.runBatch(bstate, *args)
+    def runReps(self, *args):
+        return self.inst.runReps(*args)
+
+def countInstructions(e:Runtime.Executor)->int:
+    counter = [0]
+    ilist = mapBlocks(e.instructions, lambda il: [made(CountedUnit(inst, counter), inst.script_i) for inst in il])
+    runQuietly(Runtime.Executor(ilist, e.debug_script))
+    return counter[0]
+
+def runQuietly(e:Runtime.Executor, checkpointer:Checkpointer=None):
+    DiceRNG.seed(SEED)
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        if checkpointer is not None:
+            checkpointer.run(e)
+        else:
+            e.run()
+
+def timeOnce(fn)->float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+def bestTime(times:List[float])->Tuple[float, float]:
+    # Returns the best time and the spread between the best and the worst
+    return min(times), max(times) - min(times)
+
+class Case:
+    # One script, compiled and optimised once and then timed a repeat at a time
+    def __init__(self, script:str, codegen:bool=False, checkpoint_s:float=None):
+        self.script = script
+        self.e = optimize(Compiler(script).compile())
+        if codegen:
+            try:
+                self.e = Codegen.generate(self.e)
+            except Codegen.CodegenUnsupported:
+                pass
+        self.checkpointer = None
+        if checkpoint_s is not None:
+            self.checkpointer = Checkpointer(os.path.join(tempfile.gettempdir(),
+                                                          'benchmark-%d.checkpoint'%os.getpid()), checkpoint_s)
+        self.compile_times = []
+        self.run_times = []
+    def timeRepeat(self):
+        self.compile_times.append(timeOnce(lambda: Compiler(self.script).compile()))
+        self.run_times.append(timeOnce(lambda: runQuietly(self.e, self.checkpointer)))
+    def result(self)->dict:
+        compile_s, compile_spread_s = bestTime(self.compile_times)
+        run_s, run_spread_s = bestTime(self.run_times)
+        instructions = countInstructions(self.e)
+        tracemalloc.start()
+        runQuietly(self.e, self.checkpointer)
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        result = {
+            'compile_s'   : compile_s,
+            'compile_spread_s': compile_spread_s,
+            'run_s'       : run_s,
+            'run_spread_s': run_spread_s,
+            'instructions': instructions,
+            'instr_per_s' : instructions / run_s if run_s > 0 else 0.0,
+            'peak_bytes'  : peak_bytes,
+        }
+        if self.checkpointer is not None:
+            runs = len(self.run_times) + 1
+            result['checkpoints'] = self.checkpointer.stats['saves'] / runs
+            result['checkpoint_s'] = self.checkpointer.stats['save_s'] / runs
+            if os.path.exists(self.checkpointer.path):
+                os.remove(self.checkpointer.path)
+        return result
+
+def runSuite(repeat:int, only:str=None, codegen:bool=False, checkpoint_s:float=None)->dict:
+    # Repeats go round every case in turn rather than timing one case repeat times in a row, so a burst of load on
+    # the machine slows one repeat of many cases instead of every repeat of one
+    scripts = dict(CASES)
+    scripts['test.txt'] = open(TEST_SCRIPT).read()
+    cases = {name: Case(script, codegen, checkpoint_s) for name, script in scripts.items()
+             if only is None or only in name}
+    for i in range(repeat):
+        for case in cases.values():
+            case.timeRepeat()
+    results = {}
+    for name, case in cases.items():
+        results[name] = r = case.result()
+        line = '%-18s %10.2fms %10.2fms %12d %12.0f %10.1fKB'%(name, 1e3*r['compile_s'], 1e3*r['run_s'],
+               r['instructions'], r['instr_per_s'], r['peak_bytes']/1024)
+        if checkpoint_s is not None:
+            line += ' %10.1f %10.2fms'%(r['checkpoints'], 1e3*r['checkpoint_s'])
+        print(line)
+    return results
+
+def environment(codegen:bool=False, checkpoint_s:float=None)->dict:
+    return {
+        'python'  : platform.python_version(),
+        'numpy'   : numpy.__version__,
+        'machine' : platform.machine(),
+        'pool'    : Runtime.POOL_CLASS.__name__,
+        'batch'   : Runtime.BATCH_ENABLED,
+        'codegen' : codegen,
+        'checkpoint': checkpoint_s,
+        'seed'    : SEED,
+    }
+
+def compare(results:dict, baseline:dict, threshold:float)->list:
+    # Returns a line for every case and metric that got worse by more than threshold
+    regressions = []
+    for name, r in results.items():
+        old = baseline['cases'].get(name)
+        if old is None:
+            continue
+        for metric in ('compile_s', 'run_s', 'peak_bytes'):
+            if metric.endswith('_s'):
+                spread = metric[:-2] + '_spread_s'
+                if r[metric] - old[metric] <= max(r[spread], old.get(spread, 0.0)):
+                    continue
+            if old[metric] > 0 and r[metric] > old[metric] * (1 + threshold):
+                regressions.append('%-18s %-10s %12.4g -> %12.4g (%+.0f%%)'%(name, metric, old[metric], r[metric],
+                                   100*(r[metric] / old[metric] - 1)))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the compiler and runtime")
+    parser.add_argument('--repeat', type=int, default=5, help="Runs per case; the best time is kept")
+    parser.add_argument('--only', default=None, help="Only run cases whose name contains this")
+    parser.add_argument('--save', default=None, help="Write the results to this baseline file")
+    parser.add_argument('--compare', default=None, help="Compare the results against this baseline file")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="Fractional slowdown or memory growth that counts as a regression")
+    parser.add_argument('--pool', choices=['dict', 'array'], default='dict', help="Pool implementation to benchmark")
+    parser.add_argument('--no-batch', action='store_true', help="Benchmark the per-rep interpreter")
+    parser.add_argument('--codegen', action='store_true', help="Run scripts as generated Python functions")
+    parser.add_argument('--checkpoint', type=float, default=None, metavar='SECONDS',
+                        help="Save a checkpoint this often during runs, to measure the cost. 0 saves after every "
+                             "batch of reps.")
+    args = parser.parse_args()
+    Graph.setGraphOutput('none')
+    if args.pool == 'array':
+        from ArrayPool import ArrayPool
+        Runtime.POOL_CLASS = ArrayPool
+    Runtime.BATCH_ENABLED = not args.no_batch
+    header = '%-18s %12s %12s %12s %12s %12s'%('case', 'compile', 'run', 'instructions', 'instr/s', 'peak mem')
+    if args.checkpoint is not None:
+        header += ' %10s %12s'%('saves/run', 'saving/run')
+    print(header)
+    results = runSuite(args.repeat, args.only, args.codegen, args.checkpoint)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'environment': environment(args.codegen, args.checkpoint), 'cases': results}, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['environment'] != environment(args.codegen, args.checkpoint):
+            print("Warning: baseline was recorded with %s"%baseline['environment'])
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("Regressions over %d%%:"%(100*args.threshold))
+            print('\n'.join(regressions))
+            sys.exit(1)
+        print("No regressions over %d%%"%(100*args.threshold))
@@ -0,0 +1,147 @@
+import hashlib
+import os
+import pickle
+import time
+import zlib
+import numpy as np
+import DiceRNG
+import Runtime
+from typing import *
+from BatchPool import BatchPool, BatchUnsupported
+from DicePool import DicePool
+from Runtime import ExecState, Executor, RunContext, RunCurlyBlock
+
+# Checkpoint and resume for long runs.
+#
+# Checkpointer runs a script's top level instructions itself and plugs in as the top level runner, so it sees every
+# rep of every quiet top level curly block. Those reps are run BATCH_REPS at a time, the same chunks runBatched uses,
+# and after any chunk that ends every_s seconds or more after the last save it writes a checkpoint: which top level
+# instruction is running, the reps done so far and their aggregate, the block's input pool, the top level pool and
+# arg stack, the verbosity and the RNG state. Checkpoints are pickled and compressed, written to a temporary name and
+# renamed over the previous one, so a run killed while saving still leaves the last good checkpoint.
+#
+# Resuming restores all of that, finishes the block and carries on with the next instruction. The RNG continues from
+# where it was and the chunks line up with an uninterrupted run's, so the result is the same as a run that was never
+# stopped. A checkpoint only resumes the script, optimisation and runtime settings that wrote it.
+
+class CheckpointMismatch(Exception):
+    pass
+
+CHECKPOINT_VERSION = 1
+EVERY_S = 60.0
+
+def rngState(rng:DiceRNG.DiceRNG)->dict:
+    # Only the unused part of each roll buffer matters, and buffered dice never have more than FAST_SIDES sides
+    return {'gen': rng.gen.bit_generator.state,
+            'buffers': {sides: buf[pos:].astype(np.uint8) for sides, (buf, pos) in rng.buffers.items()}}
+
+def restoreRng(rng:DiceRNG.DiceRNG, state:dict):
+    rng.gen.bit_generator.state = state['gen']
+    rng.buffers = {sides: [buf.astype(np.int64), 0] for sides, buf in state['buffers'].items()}
+
+def scriptKey(e:Executor)->str:
+    # Identifies the script, how it was compiled and the settings that decide which dice get drawn
+    layout = repr(([type(inst).__name__ for inst in e.instructions], Runtime.POOL_CLASS.__name__,
+                   Runtime.BATCH_ENABLED, Runtime.BATCH_REPS, DiceRNG.COUNT_MIN_DICE, DiceRNG.BLOCK_SIZE))
+    return hashlib.sha256((e.debug_script + layout).encode('utf-8')).hexdigest()
+
+class Checkpointer:
+    def __init__(self, path:str, every_s:float=EVERY_S):
+        self.path = path
+        self.every_s = every_s
+        self.stats = {'saves': 0, 'save_s': 0.0, 'bytes': 0}
+        self.key = None
+        self.index = None    # Top level instruction being run
+        self.estate = None
+        self.pending = None  # State of the block to pick up on resume
+        self.last_save = None
+    def run(self, e:Executor, resume:bool=False, ctx:RunContext=None)->ExecState:
+        # Runs e from the start, or from the checkpoint at path if resume is set and there is one
+        self.key = scriptKey(e)
+        s = ExecState(Runtime.POOL_CLASS(), [], 0, e.debug_script, RunContext() if ctx is None else ctx)
+        start = 0
+        if resume and os.path.exists(self.path):
+            state = self.load()
+            s.pool, s.arg_stack = state['pool'], state['arg_stack']
+            s.ctx.verbosity = state['verbosity']
+            restoreRng(s.ctx.rng, state['rng'])
+            start = state['index']
+            self.pending = state['block']
+        self.estate = s
+        self.last_save = time.perf_counter()
+        old_runner = Runtime.TOP_LEVEL_RUNNER
+        Runtime.TOP_LEVEL_RUNNER = self
+        try:
+            instructions = e.instructionsFor(s.ctx)
+            for self.index in range(start, len(instructions)):
+                inst = instructions[self.index]
+                try:
+                    if self.pending is not None:
+                        self.finishBlock(inst, s)
+                    else:
+                        inst.run(s)
+                except Exception as err:
+                    e.reportError(inst, s.ctx)
+                    raise(err)
+        finally:
+            Runtime.TOP_LEVEL_RUNNER = old_runner
+        return s
+    def finishBlock(self, inst:Runtime.RunnableUnit, s:ExecState):
+        # The rest of the block a checkpoint was saved in. The checkpoint already has the reps count popped and the
+        # input pool taken out of the top level pool.
+        block = inst if isinstance(inst, RunCurlyBlock) else inst.curly_block
+        s.pool.addPool(self.runReps(block, s, self.pending['pool_arg'], self.pending['reps']))
+    def runReps(self, block:RunCurlyBlock, estate:ExecState, pool_arg:DicePool, reps:int)->DicePool:
+        # RunCurlyBlock.runReps, cut into chunks of BATCH_REPS reps
+        if self.pending is not None:
+            done, agg_pool, batched = self.pending['done'], self.pending['agg_pool'], self.pending['batched']
+            self.pending = None
+        else:
+            done, agg_pool, batched = 0, Runtime.POOL_CLASS(), Runtime.BATCH_ENABLED
+        e = Executor(block.ilist, estate.debug_script)
+        while done < reps:
+            rows = min(Runtime.BATCH_REPS, reps - done)
+            if batched:
+                try:
+                    sub_s = e.runBatch(BatchPool.fromPool(pool_arg, rows), estate.nest_level+1, ctx=estate.ctx)
+                except BatchUnsupported:
+                    # Like runBatched, drop the batched reps and run them all again one at a time
+                    done, agg_pool, batched = 0, Runtime.POOL_CLASS(), False
+                    continue
+                agg_pool.addPool(sub_s.outputPool().totals(Runtime.POOL_CLASS))
+            else:
+                for i in range(rows):
+                    sub_s = e.run(pool_arg, estate.nest_level+1, ctx=estate.ctx)
+                    if len(sub_s.arg_stack):
+                        agg_pool.addDice(sub_s.arg_stack)
+                    else:
+                        agg_pool.addPool(sub_s.pool)
+            done += rows
+            if done < reps and time.perf_counter() - self.last_save >= self.every_s:
+                self.save({'pool_arg': pool_arg, 'reps': reps, 'done': done, 'agg_pool': agg_pool,
+                           'batched': batched})
+        return agg_pool
+    def save(self, block:dict):
+        start = time.perf_counter()
+        state = {'version': CHECKPOINT_VERSION, 'key': self.key, 'index': self.index, 'pool': self.estate.pool,
+                 'arg_stack': self.estate.arg_stack, 'verbosity': self.estate.ctx.verbosity,
+                 'rng': rngState(self.estate.ctx.rng), 'block': block}
+        data = zlib.compress(pickle.dumps(state, pickle.HIGHEST_PROTOCOL), 1)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+        self.last_save = time.perf_counter()
+        self.stats['saves'] += 1
+        self.stats['save_s'] += self.last_save - start
+        self.stats['bytes'] = len(data)
+    def load(self)->dict:
+        with open(self.path, 'rb') as f:
+            state = pickle.loads(zlib.decompress(f.read()))
+        if state.get('version') != CHECKPOINT_VERSION or state.get('key') != self.key:
+            raise CheckpointMismatch("Checkpoint %s was written by a different script or with different settings"%
+                                     self.path)
+        return state
+    def report(self)->str:
+        st = self.stats
+        return "Checkpoints: %d saved in %0.3fs, last one %0.1fKB"%(st['saves'], st['save_s'], st['bytes'] / 1024)
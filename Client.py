@@ -0,0 +1,46 @@
+import argparse
+import json
+import socket
+import sys
+
+# Thin client for Server.py. Sends a script to the running server and prints what it printed, plus a summary of the
+# result. Deliberately imports nothing heavy so it starts quickly.
+
+DEFAULT_SOCKET = '/tmp/diceroller.sock'
+
+def submit(script:str, reps:int=None, seed:int=None, socket_path:str=DEFAULT_SOCKET)->dict:
+    request = {'script': script}
+    if reps is not None:
+        request['reps'] = reps
+    if seed is not None:
+        request['seed'] = seed
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        with sock.makefile('rb') as f:
+            return json.loads(f.readline())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a dice script on a running Server.py")
+    parser.add_argument('script', help="The name of the script you want to run")
+    parser.add_argument('--reps', type=int, default=None, help="Run the whole script this many times")
+    parser.add_argument('--seed', type=int, default=None, help="Seed for the random number generator")
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help="Path of the server's socket")
+    parser.add_argument('--json', action='store_true', help="Print the server's full reply as JSON")
+    args = parser.parse_args()
+    reply = submit(open(args.script).read(), args.reps, args.seed, args.socket)
+    if args.json:
+        print(json.dumps(reply, indent=1))
+        sys.exit(0 if reply['ok'] else 1)
+    sys.stdout.write(reply.get('output', ''))
+    if not reply['ok']:
+        print(reply['error'])
+        sys.exit(1)
+    for graph in reply['graphs']:
+        s = graph['summary']
+        print("%s: mean %0.3f, quartiles %0.2f %0.2f %0.2f"%(graph['title'], s['mean'], s['q1'], s['median'], s['q3']))
+    if reply['summary'] is not None:
+        s = reply['summary']
+        print("Pool: %d values, mean %0.3f, quartiles %0.2f %0.2f %0.2f"%(s['count'], s['mean'], s['q1'], s['median'], s['q3']))
+    if reply['stack']:
+        print("Stack:", reply['stack'])
@@ -0,0 +1,217 @@
+import itertools
+import linecache
+import Runtime
+from typing import *
+from Optimizer import *
+
+# Compiles an instruction list into the source of one Python function, instead of interpreting RunnableUnit objects.
+#
+# The argument stack's depth is known at every point of a script, so each stack slot becomes a local variable and
+# the pops and pushes disappear. Curly and square blocks become inline code, with the per-rep loop of a curly block
+# written out as a for loop. Blocks that the interpreter would batch call the same runBatched as the interpreter, so
+# the dice are drawn in the same order and a seeded run gives the same result as Executor.run.
+#
+# Errors are caught once for the whole function. The traceback's line in the generated source is mapped back to the
+# instructions (outermost block first) that were running, and reported the way the interpreter reports them.
+#
+# Only scripts that can never turn verbosity on are compiled; the interpreter stays the reference for everything else.
+
+class CodegenUnsupported(Exception):
+    pass
+
+script_ids = itertools.count()
+
+class CodeGenerator:
+    def __init__(self, e:Executor):
+        self.e = e
+        self.lines = []   # Generated source
+        self.chains = []  # For each line of source, the script_i of the instructions it runs for, outermost first
+        self.chain = []
+        self.names = {}   # Objects the generated code refers to
+        self.n = 0
+    def temp(self, prefix:str)->str:
+        self.n += 1
+        return '%s_%d'%(prefix, self.n)
+    def emit(self, indent:int, text:str):
+        self.lines.append('    '*indent + text)
+        self.chains.append(tuple(self.chain))
+    def bind(self, prefix:str, obj)->str:
+        name = self.temp(prefix)
+        self.names[name] = obj
+        return name
+    def generate(self)->str:
+        if canRaiseVerbosity(self.e.instructions):
+            raise CodegenUnsupported("Scripts that can turn verbosity on are only run by the interpreter")
+        self.emit(0, 'def run(pool_override=None, nest_level=0, ctx=None):')
+        self.emit(1, 'P = Runtime.POOL_CLASS')
+        self.emit(1, 'rollPool = Runtime.rollPool')
+        self.emit(1, 'ctx = RunContext() if ctx is None else ctx')
+        self.emit(1, 'rng = ctx.rng')
+        self.emit(1, 'pool_0 = P() if pool_override is None else pool_override.copy()')
+        self.emit(1, 'try:')
+        self.emit(2, 'pass')
+        stack = self.genList(self.e.instructions, 'pool_0', 2, 0)
+        self.emit(1, 'except Exception as e:')
+        self.emit(2, 'reportError(e, ctx)')
+        self.emit(2, 'raise')
+        self.emit(1, 'return ExecState(pool_0, [%s], nest_level, debug_script, ctx)'%', '.join(stack))
+        return '\n'.join(self.lines) + '\n'
+    def genList(self, ilist:List[RunnableUnit], pool:str, indent:int, depth:int)->List[str]:
+        # Emits the code for ilist acting on the pool variable pool. Returns what's left on its argument stack.
+        stack = []
+        def pop()->str:
+            if len(stack):
+                return stack.pop()
+            self.emit(indent, "raise IndexError('pop from empty list')")
+            return '0'
+        def push(expr:str):
+            var = self.temp('t')
+            self.emit(indent, '%s = %s'%(var, expr))
+            stack.append(var)
+        for inst in ilist:
+            self.chain.append(inst.script_i)
+            if isinstance(inst, IntLiteral):
+                stack.append(repr(inst.val))
+            elif isinstance(inst, IntParam):
+                if inst.default is None:
+                    raise CodegenUnsupported("Parameter $%s has no value"%inst.name)
+                stack.append(repr(inst.default))
+            elif isinstance(inst, RunS):
+                push('%s.sum()'%pool)
+            elif isinstance(inst, RunC):
+                push('len(%s)'%pool)
+            elif isinstance(inst, RunD):
+                n_sides = pop()
+                n_dice = pop()
+                self.emit(indent, '%s = rollPool(rng, %s, %s)'%(pool, n_dice, n_sides))
+            elif isinstance(inst, RunDConst):
+                self.emit(indent, '%s = rollPool(rng, %d, %d)'%(pool, inst.n_dice, inst.n_sides))
+            elif isinstance(inst, RunDSidesConst):
+                self.emit(indent, '%s = rollPool(rng, %s, %d)'%(pool, pop(), inst.n_sides))
+            elif isinstance(inst, RunGeq):
+                self.emit(indent, '%s.keepGeq(%s)'%(pool, pop()))
+            elif isinstance(inst, RunLeq):
+                self.emit(indent, '%s.keepLeq(%s)'%(pool, pop()))
+            elif isinstance(inst, RunRangeConst):
+                if inst.low is not None:
+                    self.emit(indent, '%s.keepGeq(%d)'%(pool, inst.low))
+                if inst.high is not None:
+                    self.emit(indent, '%s.keepLeq(%d)'%(pool, inst.high))
+            elif isinstance(inst, RunPlusX):
+                self.emit(indent, '%s.addDie(%s)'%(pool, pop()))
+            elif isinstance(inst, RunMinusX):
+                self.emit(indent, '%s.addDie(-1*%s)'%(pool, pop()))
+            elif isinstance(inst, RunAddConst):
+                self.emit(indent, '%s.addDie(%d)'%(pool, inst.die))
+            elif isinstance(inst, RunMult):
+                self.emit(indent, '%s.mulInt(%s)'%(pool, pop()))
+            elif isinstance(inst, RunMultConst):
+                self.emit(indent, '%s.mulInt(%d)'%(pool, inst.factor))
+            elif isinstance(inst, RunH):
+                self.emit(indent, '%s.keepTop(%s)'%(pool, pop()))
+            elif isinstance(inst, RunL):
+                self.emit(indent, '%s.keepBottom(%s)'%(pool, pop()))
+            elif isinstance(inst, RunTopConst):
+                self.emit(indent, '%s.%s(%d)'%(pool, 'keepTop' if inst.top else 'keepBottom', inst.count))
+            elif isinstance(inst, RunV):
+                # Only "V0" gets this far
+                level = pop()
+                self.emit(indent, 'ctx.verbosity = %s'%level)
+                self.emit(indent, "ExecState(%s, [], nest_level + %d, debug_script, ctx).nestPrint("
+                                  "'Verbosity set to %%d'%%%s)"%(pool, depth, level))
+            elif isinstance(inst, RunG):
+                self.emit(indent, 'ctx.graph(%s)'%pool)
+            elif isinstance(inst, RunP):
+                pass # Only prints when verbose
+            elif isinstance(inst, RunCurlyBlock):
+                self.genCurly(inst, pool, pop(), None, indent, depth)
+            elif isinstance(inst, RunSquareBlock):
+                filtered = self.temp('pool')
+                self.emit(indent, '%s = %s.copy()'%(filtered, pool))
+                self.genList(inst.filt_ilist, filtered, indent, depth+1)
+                self.emit(indent, '%s.subPool(%s)'%(pool, filtered))
+                if inst.curly_block is not None:
+                    self.genCurly(inst.curly_block, pool, pop(), filtered, indent, depth)
+            else:
+                raise CodegenUnsupported("No code generator for %s"%type(inst).__name__)
+            self.chain.pop()
+        return stack
+    def genCurly(self, block:RunCurlyBlock, pool:str, reps_expr:str, pool_override:Union[str, None], indent:int,
+                 depth:int):
+        # Mirrors RunCurlyBlock.run and runReps for a block running at nest level nest_level+depth
+        reps, pool_arg, agg_pool, sub_pool = self.temp('reps'), self.temp('arg'), self.temp('agg'), self.temp('pool')
+        name = self.bind('block', block)
+        executor = self.bind('executor', Executor(block.ilist, self.e.debug_script))
+        self.emit(indent, '%s = %s'%(reps, reps_expr))
+        if pool_override is not None:
+            self.emit(indent, '%s = %s.copy()'%(pool_arg, pool_override))
+        else:
+            self.emit(indent, '%s = %s.copy()'%(pool_arg, pool))
+            self.emit(indent, '%s.clear()'%pool)
+        self.emit(indent, 'if %s != 0:'%reps)
+        indent += 1
+        if depth == 0:
+            self.emit(indent, 'if nest_level == 0 and Runtime.TOP_LEVEL_RUNNER is not None:')
+            self.emit(indent+1, '%s = Runtime.TOP_LEVEL_RUNNER.runReps(%s, ExecState(%s, [], nest_level, '
+                                'debug_script, ctx), %s, %s)'%(agg_pool, name, pool, pool_arg, reps))
+            self.emit(indent, 'else:')
+            indent += 1
+        self.emit(indent, '%s = None'%agg_pool)
+        self.emit(indent, 'if Runtime.OUTCOME_CACHE is not None:')
+        self.emit(indent+1, '%s = Runtime.OUTCOME_CACHE.runReps(%s, ExecState(%s, [], nest_level + %d, debug_script, '
+                            'ctx), %s, %s)'%(agg_pool, name, pool, depth, pool_arg, reps))
+        self.emit(indent, 'if %s is None and Runtime.BATCH_ENABLED:'%agg_pool)
+        self.emit(indent+1, '%s = %s.runBatched(%s, %s, %s, nest_level + %d, ctx)'%(agg_pool, name, executor,
+                                                                                  pool_arg, reps, depth))
+        self.emit(indent, 'if %s is None:'%agg_pool)
+        self.emit(indent+1, '%s = P()'%agg_pool)
+        self.emit(indent+1, 'for _ in range(%s):'%reps)
+        self.emit(indent+2, '%s = %s.copy()'%(sub_pool, pool_arg))
+        stack = self.genList(block.ilist, sub_pool, indent+2, depth+1)
+        if len(stack):
+            self.emit(indent+2, '%s.addDice([%s])'%(agg_pool, ', '.join(stack)))
+        else:
+            self.emit(indent+2, '%s.addPool(%s)'%(agg_pool, sub_pool))
+        if depth == 0:
+            indent -= 1
+        self.emit(indent, '%s.addPool(%s)'%(pool, agg_pool))
+
+class GeneratedExecutor(Executor):
+    # Executor whose run() calls a function generated from its instructions. stream() and runBatch() still go through
+    # the interpreter.
+    def __init__(self, e:Executor):
+        super().__init__(e.instructions, e.debug_script, e.verbose_instructions)
+        gen = CodeGenerator(e)
+        self.source = gen.generate()
+        self.chains = gen.chains
+        self.filename = '<dice script %d>'%next(script_ids)
+        # Lets tracebacks show the generated lines
+        linecache.cache[self.filename] = (len(self.source), None, self.source.splitlines(True), self.filename)
+        namespace = dict(gen.names, Runtime=Runtime, ExecState=ExecState, RunContext=RunContext,
+                         debug_script=e.debug_script, reportError=self.reportGeneratedError)
+        exec(compile(self.source, self.filename, 'exec'), namespace)
+        self.fn = namespace['run']
+    def reportGeneratedError(self, err:Exception, ctx:RunContext):
+        # Prints what the interpreter would have: one message per executor the error passed through, innermost first
+        lineno = None
+        tb = err.__traceback__
+        while tb is not None:
+            if tb.tb_frame.f_code.co_filename == self.filename:
+                lineno = tb.tb_lineno
+            tb = tb.tb_next
+        if lineno is None:
+            return
+        for script_i in reversed(self.chains[lineno - 1]):
+            lineno, line = self.getGlobalScriptLineForPosition(script_i)
+            ctx.print("Runtime error on line %d:"%lineno)
+            ctx.print(line)
+    def run(self, pool_override:DicePool=None, nest_level=0, arg_stack:List[int]=None,
+            ctx:RunContext=None)->ExecState:
+        if arg_stack or (ctx is not None and (ctx.verbosity > 0 or ctx.trace is not None)):
+            # The generated code starts with an empty stack and never prints
+            return super().run(pool_override, nest_level, arg_stack, ctx)
+        return self.fn(pool_override, nest_level, ctx)
+
+def generate(e:Executor)->GeneratedExecutor:
+    # Raises CodegenUnsupported for scripts the generator can't handle
+    return GeneratedExecutor(e)
@@ -1,4 +1,8 @@
+import hashlib
+import os
+import pickle
 import re
+import Runtime
 from Runtime import *
 
 
@@ -14,15 +18,14 @@ class Compiler:
     ws_re      = re.compile(r'\s+')
     int_re     = re.compile(r'\d+')
     comment_re = re.compile(r'#.*\n')
-    def __init__(self, global_script, subscript=None, end_re=None, nest_level=None, pos_offset=0):
-        self.compiler_pos_offset = pos_offset
+    param_re   = re.compile(r'\$([A-Za-z_]\w*)(?:=(-?\d+))?')
+    def __init__(self, global_script, start_pos=0, end_re=None, nest_level=None):
+        # Sub-compilers share the parent's script and pick up from start_pos. Everything works on indices into the
+        # global script so the script is never re-sliced while compiling.
         if len(global_script) == 0 or global_script[-1] != '\n':
             global_script += '\n'
         self.global_script = global_script
-        if subscript is None:
-            subscript = global_script
-        self.starting_subscript = subscript
-        self.script_tail = subscript
+        self.pos = start_pos
         self.end_re = end_re if end_re else None
         self.nest_level = nest_level if nest_level is not None else 0
         self.verbose = 0
@@ -36,27 +39,27 @@ class Compiler:
                 return lineno+1, line # Line numbers count from 1, not 0
         return 0, ''
     def getGlobalCompilerPosition(self)->int:
-        return len(self.starting_subscript) - len(self.script_tail) + self.compiler_pos_offset
+        return self.pos
     def getEndOfPresentLine(self)->str:
-        return self.script_tail.splitlines()[0]
+        end = self.global_script.find('\n', self.pos)
+        return self.global_script[self.pos:end]
+    def peek(self)->str:
+        return self.global_script[self.pos] if self.pos < len(self.global_script) else ''
     def addInstruction(self, instruction_subclass, *args):
         to_add = instruction_subclass(*args)
         to_add.setDebugParams(script_i=self.getGlobalCompilerPosition())
         self.ilist.append(to_add)
     def advanceByMatch(self, exp:Union[re.Pattern,str])->str:
         if type(exp) == str:
-            if self.script_tail[0] == exp:
-                matching = exp
-            else:
+            if self.peek() != exp:
                 return None
-        else:
-            matching = re.match(exp, self.script_tail)
-            if matching is None:
-                return None
-            matching = matching.group()
-        rval = self.script_tail[:len(matching)]
-        self.script_tail = self.script_tail[len(matching):]
-        return rval
+            self.pos += 1
+            return exp
+        matching = exp.match(self.global_script, self.pos)
+        if matching is None:
+            return None
+        self.pos = matching.end()
+        return matching.group()
     def grabPostFixArgument(self)->bool:
         self.advanceByMatch(self.ws_re)
         # The only valid post-fix values are integer literals, S or C
@@ -72,6 +75,8 @@ class Compiler:
             self.addInstruction(RunC)
             self.arg_stack_len += 1
             return True
+        if self.doParam():
+            return True
         return False
     def requirePostFixArgument(self):
         assert self.grabPostFixArgument(), "Couldn't get post-fix argument from: \"%s\""%self.getEndOfPresentLine()
@@ -85,6 +90,15 @@ class Compiler:
             self.addInstruction(IntLiteral,int(matched))
             self.arg_stack_len+=1
         return matched
+    def doParam(self):
+        # "$name" or "$name=default", a named integer that is bound before the script runs
+        matching = self.param_re.match(self.global_script, self.pos)
+        if matching is None:
+            return None
+        self.addInstruction(IntParam, matching.group(1), None if matching.group(2) is None else int(matching.group(2)))
+        self.pos = matching.end()
+        self.arg_stack_len += 1
+        return matching.group()
     def doS(self):
         self.addInstruction(RunS)
         self.arg_stack_len += 1
@@ -132,24 +146,21 @@ class Compiler:
     def doCurlyBracket(self):
         self.addInstruction(self.doCaptiveCurlyBracket)
     def doCaptiveCurlyBracket(self):
-        sub = Compiler(self.global_script, self.script_tail,
-                          '}', self.nest_level + 1, self.getGlobalCompilerPosition())
+        sub = Compiler(self.global_script, self.pos, '}', self.nest_level + 1)
         sub.compile()
-        self.script_tail = sub.script_tail
+        self.pos = sub.pos
         if self.arg_stack_len < 1:
             self.addInstruction(IntLiteral,1)
             self.arg_stack_len += 1
         self.arg_stack_len -= 1
         return RunCurlyBlock(sub.ilist)
     def doSquareBracket(self):
-        sub1 = Compiler(self.global_script, self.script_tail,
-                          ']', self.nest_level + 1, self.getGlobalCompilerPosition())
+        sub1 = Compiler(self.global_script, self.pos, ']', self.nest_level + 1)
         sub1.compile()
-        self.script_tail = sub1.script_tail
+        self.pos = sub1.pos
         ilist1 = sub1.ilist
         self.doWS()
-        if self.script_tail[0] == '{':
-            self.script_tail = self.script_tail[1:]
+        if self.advanceByMatch('{'):
             captive_curly = self.doCaptiveCurlyBracket()
         else:
             captive_curly = None
@@ -178,16 +189,18 @@ class Compiler:
             'V':self.doV,
             'P':self.doP,
         }
+        script_len = len(self.global_script)
         try:
-            while len(self.script_tail):
-                next_char = self.script_tail[0]
+            while self.pos < script_len:
+                next_char = self.global_script[self.pos]
                 if next_char in single_letter_ops:
-                    self.script_tail = self.script_tail[1:]
+                    self.pos += 1
                     single_letter_ops[next_char]()
                     continue
                 if self.doWS():       continue
                 if self.doComments(): continue
                 if self.doInt():      continue
+                if self.doParam():    continue
                 if self.end_re and self.advanceByMatch(self.end_re):
                     # We found the end condition, we rejoin the parent
                     break
@@ -201,6 +214,36 @@ class Compiler:
             raise e
         return Executor(self.ilist, self.global_script)
 
+# Compiled scripts are cached as pickled Executors, keyed by a hash of the script. The compiler and runtime sources go
+# into the key as well, since a change to either can change what a script compiles to.
+CACHE_VERSION = 1
+_code_hash = None
+
+def scriptCacheKey(script:str)->str:
+    global _code_hash
+    if _code_hash is None:
+        h = hashlib.sha256(b'v%d'%CACHE_VERSION)
+        for module_file in (__file__, Runtime.__file__):
+            with open(module_file, 'rb') as f:
+                h.update(f.read())
+        _code_hash = h.digest()
+    return hashlib.sha256(_code_hash + script.encode()).hexdigest()
+
+def compileCached(script:str, cache_dir:str)->Executor:
+    path = os.path.join(cache_dir, scriptCacheKey(script) + '.pickle')
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError):
+        pass
+    e = Compiler(script).compile()
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = '%s.%d.tmp'%(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(e, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    return e
+
 if __name__ == '__main__':
     cmp = Compiler(open('test.txt').read())
     e = cmp.compile()
@@ -0,0 +1,117 @@
+import math
+from statistics import NormalDist
+from typing import *
+import Runtime
+import Stats
+from DicePool import DicePool
+from Runtime import ExecState, RunCurlyBlock
+
+# Runs top level curly blocks until their output is known precisely enough, instead of for the hard coded rep count.
+#
+# Reps are run in chunks. After each chunk a confidence interval is worked out from the aggregated counts for every
+# target, and the block stops once every interval is narrow enough or max_reps is reached. Intervals treat every
+# value in the pool as an independent sample, which is exact when each rep adds one value (e.g. "N{ ... S }").
+#
+# A target is written KIND:HALF_WIDTH:
+#   mean:0.01   the mean, to within 0.01
+#   q0.9:0.5    the 90th percentile, to within 0.5
+#   bins:0.1    every value's percentage, to within 0.1 percentage points
+
+MIN_CHUNK = 1000
+
+def parseFraction(text:str)->Union[float, None]:
+    # The fraction of a quantile target, or None if text isn't a number strictly between 0 and 1
+    try:
+        frac = float(text)
+    except ValueError:
+        return None
+    return frac if 0 < frac < 1 else None
+
+class Target:
+    def __init__(self, spec:str):
+        kind, _, width = spec.partition(':')
+        if not width:
+            raise ValueError("Convergence target %r should look like mean:0.01, q0.9:0.5 or bins:0.1"%spec)
+        self.spec = spec
+        self.kind = kind
+        try:
+            self.width = float(width)
+        except ValueError:
+            self.width = None
+        if self.width is None or not self.width > 0:
+            raise ValueError("Convergence target %r needs a positive half width after the colon, eg. %s:0.01"%(spec,
+                             kind))
+        if kind == 'mean' or kind == 'bins':
+            self.frac = None
+        elif kind.startswith('q') and parseFraction(kind[1:]) is not None:
+            self.frac = parseFraction(kind[1:])
+        else:
+            raise ValueError("Unknown convergence target %r, use mean, bins or a quantile like q0.9"%kind)
+    def estimate(self, counts:Dict[int, int], z:float)->Tuple[float, float]:
+        # Returns the estimate and the half width of its confidence interval
+        n = Stats.total(counts)
+        if self.kind == 'mean':
+            return Stats.mean(counts), z * math.sqrt(Stats.variance(counts) / n)
+        if self.kind == 'bins':
+            worst = max(p*(100 - p) for p in Stats.percentages(counts).values())
+            return float(len(counts)), z * math.sqrt(worst / n)
+        # The ranks that bound the quantile come from the binomial count of values below it
+        spread = z * math.sqrt(self.frac * (1 - self.frac) / n)
+        low = Stats.quantile(counts, max(self.frac - spread, 0.0))
+        high = Stats.quantile(counts, min(self.frac + spread, 1.0))
+        return Stats.quantile(counts, self.frac), (high - low) / 2
+
+class ConvergenceRunner:
+    def __init__(self, targets:List[str], confidence:float=0.95, min_reps:int=MIN_CHUNK, max_reps:int=10**7,
+                 runner=None):
+        self.targets = [Target(spec) for spec in targets]
+        self.z = NormalDist().inv_cdf((1 + confidence) / 2)
+        self.confidence = confidence
+        self.min_reps = min_reps
+        self.max_reps = max_reps
+        self.runner = runner # Runs the chunks, e.g. a ParallelRunner. None runs them in this process.
+        self.reports = []
+    def runChunk(self, block:RunCurlyBlock, estate:ExecState, pool_arg:DicePool, reps:int)->DicePool:
+        if self.runner is not None:
+            return self.runner.runReps(block, estate, pool_arg, reps)
+        return block.runReps(estate, pool_arg, reps)
+    def runReps(self, block:RunCurlyBlock, estate:ExecState, pool_arg:DicePool, reps:int)->DicePool:
+        # reps from the script is ignored; the targets decide how many to run
+        agg_pool = Runtime.POOL_CLASS()
+        done = 0
+        chunk = min(self.min_reps, self.max_reps)
+        while True:
+            agg_pool.addPool(self.runChunk(block, estate, pool_arg, chunk))
+            done += chunk
+            counts = Stats.poolCounts(agg_pool)
+            if not counts:
+                break
+            results = [(t, *t.estimate(counts, self.z)) for t in self.targets]
+            worst = max(half / t.width for t, est, half in results)
+            if worst <= 1 or done >= self.max_reps:
+                break
+            # Interval widths shrink with the square root of the sample size. Grow by at most double per chunk.
+            needed = math.ceil(done * worst**2) - done
+            chunk = min(max(needed, MIN_CHUNK), done, self.max_reps - done)
+        lineno, line = Runtime.Executor([], estate.debug_script).getGlobalScriptLineForPosition(block.script_i)
+        if counts:
+            self.reports.append(self.report(lineno, done, counts, worst <= 1))
+        else:
+            self.reports.append("Block ending on line %d added no values in %d reps"%(lineno, done))
+        estate.ctx.print(self.reports[-1])
+        return agg_pool
+    def report(self, lineno:int, done:int, counts:Dict[int, int], converged:bool)->str:
+        status = "Converged after" if converged else "Stopped without converging after"
+        lines = ["%s %d reps (block ending on line %d, %d%% confidence):"%(status, done, lineno, round(100*self.confidence))]
+        for t in self.targets:
+            est, half = t.estimate(counts, self.z)
+            if t.kind == 'bins':
+                lines.append("    bins: %d values, percentages within +-%0.4g points (target %g)"%(est, half, t.width))
+            else:
+                lines.append("    %s: %0.4f +- %0.4g (target %g)"%(t.kind, est, half, t.width))
+        return '\n'.join(lines)
+    def __enter__(self):
+        Runtime.TOP_LEVEL_RUNNER = self
+        return self
+    def __exit__(self, *exc):
+        Runtime.TOP_LEVEL_RUNNER = None
@@ -1,27 +1,74 @@
 from collections import defaultdict
 from typing import Iterable
 
+# Number of copy() calls, and how many of those copies had to be made for real. Kept outside the class because
+# writing to a class attribute slows down every method lookup on the class.
+COPY_STATS = {'copies': 0, 'materialized': 0}
+
 class DicePool:
+    # Copies are copy-on-write: copy() shares vals with the original, and pools sharing vals also share a one element
+    # list counting them. A pool takes a private copy of vals when it's changed while the count is above one, and
+    # gives up its place in the count when it replaces vals. Code outside this class must not change vals directly.
     def __init__(self, dice:Iterable[int]=None, init_pool=None):
-        self.vals = defaultdict(int) if init_pool is None else init_pool.copy()
+        self.vals = defaultdict(int) if init_pool is None else defaultdict(int, init_pool)
+        self.shared = None # Holder count, when vals may be shared
         if dice is not None:
             self.addDice(dice)
+    @classmethod
+    def adopt(cls, vals:defaultdict):
+        # Pool that takes over vals without copying it
+        rval = cls.__new__(cls)
+        rval.vals = vals
+        rval.shared = None
+        return rval
+    @classmethod
+    def fromCounts(cls, offset:int, counts):
+        # Pool with counts[i] dice showing offset+i
+        vals = defaultdict(int)
+        for i, n in enumerate(counts.tolist()):
+            if n:
+                vals[offset + i] = n
+        return cls.adopt(vals)
+    def own(self):
+        # Called before vals is changed, when it may be shared
+        shared = self.shared
+        if shared[0] > 1:
+            self.vals = self.vals.copy()
+            COPY_STATS['materialized'] += 1
+        shared[0] -= 1
+        self.shared = None
+    def detach(self):
+        # Called before vals is replaced, when it may be shared
+        self.shared[0] -= 1
+        self.shared = None
     def clear(self):
+        if self.shared is not None:
+            self.detach()
         self.vals = defaultdict(int)
     def addDie(self, val:int):
+        if self.shared is not None:
+            self.own()
         self.vals[val] += 1
     def addDice(self, vals:Iterable[int]):
+        if self.shared is not None:
+            self.own()
         for v in vals:
             self.vals[v] += 1
     def addPool(self, other):
+        if self.shared is not None:
+            self.own()
         for k, v in other.vals.items():
             self.vals[k] += v
     def subPool(self, other):
+        if self.shared is not None:
+            self.own()
         for k, v in other.vals.items():
             self.vals[k] -= v
             if self.vals[k] < 0:
                 raise RuntimeError("Can't remove an X from a dice pool without X in it!")
     def mulInt(self, factor:int):
+        if self.shared is not None:
+            self.own()
         for k, v in self.vals.items():
             self.vals[k] = factor*v
     def __len__(self):
@@ -42,24 +89,24 @@ class DicePool:
         high = max(self.vals.keys())
         lines = []
         for i in range(low, high+1):
-            lines.append('%d:%d'%(i, self.vals[i]))
+            lines.append('%d:%d'%(i, self.vals.get(i, 0)))
         return ' - '.join(lines)
     def getGeqSubset(self, thresh):
         ss = defaultdict(int)
         for k, v in self.vals.items():
             if k >= thresh:
                 ss[k] = v
-        return DicePool(init_pool=ss)
+        return DicePool.adopt(ss)
     def getLeqSubset(self, thresh):
         ss = defaultdict(int)
         for k, v in self.vals.items():
             if k <= thresh:
                 ss[k] = v
-        return DicePool(init_pool=ss)
+        return DicePool.adopt(ss)
     def getEqSubset(self, val):
         ss = defaultdict(int)
-        ss[val] = self.vals[val]
-        return DicePool(init_pool=ss)
+        ss[val] = self.vals.get(val, 0)
+        return DicePool.adopt(ss)
     def getTop(self, count):
         ss = defaultdict(int)
         sorted_keys = sorted(self.vals.keys(), reverse=True)
@@ -71,7 +118,7 @@ class DicePool:
             else:
                 ss[k] = count
                 break
-        return DicePool(init_pool=ss)
+        return DicePool.adopt(ss)
     def getBottom(self, count):
         ss = defaultdict(int)
         sorted_keys = sorted(self.vals.keys(), reverse=False)
@@ -83,11 +130,39 @@ class DicePool:
             else:
                 ss[k] = count
                 break
-        return DicePool(init_pool=ss)
+        return DicePool.adopt(ss)
+    # In-place versions of the filters, for callers that don't need the original pool any more
+    def keepGeq(self, thresh):
+        vals = self.getGeqSubset(thresh).vals
+        if self.shared is not None:
+            self.detach()
+        self.vals = vals
+    def keepLeq(self, thresh):
+        vals = self.getLeqSubset(thresh).vals
+        if self.shared is not None:
+            self.detach()
+        self.vals = vals
+    def keepTop(self, count):
+        vals = self.getTop(count).vals
+        if self.shared is not None:
+            self.detach()
+        self.vals = vals
+    def keepBottom(self, count):
+        vals = self.getBottom(count).vals
+        if self.shared is not None:
+            self.detach()
+        self.vals = vals
     def getCountOfVal(self, val):
-        return self.vals[val]
+        return self.vals.get(val, 0)
     def copy(self):
-        return DicePool(init_pool=self.vals)
+        COPY_STATS['copies'] += 1
+        if self.shared is None:
+            self.shared = [1]
+        self.shared[0] += 1
+        rval = DicePool.__new__(DicePool)
+        rval.vals = self.vals
+        rval.shared = self.shared
+        return rval
     def asList(self):
         rval = []
         for k, v in self.vals.items():
@@ -0,0 +1,64 @@
+import numpy as np
+
+# Random number service for dice rolls.
+#
+# Scripts mostly roll a handful of dice at a time, and each call into NumPy costs far more than the dice themselves.
+# DiceRNG draws big blocks of rolls up front, one buffer per die size, and hands out slices of them. Everything comes
+# from one numpy.random.Generator, so a run is reproducible from its seed.
+
+BLOCK_SIZE = 1 << 16
+FAST_SIDES = 64 # Dice with more sides than this skip the buffers
+# Rolls of at least this many dice are drawn straight as face counts: one multinomial over the faces instead of a
+# value per die, so the cost follows the number of faces rather than the number of dice. Dice with more than
+# FAST_SIDES sides only do this when there are at least as many dice as faces. None turns this off.
+COUNT_MIN_DICE = 64
+
+class DiceRNG:
+    def __init__(self, seed=None):
+        self.reseed(seed)
+    def reseed(self, seed=None):
+        # seed can be anything numpy.random.default_rng accepts, including a SeedSequence
+        self.gen = np.random.default_rng(seed)
+        self.buffers = {} # Sides -> [buffer, position of the next unused roll]
+        self.face_probs = {} # Sides -> probability of each face
+    def useCounts(self, n_dice, n_sides:int)->bool:
+        # Whether a roll of n_dice (an int, or the mean of an array of them) should go through rollCounts
+        return (COUNT_MIN_DICE is not None and n_sides >= 1 and n_dice >= COUNT_MIN_DICE
+                and (n_sides <= FAST_SIDES or n_dice >= n_sides))
+    def roll(self, n_dice:int, n_sides:int)->np.ndarray:
+        if n_sides > FAST_SIDES or n_sides < 1 or n_dice > BLOCK_SIZE or n_dice < 0:
+            return self.gen.integers(1, n_sides + 1, n_dice)
+        entry = self.buffers.get(n_sides)
+        if entry is None or entry[1] + n_dice > len(entry[0]):
+            leftover = entry[0][entry[1]:] if entry is not None else np.zeros(0, dtype=np.int64)
+            entry = [np.concatenate((leftover, self.gen.integers(1, n_sides + 1, BLOCK_SIZE))), 0]
+            self.buffers[n_sides] = entry
+        pos = entry[1]
+        entry[1] = pos + n_dice
+        return entry[0][pos:pos + n_dice]
+    def rollCounts(self, n_dice, n_sides:int)->np.ndarray:
+        # How many of n_dice landed on each face 1..n_sides. With an array of n_dice, one row of counts per entry.
+        probs = self.face_probs.get(n_sides)
+        if probs is None:
+            probs = self.face_probs[n_sides] = np.full(n_sides, 1.0 / n_sides)
+        return self.gen.multinomial(n_dice, probs)
+    def rollVaried(self, n_sides:np.ndarray)->np.ndarray:
+        # One die per entry of n_sides, for rolls where the die size differs between dice
+        return self.gen.integers(1, n_sides + 1)
+    def rollRows(self, n_dice:np.ndarray, n_sides:np.ndarray)->np.ndarray:
+        # The dice of a batched roll: n_dice[i] dice with n_sides[i] sides for every row i, one row after another
+        if (n_sides == n_sides[0]).all():
+            return self.roll(int(n_dice.sum()), int(n_sides[0]))
+        return self.rollVaried(np.repeat(n_sides, n_dice))
+    def repeatRows(self, reps:np.ndarray):
+        # Called before a nested block of a batched run repeats row i reps[i] times, and restoreRows with what this
+        # returned once it's done. Only samplers that tie dice to reps (see Sampling.py) need to know.
+        return None
+    def restoreRows(self, saved):
+        pass
+
+# The runtime's shared generator
+RNG = DiceRNG()
+
+def seed(seed=None):
+    RNG.reseed(seed)
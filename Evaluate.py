@@ -0,0 +1,64 @@
+import io
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import *
+from numpy import random
+import Runtime
+from DicePool import DicePool
+from DiceRNG import DiceRNG
+from Runtime import ExecState, Executor, RunContext, RunCurlyBlock
+
+# Library API for evaluating compiled scripts, several at once on a thread pool.
+#
+# Every evaluation runs in its own RunContext, with its own RNG, printed output and graphs, so evaluations don't see
+# each other's verbosity or dice and can share a process and its compiled Executors. The settings that stay module
+# level in Runtime (POOL_CLASS, BATCH_ENABLED, TOP_LEVEL_RUNNER, OUTCOME_CACHE) apply to every evaluation and should be
+# set before any start.
+#
+#   with ThreadedEvaluator(workers=8) as evaluator:
+#       results = evaluator.evaluateAll([optimize(Compiler(script).compile()) for script in scripts], seed=1)
+
+@dataclass
+class Evaluation:
+    pool     : DicePool
+    arg_stack: List[int]
+    output   : str        # Everything the script printed
+    graphs   : List[dict] # Data of each G, as Graph.barGraphData gives it
+    elapsed  : float
+
+def runScript(e:Executor, ctx:RunContext, reps:int=None)->ExecState:
+    # Runs e in ctx, as the body of "reps{ ... }" if reps is given
+    if reps is None:
+        return e.run(ctx=ctx)
+    block = RunCurlyBlock(e.instructionsFor(ctx))
+    block.setDebugParams(script_i=0)
+    s = ExecState(Runtime.POOL_CLASS(), [reps], 0, e.debug_script, ctx)
+    block.run(s)
+    return s
+
+def evaluate(e:Executor, reps:int=None, seed=None)->Evaluation:
+    # seed can be anything numpy.random.default_rng accepts. Without one the dice are unseeded.
+    start = time.perf_counter()
+    ctx = RunContext(rng=DiceRNG(seed), out=io.StringIO(), graphs=[])
+    s = runScript(e, ctx, reps)
+    return Evaluation(s.pool, [int(v) for v in s.arg_stack], ctx.out.getvalue(), ctx.graphs,
+                      time.perf_counter() - start)
+
+class ThreadedEvaluator:
+    def __init__(self, workers:int=None):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+    def submit(self, e:Executor, reps:int=None, seed=None)->Future:
+        return self.pool.submit(evaluate, e, reps, seed)
+    def evaluateAll(self, executors:Iterable[Executor], reps:int=None, seed=None)->List[Evaluation]:
+        # Each script gets its own stream spawned from seed, so the results don't depend on which thread ran what
+        executors = list(executors)
+        seeds = random.SeedSequence(seed).spawn(len(executors))
+        futures = [self.submit(e, reps, script_seed) for e, script_seed in zip(executors, seeds)]
+        return [f.result() for f in futures]
+    def close(self):
+        self.pool.shutdown()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,469 @@
+import math
+import numpy as np
+from collections import defaultdict
+from typing import Callable, Dict, List, Tuple
+from Graph import countPool, determineIncrement, findQuartiles, makeBarGraph
+from Optimizer import RunAddConst, RunDConst, RunDSidesConst, RunMultConst, RunRangeConst, RunTopConst
+from Runtime import *
+
+# Exact evaluation of a compiled script. Instead of sampling pools, this pushes a probability distribution over
+# (pool, arg stack) states through the instruction list.
+#
+# A pool is a sorted tuple of parts. A part (dist, n) is n independent dice each drawn from dist, which is a tuple of
+# (value, probability) pairs. Plain values are parts whose dist has a single entry, so "2D6 +3" is
+# (((1, 1/6), ..., (6, 1/6)), 2), (((3, 1.0),), 1).
+#
+# Parts are kept rolled-up for as long as possible: filters split them with binomials, S on a pool that is never read
+# again is a convolution and H/L on a single part use order statistics. Anything else has to enumerate the outcomes
+# of the part, which is where the state count can blow up.
+
+MAX_STATES = 200000
+PRUNE      = 1e-12 # States less likely than this are dropped
+
+class ExactUnsupported(Exception):
+    pass
+
+def fixed(val:int)->tuple:
+    return ((val, 1.0),)
+
+def uniform(sides:int)->tuple:
+    return tuple((v, 1.0/sides) for v in range(1, sides+1))
+
+def isConcrete(pool:tuple)->bool:
+    return all(len(dist) == 1 for dist, n in pool)
+
+def makePool(parts)->tuple:
+    merged = defaultdict(int)
+    for dist, n in parts:
+        if n:
+            merged[dist] += n
+    return tuple(sorted(merged.items()))
+
+def poolFromValues(vals)->tuple:
+    return makePool((fixed(v), 1) for v in vals)
+
+def poolCounts(pool:tuple)->Dict[int,int]:
+    # Value->count of a concrete pool
+    return {dist[0][0]: n for dist, n in pool}
+
+def poolFromCounts(counts:Dict[int,int])->tuple:
+    return makePool((fixed(v), n) for v, n in counts.items())
+
+def poolLen(pool:tuple)->int:
+    return sum(n for dist, n in pool)
+
+def conditional(entries)->tuple:
+    total = sum(p for v, p in entries)
+    return tuple((v, round(p/total, 15)) for v, p in entries)
+
+def binomial(n:int, p:float)->List[Tuple[int,float]]:
+    if p <= 0.0: return [(0, 1.0)]
+    if p >= 1.0: return [(n, 1.0)]
+    lp, lq, lf = math.log(p), math.log1p(-p), math.lgamma(n+1)
+    rval = []
+    for k in range(n+1):
+        pr = math.exp(lf - math.lgamma(k+1) - math.lgamma(n-k+1) + k*lp + (n-k)*lq)
+        if pr > PRUNE:
+            rval.append((k, pr))
+    return rval
+
+def splitPool(pool:tuple, pred:Callable[[int],bool])->List[Tuple[tuple,tuple,float]]:
+    # Split every part into the dice passing pred and the rest. Returns (passing, failing, probability) triples.
+    splits = [((), (), 1.0)]
+    for dist, n in pool:
+        passing = [(v, p) for v, p in dist if pred(v)]
+        failing = [(v, p) for v, p in dist if not pred(v)]
+        p_pass = sum(p for v, p in passing)
+        new_splits = []
+        for k, bp in binomial(n, p_pass):
+            kept = ((conditional(passing), k),) if k else ()
+            rest = ((conditional(failing), n-k),) if k < n else ()
+            for kept_parts, rest_parts, pr in splits:
+                if pr*bp > PRUNE:
+                    new_splits.append((kept_parts + kept, rest_parts + rest, pr*bp))
+        splits = new_splits
+    return [(makePool(kept), makePool(rest), pr) for kept, rest, pr in splits]
+
+def partOutcomes(dist:tuple, n:int, max_states:int)->List[Tuple[tuple,float]]:
+    # Every multiset n dice from dist can land on, found as a chain of binomials over the faces
+    outcomes = [((), n, 1.0)]
+    remaining = 1.0
+    for idx, (v, p) in enumerate(dist):
+        q = 1.0 if idx == len(dist)-1 else min(1.0, p/remaining)
+        new_outcomes = []
+        for parts, left, pr in outcomes:
+            for k, bp in binomial(left, q):
+                if pr*bp > PRUNE:
+                    new_outcomes.append((parts + ((fixed(v), k),) if k else parts, left-k, pr*bp))
+        if len(new_outcomes) > max_states:
+            raise ExactUnsupported("Enumerating %d dice over %d faces needs more than %d states"%(n, len(dist), max_states))
+        outcomes = new_outcomes
+        remaining -= p
+    return [(parts, pr) for parts, left, pr in outcomes]
+
+def materialize(pool:tuple, max_states:int)->List[Tuple[tuple,float]]:
+    # Expand a pool into concrete pools (all parts fixed values)
+    if isConcrete(pool):
+        return [(pool, 1.0)]
+    rval = [((), 1.0)]
+    for dist, n in pool:
+        outcomes = [(((dist, n),), 1.0)] if len(dist) == 1 else partOutcomes(dist, n, max_states)
+        rval = [(a + b, pa*pb) for a, pa in rval for b, pb in outcomes if pa*pb > PRUNE]
+        if len(rval) > max_states:
+            raise ExactUnsupported("Enumerating the pool needs more than %d states"%max_states)
+    return [(makePool(parts), pr) for parts, pr in rval]
+
+def orderStatistic(dist:tuple, n:int, count:int, top:bool)->List[Tuple[tuple,float]]:
+    # Distribution of the highest (or lowest) count dice out of n drawn from dist
+    faces = sorted(dist, reverse=top)
+    states = {((), 0, n): 1.0} # Kept parts, number kept, dice left to place
+    finished = defaultdict(float)
+    remaining = 1.0
+    for idx, (v, p) in enumerate(faces):
+        q = 1.0 if idx == len(faces)-1 else min(1.0, p/remaining)
+        new_states = defaultdict(float)
+        for (kept, n_kept, left), pr in states.items():
+            for c, bp in binomial(left, q):
+                if pr*bp <= PRUNE:
+                    continue
+                take = min(c, count - n_kept)
+                new_kept = kept + ((fixed(v), take),) if take else kept
+                if n_kept + take == count or left == c:
+                    finished[new_kept] += pr*bp
+                else:
+                    new_states[(new_kept, n_kept + take, left - c)] += pr*bp
+        states = new_states
+        remaining -= p
+    return [(makePool(kept), pr) for kept, pr in finished.items()]
+
+def concreteSubset(pool:tuple, count:int, top:bool)->tuple:
+    kept = []
+    for dist, n in sorted(pool, reverse=top):
+        if count <= 0:
+            break
+        kept.append((dist, min(n, count)))
+        count -= n
+    return makePool(kept)
+
+def sumDistribution(pool:tuple)->Dict[int,float]:
+    # Convolution of every die in the pool
+    low, arr = 0, np.ones(1)
+    for dist, n in pool:
+        if len(dist) == 1:
+            low += dist[0][0]*n
+            continue
+        d_low = min(v for v, p in dist)
+        base = np.zeros(max(v for v, p in dist) - d_low + 1)
+        for v, p in dist:
+            base[v - d_low] += p
+        low += d_low*n
+        while n:
+            if n & 1:
+                arr = np.convolve(arr, base)
+            base = np.convolve(base, base)
+            n >>= 1
+    return {low + i: p for i, p in enumerate(arr.tolist()) if p > PRUNE}
+
+def stackDelta(inst:RunnableUnit)->int:
+    if isinstance(inst, (IntLiteral, RunS, RunC)):
+        return 1
+    if isinstance(inst, RunD):
+        return -2
+    if isinstance(inst, (RunG, RunP, RunDConst, RunRangeConst, RunTopConst, RunMultConst, RunAddConst)):
+        return 0
+    if isinstance(inst, RunSquareBlock):
+        return -1 if inst.curly_block is not None else 0
+    return -1
+
+class ExactResult:
+    def __init__(self, weights:Dict[int,float], peak_states:int):
+        self.weights = {v: w for v, w in weights.items() if w > 0}
+        self.peak_states = peak_states
+    def total(self)->float:
+        return sum(self.weights.values())
+    def percentages(self)->Dict[int,float]:
+        total = self.total()
+        return {v: 100*w/total for v, w in sorted(self.weights.items())}
+    def mean(self)->float:
+        return sum(v*w for v, w in self.weights.items()) / self.total()
+    def quartiles(self)->Tuple[float,float,float]:
+        counter = countPool(self.weights)
+        return findQuartiles(counter, determineIncrement(counter))
+    def report(self)->str:
+        lines = ['%6d: %8.4f%%'%(v, pct) for v, pct in self.percentages().items()]
+        lines.append('Mean: %0.4f'%self.mean())
+        lines.append('Quartiles: %0.2f, %0.2f, %0.2f'%self.quartiles())
+        lines.append('Peak states: %d'%self.peak_states)
+        return '\n'.join(lines)
+
+class ExactExecutor:
+    # Runs the instruction list from Compiler.compile() on distributions instead of sampled pools.
+    # The result is the distribution a "N{ script } G" graph converges to as N grows.
+    def __init__(self, executor:Executor, max_states:int=MAX_STATES):
+        self.executor = executor
+        self.max_states = max_states
+        self.peak_states = 1
+        self.mean_pool = None
+        self.outcome_cache = {}
+        self.handlers = {
+            IntLiteral    : self.doIntLiteral,
+            RunS          : self.doS,
+            RunC          : self.doC,
+            RunD          : self.doD,
+            RunGeq        : self.doGeq,
+            RunLeq        : self.doLeq,
+            RunPlusX      : self.doPlusX,
+            RunMinusX     : self.doMinusX,
+            RunMult       : self.doMult,
+            RunH          : self.doH,
+            RunL          : self.doL,
+            RunV          : self.doV,
+            RunG          : self.doG,
+            RunP          : self.doP,
+            RunCurlyBlock : self.doCurlyBlock,
+            RunSquareBlock: self.doSquareBlock,
+            # The optimiser's fused instructions
+            RunDConst     : self.doDConst,
+            RunDSidesConst: self.doDSidesConst,
+            RunRangeConst : self.doRangeConst,
+            RunTopConst   : self.doTopConst,
+            RunMultConst  : self.doMultConst,
+            RunAddConst   : self.doAddConst,
+        }
+    def run(self)->ExactResult:
+        dist = self.runList(self.executor.instructions, {((), ()): 1.0}, 0, True)
+        weights = self.mean_pool if self.mean_pool is not None else self.outputWeights(dist)
+        return ExactResult(weights, self.peak_states)
+    def runList(self, ilist:List[RunnableUnit], dist:dict, nest_level:int, stack_output:bool)->dict:
+        # stack_output is True for lists whose arg stack (if non-empty) replaces the pool as their output
+        for i, inst in enumerate(ilist):
+            if nest_level == 0 and isinstance(inst, RunCurlyBlock) and self.onlyGraphsAfter(ilist, i):
+                self.runMeanTail(ilist, i, dist)
+                break
+            if isinstance(inst, RunG):
+                makeBarGraph(self.outputWeights(dist, pools_only=True), title='Exact distribution')
+            # The optimiser's Quiet variants are handled like the instructions they subclass
+            handler = next((self.handlers[cls] for cls in type(inst).__mro__ if cls in self.handlers), None)
+            try:
+                if handler is None:
+                    raise ExactUnsupported("%s has no exact implementation"%type(inst).__name__)
+                new_dist = defaultdict(float)
+                for (pool, stack), p in dist.items():
+                    for state, sp in handler(inst, pool, stack, (ilist, i, nest_level, stack_output)):
+                        if p*sp > PRUNE:
+                            new_dist[state] += p*sp
+                if len(new_dist) > self.max_states:
+                    raise ExactUnsupported("%d states exceeds the limit of %d"%(len(new_dist), self.max_states))
+            except ExactUnsupported as e:
+                if getattr(e, 'located', False):
+                    raise
+                lineno, line = self.executor.getGlobalScriptLineForPosition(inst.script_i)
+                located = ExactUnsupported("Can't evaluate line %d exactly: %s\n%s"%(lineno, e, line))
+                located.located = True
+                raise located
+            dist = new_dist
+            self.peak_states = max(self.peak_states, len(dist))
+        return dist
+    def poolDeadAfter(self, ilist:List[RunnableUnit], i:int, depth:int, stack_output:bool)->bool:
+        # True if nothing reads the pool after instruction i. depth is the stack depth after instruction i.
+        for inst in ilist[i+1:]:
+            if isinstance(inst, (RunD, RunDConst, RunDSidesConst)):
+                return True
+            if not isinstance(inst, (IntLiteral, RunV, RunP)):
+                return False
+            depth += stackDelta(inst)
+        return stack_output and depth > 0
+    def onlyGraphsAfter(self, ilist:List[RunnableUnit], i:int)->bool:
+        return all(isinstance(inst, (IntLiteral, RunV, RunP, RunG)) for inst in ilist[i+1:])
+    def outputWeights(self, dist:dict, pools_only:bool=False)->Dict[int,float]:
+        # Expected count of every value in the output of the states
+        weights = defaultdict(float)
+        for (pool, stack), p in dist.items():
+            if len(stack) and not pools_only:
+                for v in stack:
+                    weights[v] += p
+                continue
+            for pdist, n in pool:
+                for v, pv in pdist:
+                    weights[v] += p*n*pv
+        return weights
+    def runMeanTail(self, ilist:List[RunnableUnit], i:int, dist:dict):
+        # Nothing but graphs follow a top level curly block, so its N reps don't need to be combined into a
+        # distribution: the expected pool is N times the expected output of one rep.
+        block = ilist[i]
+        weights = defaultdict(float)
+        for (pool, stack), p in dist.items():
+            reps = stack[-1]
+            if reps == 0:
+                continue
+            body = self.runList(block.ilist, {(pool, ()): 1.0}, 1, True)
+            for v, w in self.outputWeights(body).items():
+                weights[v] += p*reps*w
+        self.mean_pool = weights
+        for inst in ilist[i+1:]:
+            if isinstance(inst, RunG):
+                makeBarGraph(self.mean_pool, title='Exact distribution')
+    def doIntLiteral(self, inst, pool, stack, where):
+        return [((pool, stack + (inst.val,)), 1.0)]
+    def doS(self, inst, pool, stack, where):
+        ilist, i, nest_level, stack_output = where
+        if not isConcrete(pool) and self.poolDeadAfter(ilist, i, len(stack)+1, stack_output):
+            return [(((), stack + (s,)), p) for s, p in sumDistribution(pool).items()]
+        return [((c, stack + (sum(v*n for v, n in poolCounts(c).items()),)), p)
+                for c, p in materialize(pool, self.max_states)]
+    def doC(self, inst, pool, stack, where):
+        return [((pool, stack + (poolLen(pool),)), 1.0)]
+    def doD(self, inst, pool, stack, where):
+        n_sides, n_dice = stack[-1], stack[-2]
+        if n_sides < 1 or n_dice < 0:
+            raise ExactUnsupported("Can't roll %dD%d"%(n_dice, n_sides))
+        new_pool = makePool([(uniform(n_sides), n_dice)])
+        return [((new_pool, stack[:-2]), 1.0)]
+    def doGeq(self, inst, pool, stack, where):
+        thresh = stack[-1]
+        return [((kept, stack[:-1]), p) for kept, rest, p in splitPool(pool, lambda v: v >= thresh)]
+    def doLeq(self, inst, pool, stack, where):
+        thresh = stack[-1]
+        return [((kept, stack[:-1]), p) for kept, rest, p in splitPool(pool, lambda v: v <= thresh)]
+    def doPlusX(self, inst, pool, stack, where):
+        return [((makePool(pool + ((fixed(stack[-1]), 1),)), stack[:-1]), 1.0)]
+    def doMinusX(self, inst, pool, stack, where):
+        return [((makePool(pool + ((fixed(-stack[-1]), 1),)), stack[:-1]), 1.0)]
+    def doMult(self, inst, pool, stack, where):
+        factor = stack[-1]
+        if factor < 0:
+            raise ExactUnsupported("Can't multiply a pool by %d"%factor)
+        return [((makePool((dist, n*factor) for dist, n in c), stack[:-1]), p)
+                for c, p in materialize(pool, self.max_states)]
+    def doTopOrBottom(self, pool, stack, top:bool):
+        count = stack[-1]
+        if count <= 0:
+            return [(((), stack[:-1]), 1.0)]
+        if count >= poolLen(pool):
+            return [((pool, stack[:-1]), 1.0)]
+        if len(pool) == 1 and not isConcrete(pool):
+            dist, n = pool[0]
+            return [((kept, stack[:-1]), p) for kept, p in orderStatistic(dist, n, count, top)]
+        return [((concreteSubset(c, count, top), stack[:-1]), p) for c, p in materialize(pool, self.max_states)]
+    def doH(self, inst, pool, stack, where):
+        return self.doTopOrBottom(pool, stack, True)
+    def doL(self, inst, pool, stack, where):
+        return self.doTopOrBottom(pool, stack, False)
+    def doDConst(self, inst, pool, stack, where):
+        return self.doD(inst, pool, stack + (inst.n_dice, inst.n_sides), where)
+    def doDSidesConst(self, inst, pool, stack, where):
+        return self.doD(inst, pool, stack + (inst.n_sides,), where)
+    def doRangeConst(self, inst, pool, stack, where):
+        low = -math.inf if inst.low is None else inst.low
+        high = math.inf if inst.high is None else inst.high
+        return [((kept, stack), p) for kept, rest, p in splitPool(pool, lambda v: low <= v <= high)]
+    def doTopConst(self, inst, pool, stack, where):
+        return self.doTopOrBottom(pool, stack + (inst.count,), inst.top)
+    def doMultConst(self, inst, pool, stack, where):
+        return self.doMult(inst, pool, stack + (inst.factor,), where)
+    def doAddConst(self, inst, pool, stack, where):
+        return [((makePool(pool + ((fixed(inst.die), 1),)), stack), 1.0)]
+    def doV(self, inst, pool, stack, where):
+        return [((pool, stack[:-1]), 1.0)]
+    def doG(self, inst, pool, stack, where):
+        # Graphs need every state at once, see runList
+        return [((pool, stack), 1.0)]
+    def doP(self, inst, pool, stack, where):
+        return [((pool, stack), 1.0)]
+    def repOutcomes(self, block:RunCurlyBlock, pool_arg:tuple, reps:int, nest_level:int)->dict:
+        # Distribution of the pool added by "reps" runs of block, all receiving pool_arg
+        key = (id(block), pool_arg, reps)
+        if key in self.outcome_cache:
+            return self.outcome_cache[key]
+        rval = defaultdict(float)
+        # Every rep sees the same rolled pool, so a pool that isn't concrete yet has to be rolled first
+        inputs = [(pool_arg, 1.0)] if reps == 1 else materialize(pool_arg, self.max_states)
+        for concrete, cp in inputs:
+            body = self.runList(block.ilist, {(concrete, ()): 1.0}, nest_level+1, True)
+            single = defaultdict(float)
+            for (pool, stack), p in body.items():
+                single[poolFromValues(stack) if len(stack) else pool] += p
+            for outcome, p in self.unionPower(single, reps).items():
+                rval[outcome] += cp*p
+        self.outcome_cache[key] = rval
+        return rval
+    def unionPower(self, single:dict, reps:int)->dict:
+        # Distribution of the union of reps independent draws from single
+        rval, base = {(): 1.0}, single
+        while reps:
+            if reps & 1:
+                rval = self.union(rval, base)
+            reps >>= 1
+            if reps:
+                base = self.union(base, base)
+        return rval
+    def union(self, a:dict, b:dict)->dict:
+        rval = defaultdict(float)
+        for pa_pool, pa in a.items():
+            for pb_pool, pb in b.items():
+                if pa*pb > PRUNE:
+                    rval[makePool(pa_pool + pb_pool)] += pa*pb
+        if len(rval) > self.max_states:
+            raise ExactUnsupported("Combining sub-block reps needs more than %d states"%self.max_states)
+        return rval
+    def doCurlyBlock(self, inst, pool, stack, where, pool_override=None):
+        reps, stack = stack[-1], stack[:-1]
+        if pool_override is not None:
+            pool_arg = pool_override
+        else:
+            pool_arg, pool = pool, ()
+        if reps == 0:
+            return [((pool, stack), 1.0)]
+        return [((makePool(pool + outcome), stack), p)
+                for outcome, p in self.repOutcomes(inst, pool_arg, reps, where[2]).items()]
+    def filterPredicate(self, ilist:List[RunnableUnit])->Union[Callable[[int],bool], None]:
+        # If a filter script is nothing but constant X+ / X- filters and [..] inversions, return it as a
+        # predicate on single values. Otherwise None.
+        checks = []
+        i = 0
+        while i < len(ilist):
+            inst = ilist[i]
+            if isinstance(inst, IntLiteral) and i+1 < len(ilist) and isinstance(ilist[i+1], (RunGeq, RunLeq)):
+                t = inst.val
+                checks.append((lambda v, t=t: v >= t) if isinstance(ilist[i+1], RunGeq) else (lambda v, t=t: v <= t))
+                i += 2
+                continue
+            if isinstance(inst, RunRangeConst):
+                low, high = inst.low, inst.high
+                checks.append(lambda v, low=low, high=high: (low is None or v >= low) and (high is None or v <= high))
+                i += 1
+                continue
+            if isinstance(inst, RunSquareBlock) and inst.curly_block is None:
+                inner = self.filterPredicate(inst.filt_ilist)
+                if inner is None:
+                    return None
+                checks.append(lambda v, inner=inner: not inner(v))
+                i += 1
+                continue
+            return None
+        return lambda v: all(c(v) for c in checks)
+    def doSquareBlock(self, inst, pool, stack, where):
+        nest_level = where[2]
+        pred = self.filterPredicate(inst.filt_ilist)
+        if pred is not None:
+            splits = splitPool(pool, pred)
+        else:
+            splits = []
+            for concrete, cp in materialize(pool, self.max_states):
+                filtered = self.runList(inst.filt_ilist, {(concrete, ()): 1.0}, nest_level+1, False)
+                for (fpool, fstack), fp in filtered.items():
+                    for fconcrete, fcp in materialize(fpool, self.max_states):
+                        counts = poolCounts(concrete)
+                        for v, n in poolCounts(fconcrete).items():
+                            counts[v] = counts.get(v, 0) - n
+                            if counts[v] < 0:
+                                raise RuntimeError("Can't remove an X from a dice pool without X in it!")
+                        splits.append((fconcrete, poolFromCounts(counts), cp*fp*fcp))
+        rval = []
+        for filtered, rest, p in splits:
+            if inst.curly_block is None:
+                rval.append(((rest, stack), p))
+                continue
+            for state, sp in self.doCurlyBlock(inst.curly_block, rest, stack, where, filtered):
+                rval.append((state, p*sp))
+        return rval
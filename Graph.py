@@ -1,34 +1,49 @@
-import matplotlib.pyplot as plt
+import csv
+import json
+import os
+import Stats
 from collections import Counter
 from typing import *
 
+# Where G sends its output. 'show' opens a matplotlib window, 'png', 'csv' and 'json' write to GRAPH_PATH, 'collect'
+# appends the graph's data to collected_graphs and 'none' throws the graph away. Only 'show' and 'png' import
+# matplotlib, so the other backends work on headless machines.
+GRAPH_BACKEND = 'show'
+GRAPH_PATH    = None
+graphs_written = 0
+collected_graphs = []
+
+def setGraphOutput(spec:str):
+    # spec is "show", "none", or "<png|csv|json>:<path>"
+    global GRAPH_BACKEND, GRAPH_PATH
+    backend, _, path = spec.partition(':')
+    if backend not in ('show', 'none', 'collect', 'png', 'csv', 'json'):
+        raise ValueError("Unknown graph output \"%s\""%spec)
+    if backend in ('png', 'csv', 'json') and not path:
+        raise ValueError("Graph output \"%s\" needs a file name, eg. %s:graph.%s"%(spec, backend, backend))
+    GRAPH_BACKEND, GRAPH_PATH = backend, path
+
+def nextGraphPath()->str:
+    # The first graph goes to GRAPH_PATH, later ones to name-2.ext, name-3.ext...
+    global graphs_written
+    graphs_written += 1
+    if graphs_written == 1:
+        return GRAPH_PATH
+    root, ext = os.path.splitext(GRAPH_PATH)
+    return '%s-%d%s'%(root, graphs_written, ext)
+
+def countPool(pool)->Counter:
+    # Accepts pools, value->weight mappings or anything that iterates over values
+    return Counter(Stats.poolCounts(pool))
+
 def findQuartiles(pool, val_increment=1.0)->Tuple[float, float, float]:
     # Find quartiles by graph area method.
     # IE first quartile should have 1/4 of the total bar graph area to the left
     # This assumes all bars are 1 unit wide. In cases where the histogram is regularly gappy,
     # eg. when there are only EVEN bars, it might be argued that the interpolated values should
     # be able to appear in the gaps, which this function will not do.
-    l = len(pool)
-    counter = Counter(pool)
-    def helper(frac)->float:
-        # Return a value such that frac amount of graph area is to the left of the argument
-        area_target = l * frac
-        area = 0.0
-        val = min(counter)
-        while True:
-            new_area = area + counter[val]
-            if new_area > area_target:
-                # This iteration would put us over the area_target
-                break
-            area = new_area
-            val += 1
-        # val represents the bar which must now be sub-divided
-        bar_height = counter[val] / val_increment
-        bar_left_edge = val - (0.5*val_increment)
-        area_delta = area_target - area
-        rval = bar_left_edge + (area_delta / bar_height)
-        return rval
-    return helper(0.25), helper(0.5), helper(0.75)
+    counter = countPool(pool)
+    return tuple(Stats.quantile(counter, frac, val_increment) for frac in (0.25, 0.5, 0.75))
 
 def determineIncrement(counter:Counter)->int:
     # Create a new counter of the deltas between adjacent values
@@ -41,25 +56,128 @@ def determineIncrement(counter:Counter)->int:
             return span
     assert(False, "Should never get here!")
 
-def makeBarGraph(pool, increment=None):
-    counter = Counter(pool)
-    if increment is None:
-        increment = determineIncrement(counter)
-    plt.figure(figsize=(10, 5))
-    pool_len = len(pool)
+def writeCsv(path:str, counter:Counter):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['value', 'count', 'percent'])
+        for val, pct in Stats.percentages(counter).items():
+            writer.writerow([val, counter[val], pct])
+
+def graphData(counter:Counter, increment:int, title:str)->dict:
+    return {'title'      : title,
+            'summary'    : Stats.summary(counter, increment),
+            'percentages': {str(k): v for k, v in Stats.percentages(counter).items()}}
+
+def plotBars(plt, counter:Counter, increment:int, title:str):
+    pool_len = sum(counter.values())
     percentages = [100*v / pool_len for v in counter.values()]
     plt.bar(counter.keys(), percentages, color='skyblue', width=increment-0.025)
-    q1, q2, q3 = findQuartiles(pool, increment)
+    q1, q2, q3 = findQuartiles(counter, increment)
     plt.axvline(x=q1, color='green', linestyle='--', label='Q1: %0.2f'%q1)
     plt.axvline(x=q2, color='red',   linestyle='--', label='Q2: %0.2f'%q2)
     plt.axvline(x=q3, color='blue',  linestyle='--', label='Q3: %0.2f'%q3)
     plt.xlabel('Value')
     plt.ylabel('Frequency (%)')
-    plt.title('Pool distribution for %d values'%len(pool))
+    plt.title(title)
     plt.xticks(range(min(counter.keys()), max(counter.keys()) + 1, increment))
     plt.legend()
     plt.grid(axis='y', linestyle='--')
-    plt.show()
+
+def barGraphDefaults(pool, increment=None, title=None)->Tuple[Counter, int, str]:
+    counter = countPool(pool)
+    if increment is None:
+        increment = determineIncrement(counter)
+    if title is None:
+        title = 'Pool distribution for %d values'%sum(counter.values())
+    return counter, increment, title
+
+def barGraphData(pool, increment=None, title=None)->dict:
+    # What the 'json' and 'collect' backends record for a graph of pool
+    return graphData(*barGraphDefaults(pool, increment, title))
+
+def makeBarGraph(pool, increment=None, title=None):
+    if GRAPH_BACKEND == 'none':
+        return
+    counter, increment, title = barGraphDefaults(pool, increment, title)
+    if GRAPH_BACKEND == 'csv':
+        writeCsv(nextGraphPath(), counter)
+        return
+    if GRAPH_BACKEND in ('json', 'collect'):
+        graph = graphData(counter, increment, title)
+        if GRAPH_BACKEND == 'collect':
+            collected_graphs.append(graph)
+            return
+        with open(nextGraphPath(), 'w') as f:
+            json.dump(graph, f, indent=1)
+        return
+    if GRAPH_BACKEND == 'png':
+        import matplotlib
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    plt.figure(figsize=(10, 5))
+    plotBars(plt, counter, increment, title)
+    if GRAPH_BACKEND == 'png':
+        plt.savefig(nextGraphPath())
+        plt.close()
+    else:
+        plt.show()
+
+class LiveBarGraph:
+    # A bar graph that is redrawn in place as partial results come in, e.g. from Executor.stream. 'show' keeps one
+    # window open, file backends rewrite the same file and 'collect' keeps only the latest version of the graph.
+    def __init__(self):
+        self.path = None
+        self.figure = None
+        self.collected_i = None
+    def update(self, pool, increment=None, title=None):
+        counter = countPool(pool)
+        if not counter or GRAPH_BACKEND == 'none':
+            return
+        if increment is None:
+            increment = determineIncrement(counter)
+        if title is None:
+            title = 'Pool distribution for %d values'%sum(counter.values())
+        if GRAPH_BACKEND == 'collect':
+            if self.collected_i is None:
+                self.collected_i = len(collected_graphs)
+                collected_graphs.append(None)
+            collected_graphs[self.collected_i] = graphData(counter, increment, title)
+            return
+        if GRAPH_BACKEND != 'show' and self.path is None:
+            self.path = nextGraphPath()
+        if GRAPH_BACKEND == 'csv':
+            writeCsv(self.path, counter)
+            return
+        if GRAPH_BACKEND == 'json':
+            with open(self.path, 'w') as f:
+                json.dump(graphData(counter, increment, title), f, indent=1)
+            return
+        if GRAPH_BACKEND == 'png':
+            import matplotlib
+            matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        if self.figure is None:
+            if GRAPH_BACKEND == 'show':
+                plt.ion()
+            self.figure = plt.figure(figsize=(10, 5))
+        plt.figure(self.figure.number)
+        plt.clf()
+        plotBars(plt, counter, increment, title)
+        if GRAPH_BACKEND == 'png':
+            plt.savefig(self.path)
+        else:
+            plt.pause(0.001) # Lets the window redraw
+    def close(self):
+        # Leaves a 'show' window open until the user closes it
+        if self.figure is None:
+            return
+        import matplotlib.pyplot as plt
+        if GRAPH_BACKEND == 'show':
+            plt.ioff()
+            plt.show()
+        else:
+            plt.close(self.figure)
+        self.figure = None
 
 if __name__ == "__main__":
     #makeBarGraph([1,1,1,1,1,1,1,1,1,1,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,3,3,3,3,3,3,3,3,3,3])
@@ -0,0 +1,163 @@
+import numpy as np
+import sys
+import Runtime
+import Stats
+from collections import OrderedDict, defaultdict
+from typing import *
+from DiceRNG import DiceRNG
+from Exact import ExactExecutor, ExactUnsupported, materialize, poolCounts, poolFromCounts
+from Optimizer import mapBlocks
+from Runtime import *
+
+# Outcome cache for curly blocks. Every rep of a block gets the same input pool and the body only looks at that pool,
+# so the output of one rep is a draw from a distribution that depends on nothing but (block, input pool). The cache
+# works that distribution out the first time a block sees a given input, and from then on runs the block's reps by
+# drawing outcomes from it with an alias table instead of interpreting the body.
+#
+# Distributions are computed exactly with Exact.py. Bodies it can't handle are either left to the interpreter or,
+# when learn_reps is set, learned from that many interpreted reps (an approximation: later draws can only repeat
+# outcomes seen while learning). Bodies that graph, print or change verbosity are never cached.
+#
+# Entries are evicted least recently used first once their estimated size, key and table, passes the memory budget.
+# A table that wouldn't fit in the budget on its own is used for the block run that built it but isn't kept.
+
+MAX_OUTCOMES = 1 << 16 # Distributions with more distinct outcomes than this aren't cached
+MAX_FAILURES = 3       # Blocks stop being tried after this many inputs in a row couldn't be cached
+
+class OutcomeTable:
+    # Distinct outcomes of one rep as a matrix of counts (row i is outcome i, column j the count of offset+j), with
+    # an alias table over them
+    def __init__(self, outcomes:Dict[tuple, float]):
+        keys = list(outcomes)
+        values = [v for key in keys for v, n in key]
+        self.offset = min(values) if values else 0
+        width = max(values) - self.offset + 1 if values else 0
+        self.counts = np.zeros((len(keys), width), dtype=np.int64)
+        for i, key in enumerate(keys):
+            for v, n in key:
+                self.counts[i, v - self.offset] = n
+        probs = np.array([outcomes[key] for key in keys], dtype=float)
+        self.prob, self.alias = self.aliasTable(probs / probs.sum())
+    @staticmethod
+    def aliasTable(probs:np.ndarray)->Tuple[np.ndarray, np.ndarray]:
+        # Vose's method: each column keeps prob[i] of itself and hands the rest to alias[i]
+        n = len(probs)
+        scaled = probs * n
+        prob = np.ones(n)
+        alias = np.arange(n)
+        small = [i for i in range(n) if scaled[i] < 1.0]
+        large = [i for i in range(n) if scaled[i] >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            prob[s] = scaled[s]
+            alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+        return prob, alias
+    def nbytes(self)->int:
+        return self.counts.nbytes + self.prob.nbytes + self.alias.nbytes
+    def sample(self, reps:int, pool_class, rng:DiceRNG)->DicePool:
+        # Pool holding the outputs of reps independent draws
+        col = rng.gen.integers(0, len(self.prob), reps)
+        picked = np.where(rng.gen.random(reps) < self.prob[col], col, self.alias[col])
+        totals = np.bincount(picked, minlength=len(self.prob)) @ self.counts
+        ss = defaultdict(int)
+        for i in np.flatnonzero(totals):
+            ss[self.offset + int(i)] = int(totals[i])
+        return pool_class(init_pool=ss)
+
+def cacheable(block:RunCurlyBlock)->bool:
+    # Bodies with side effects have to run every rep
+    found = False
+    def check(ilist:List[RunnableUnit])->List[RunnableUnit]:
+        nonlocal found
+        found = found or any(isinstance(inst, (RunG, RunP, RunV)) for inst in ilist)
+        return ilist
+    mapBlocks(block.ilist, check)
+    return not found
+
+class OutcomeCache:
+    def __init__(self, budget_bytes:int=64 << 20, learn_reps:int=None, max_states:int=20000):
+        self.budget = budget_bytes
+        self.learn_reps = learn_reps
+        self.max_states = max_states
+        self.entries = OrderedDict() # (block, input counts) -> OutcomeTable, or None if it can't be cached
+        self.bytes = 0
+        self.stats = {'hits': 0, 'misses': 0, 'computed': 0, 'learned': 0, 'uncacheable': 0, 'too_big': 0,
+                      'evictions': 0, 'reps_sampled': 0}
+        # block -> inputs in a row that couldn't be cached. Blocks with side effects start at the limit.
+        self.failures = {}
+    def runReps(self, block:RunCurlyBlock, estate:ExecState, pool_arg:DicePool, reps:int)->Union[DicePool, None]:
+        # The aggregate of reps runs of block, or None if the block has to be interpreted
+        if block not in self.failures:
+            self.failures[block] = 0 if cacheable(block) else MAX_FAILURES
+        if self.failures[block] >= MAX_FAILURES:
+            return None
+        key = (block, tuple(sorted(Stats.poolCounts(pool_arg).items())))
+        if key in self.entries:
+            self.stats['hits'] += 1
+            self.entries.move_to_end(key)
+            table = self.entries[key]
+        else:
+            self.stats['misses'] += 1
+            table = self.build(block, estate, pool_arg, dict(key[1]))
+            self.failures[block] = self.failures[block] + 1 if table is None else 0
+            self.store(key, table)
+        if table is None:
+            return None
+        self.stats['reps_sampled'] += reps
+        return table.sample(reps, Runtime.POOL_CLASS, estate.ctx.rng)
+    def build(self, block:RunCurlyBlock, estate:ExecState, pool_arg:DicePool,
+              counts:Dict[int, int])->Union[OutcomeTable, None]:
+        try:
+            exact = ExactExecutor(Executor(block.ilist, estate.debug_script), self.max_states)
+            outcomes = defaultdict(float)
+            for pool, p in exact.repOutcomes(block, poolFromCounts(counts), 1, estate.nest_level).items():
+                for concrete, cp in materialize(pool, self.max_states):
+                    outcomes[tuple(sorted((v, n) for v, n in poolCounts(concrete).items() if n))] += p*cp
+                if len(outcomes) > MAX_OUTCOMES:
+                    raise ExactUnsupported("More than %d outcomes"%MAX_OUTCOMES)
+            self.stats['computed'] += 1
+            return OutcomeTable(outcomes)
+        except (ExactUnsupported, RuntimeError):
+            # A RuntimeError is a body that fails on some outcome; the interpreter will report it if it happens
+            pass
+        if self.learn_reps is None:
+            self.stats['uncacheable'] += 1
+            return None
+        e = Executor(block.ilist, estate.debug_script)
+        outcomes = defaultdict(float)
+        for i in range(self.learn_reps):
+            sub_s = e.run(pool_arg, estate.nest_level+1, ctx=estate.ctx)
+            out = Runtime.POOL_CLASS(sub_s.arg_stack) if len(sub_s.arg_stack) else sub_s.pool
+            outcomes[tuple(sorted(Stats.poolCounts(out).items()))] += 1
+        self.stats['learned'] += 1
+        return OutcomeTable(outcomes)
+    @staticmethod
+    def entryBytes(key, table:Union[OutcomeTable, None])->int:
+        # Estimated size of an entry: the input counts in its key plus its table. The block is shared, so not counted.
+        size = sys.getsizeof(key) + sys.getsizeof(key[1]) + sum(sys.getsizeof(pair) for pair in key[1])
+        return size + (table.nbytes() if table is not None else 0)
+    def store(self, key, table:Union[OutcomeTable, None]):
+        if table is not None and self.entryBytes(key, table) > self.budget:
+            # Keeping it would mean evicting everything else and still being over budget
+            self.stats['too_big'] += 1
+            table = None
+        self.entries[key] = table
+        self.bytes += self.entryBytes(key, table)
+        while self.bytes > self.budget and self.entries:
+            old_key, old = self.entries.popitem(last=False)
+            self.bytes -= self.entryBytes(old_key, old)
+            self.stats['evictions'] += 1
+    def report(self)->str:
+        st = self.stats
+        lookups = st['hits'] + st['misses']
+        return ("Outcome cache: %d hits, %d misses (%0.1f%% hit rate), %d computed exactly, %d learned, "
+                "%d uncacheable, %d too big, %d evictions, %d entries in %0.1fKB, %d reps sampled")%(
+                st['hits'], st['misses'], 100*st['hits'] / lookups if lookups else 0.0, st['computed'], st['learned'],
+                st['uncacheable'], st['too_big'], st['evictions'], len(self.entries), self.bytes / 1024, st['reps_sampled'])
+    def __enter__(self):
+        Runtime.OUTCOME_CACHE = self
+        return self
+    def __exit__(self, *exc):
+        Runtime.OUTCOME_CACHE = None
@@ -0,0 +1,349 @@
+import numpy as np
+import Runtime
+from typing import Callable, List
+from BatchPool import BatchPool
+from Runtime import *
+
+# Optimisation passes over the instruction list from Compiler.compile().
+#
+# The compiler emits a plain stack machine, so "3D6 5+" is IntLiteral 3, IntLiteral 6, RunD, IntLiteral 5, RunGeq.
+# The passes here fold constant arguments into fused instructions, merge runs of filters, drop blocks that do nothing
+# and, when the script can never turn verbosity on, swap in instructions that skip the shouldPrint checks entirely.
+# The optimised list is built from new instruction objects; the compiler's output is left untouched.
+
+def constArray(bstate:BatchExecState, val:int)->np.ndarray:
+    return np.full(bstate.pool.rows, val, dtype=np.int64)
+
+class RunDConst(RunnableUnit):
+    # "xDy" with both arguments known at compile time
+    def __init__(self, n_dice:int, n_sides:int):
+        self.n_dice = n_dice
+        self.n_sides = n_sides
+    def run(self, estate:ExecState):
+        estate.pool = Runtime.rollPool(estate.ctx.rng, self.n_dice, self.n_sides)
+        if estate.shouldPrint():
+            estate.nestPrint("Rolled %dD%d, got:" % (self.n_dice, self.n_sides))
+            estate.nestPrint(estate.pool)
+    def runBatch(self, bstate:BatchExecState):
+        bstate.pool = BatchPool.fromRolls(constArray(bstate, self.n_dice), constArray(bstate, self.n_sides),
+                                          bstate.ctx.rng)
+
+class RunDSidesConst(RunnableUnit):
+    # "CDy" and "SDy": the number of dice comes off the stack, the sides are known
+    def __init__(self, n_sides:int):
+        self.n_sides = n_sides
+    def run(self, estate:ExecState):
+        n_dice = estate.arg_stack.pop()
+        estate.pool = Runtime.rollPool(estate.ctx.rng, n_dice, self.n_sides)
+        if estate.shouldPrint():
+            estate.nestPrint("Rolled %dD%d, got:" % (n_dice, self.n_sides))
+            estate.nestPrint(estate.pool)
+    def runBatch(self, bstate:BatchExecState):
+        n_dice = bstate.arg_stack.pop()
+        bstate.pool = BatchPool.fromRolls(n_dice, constArray(bstate, self.n_sides), bstate.ctx.rng)
+
+class RunRangeConst(RunnableUnit):
+    # Keep low <= X <= high. "5+" is RunRangeConst(5, None), "3-" is RunRangeConst(None, 3).
+    def __init__(self, low:Union[int,None], high:Union[int,None]):
+        self.low = low
+        self.high = high
+    def run(self, estate:ExecState):
+        start_len = len(estate.pool)
+        if self.low is not None:
+            estate.pool.keepGeq(self.low)
+        if self.high is not None:
+            estate.pool.keepLeq(self.high)
+        if estate.shouldPrint():
+            if self.low is not None:
+                estate.nestPrint("Pass on %d+" % self.low)
+            if self.high is not None:
+                estate.nestPrint("Pass on %d-" % self.high)
+            end_len = len(estate.pool)
+            estate.nestPrint("Removed %d dice, leaving %d" % (start_len - end_len, end_len))
+    def runBatch(self, bstate:BatchExecState):
+        if self.low is not None:
+            bstate.pool = bstate.pool.getGeqSubset(constArray(bstate, self.low))
+        if self.high is not None:
+            bstate.pool = bstate.pool.getLeqSubset(constArray(bstate, self.high))
+
+class RunTopConst(RunnableUnit):
+    # "Hx" or "Lx" with a literal x
+    def __init__(self, count:int, top:bool):
+        self.count = count
+        self.top = top
+    def run(self, estate:ExecState):
+        if self.top:
+            estate.pool.keepTop(self.count)
+        else:
+            estate.pool.keepBottom(self.count)
+        if estate.shouldPrint():
+            estate.nestPrint("Grabbing %s %d dice"%('top' if self.top else 'bottom', self.count))
+    def runBatch(self, bstate:BatchExecState):
+        if self.top:
+            bstate.pool = bstate.pool.getTop(constArray(bstate, self.count))
+        else:
+            bstate.pool = bstate.pool.getBottom(constArray(bstate, self.count))
+
+class RunMultConst(RunnableUnit):
+    def __init__(self, factor:int):
+        self.factor = factor
+    def run(self, estate:ExecState):
+        estate.pool.mulInt(self.factor)
+        if estate.shouldPrint():
+            estate.nestPrint("Multiplied pool by %d"%self.factor)
+    def runBatch(self, bstate:BatchExecState):
+        bstate.pool.mulInt(constArray(bstate, self.factor))
+
+class RunAddConst(RunnableUnit):
+    # "+x" and "-x" with a literal x
+    def __init__(self, die:int):
+        self.die = die
+    def run(self, estate:ExecState):
+        estate.pool.addDie(self.die)
+        if estate.shouldPrint():
+            estate.nestPrint("Added %+d to pool" % self.die)
+    def runBatch(self, bstate:BatchExecState):
+        bstate.pool.addValues(constArray(bstate, self.die))
+
+# Variants with the verbosity checks stripped out, for scripts that can never print
+
+class QuietRunS(RunS):
+    def run(self, estate:ExecState):
+        estate.arg_stack.append(estate.pool.sum())
+
+class QuietRunC(RunC):
+    def run(self, estate:ExecState):
+        estate.arg_stack.append(len(estate.pool))
+
+class QuietRunD(RunD):
+    def run(self, estate:ExecState):
+        n_sides = estate.arg_stack.pop()
+        n_dice  = estate.arg_stack.pop()
+        estate.pool = Runtime.rollPool(estate.ctx.rng, n_dice, n_sides)
+
+class QuietRunGeq(RunGeq):
+    def run(self, estate:ExecState):
+        estate.pool.keepGeq(estate.arg_stack.pop())
+
+class QuietRunLeq(RunLeq):
+    def run(self, estate:ExecState):
+        estate.pool.keepLeq(estate.arg_stack.pop())
+
+class QuietRunPlusX(RunPlusX):
+    def run(self, estate:ExecState):
+        estate.pool.addDie(estate.arg_stack.pop())
+
+class QuietRunMinusX(RunMinusX):
+    def run(self, estate:ExecState):
+        estate.pool.addDie(-1*estate.arg_stack.pop())
+
+class QuietRunMult(RunMult):
+    def run(self, estate:ExecState):
+        estate.pool.mulInt(estate.arg_stack.pop())
+
+class QuietRunH(RunH):
+    def run(self, estate:ExecState):
+        estate.pool.keepTop(estate.arg_stack.pop())
+
+class QuietRunL(RunL):
+    def run(self, estate:ExecState):
+        estate.pool.keepBottom(estate.arg_stack.pop())
+
+class QuietRunDConst(RunDConst):
+    def run(self, estate:ExecState):
+        estate.pool = Runtime.rollPool(estate.ctx.rng, self.n_dice, self.n_sides)
+
+class QuietRunDSidesConst(RunDSidesConst):
+    def run(self, estate:ExecState):
+        estate.pool = Runtime.rollPool(estate.ctx.rng, estate.arg_stack.pop(), self.n_sides)
+
+class QuietRunRangeConst(RunRangeConst):
+    def run(self, estate:ExecState):
+        if self.low is not None:
+            estate.pool.keepGeq(self.low)
+        if self.high is not None:
+            estate.pool.keepLeq(self.high)
+
+class QuietRunTopConst(RunTopConst):
+    def run(self, estate:ExecState):
+        if self.top:
+            estate.pool.keepTop(self.count)
+        else:
+            estate.pool.keepBottom(self.count)
+
+class QuietRunMultConst(RunMultConst):
+    def run(self, estate:ExecState):
+        estate.pool.mulInt(self.factor)
+
+class QuietRunAddConst(RunAddConst):
+    def run(self, estate:ExecState):
+        estate.pool.addDie(self.die)
+
+class QuietCurlyBlock(RunCurlyBlock):
+    # RunCurlyBlock already skips its verbose paths when nothing would print. Kept as its own type so the blocks
+    # stripVerbosity made stay recognisable, e.g. in dumpIR.
+    pass
+
+class QuietSquareBlock(RunSquareBlock):
+    def run(self, estate:ExecState):
+        e = Executor(self.filt_ilist, estate.debug_script)
+        substate = e.run(estate.pool, estate.nest_level+1, ctx=estate.ctx)
+        estate.pool.subPool(substate.pool)
+        if self.curly_block is not None:
+            self.curly_block.run(estate, substate.pool)
+
+QUIET_VARIANTS = {
+    RunS          : QuietRunS,
+    RunC          : QuietRunC,
+    RunD          : QuietRunD,
+    RunGeq        : QuietRunGeq,
+    RunLeq        : QuietRunLeq,
+    RunPlusX      : QuietRunPlusX,
+    RunMinusX     : QuietRunMinusX,
+    RunMult       : QuietRunMult,
+    RunH          : QuietRunH,
+    RunL          : QuietRunL,
+    RunDConst     : QuietRunDConst,
+    RunDSidesConst: QuietRunDSidesConst,
+    RunRangeConst : QuietRunRangeConst,
+    RunTopConst   : QuietRunTopConst,
+    RunMultConst  : QuietRunMultConst,
+    RunAddConst   : QuietRunAddConst,
+}
+
+def made(inst:RunnableUnit, script_i:int)->RunnableUnit:
+    inst.setDebugParams(script_i=script_i)
+    return inst
+
+def mapBlocks(ilist:List[RunnableUnit], fn:Callable[[List[RunnableUnit]], List[RunnableUnit]])->List[RunnableUnit]:
+    # Apply fn to ilist and to the body of every block inside it, innermost first.
+    # Blocks are rebuilt rather than modified.
+    rval = []
+    for inst in ilist:
+        if isinstance(inst, RunCurlyBlock):
+            inst = made(RunCurlyBlock(mapBlocks(inst.ilist, fn)), inst.script_i)
+        elif isinstance(inst, RunSquareBlock):
+            curly = inst.curly_block
+            if curly is not None:
+                # The compiler doesn't give the curly half of "[..]{..}" a position of its own
+                curly = made(RunCurlyBlock(mapBlocks(curly.ilist, fn)), getattr(curly, 'script_i', inst.script_i))
+            inst = made(RunSquareBlock(mapBlocks(inst.filt_ilist, fn), curly), inst.script_i)
+        rval.append(inst)
+    return fn(rval)
+
+def foldConstants(ilist:List[RunnableUnit])->List[RunnableUnit]:
+    # An instruction that pops its arguments right after they were pushed as literals can take them as constants
+    rval = []
+    def literal(back:int)->Union[int,None]:
+        if len(rval) >= back and isinstance(rval[-back], IntLiteral):
+            return rval[-back].val
+        return None
+    for inst in ilist:
+        t = type(inst)
+        arg = literal(1)
+        if t is RunD and arg is not None:
+            n_dice = literal(2)
+            if n_dice is not None:
+                del rval[-2:]
+                inst = made(RunDConst(n_dice, arg), inst.script_i)
+            else:
+                del rval[-1]
+                inst = made(RunDSidesConst(arg), inst.script_i)
+        elif t in (RunGeq, RunLeq) and arg is not None:
+            del rval[-1]
+            inst = made(RunRangeConst(arg, None) if t is RunGeq else RunRangeConst(None, arg), inst.script_i)
+        elif t in (RunH, RunL) and arg is not None:
+            del rval[-1]
+            inst = made(RunTopConst(arg, t is RunH), inst.script_i)
+        elif t is RunMult and arg is not None:
+            del rval[-1]
+            inst = made(RunMultConst(arg), inst.script_i)
+        elif t in (RunPlusX, RunMinusX) and arg is not None:
+            del rval[-1]
+            inst = made(RunAddConst(arg if t is RunPlusX else -arg), inst.script_i)
+        rval.append(inst)
+    return rval
+
+def mergeFilters(ilist:List[RunnableUnit])->List[RunnableUnit]:
+    # "3+ 5+" is "5+", and "2+ 5-" is a single range filter
+    rval = []
+    for inst in ilist:
+        if type(inst) is RunRangeConst and len(rval) and type(rval[-1]) is RunRangeConst:
+            prev = rval.pop()
+            lows  = [v for v in (prev.low,  inst.low)  if v is not None]
+            highs = [v for v in (prev.high, inst.high) if v is not None]
+            inst = made(RunRangeConst(max(lows) if lows else None, min(highs) if highs else None), prev.script_i)
+        rval.append(inst)
+    return rval
+
+def dropNoOps(ilist:List[RunnableUnit])->List[RunnableUnit]:
+    rval = []
+    for inst in ilist:
+        if type(inst) is RunMultConst and inst.factor == 1:
+            continue
+        if type(inst) is RunCurlyBlock and len(inst.ilist) == 0 and len(rval) and \
+                type(rval[-1]) is IntLiteral and rval[-1].val == 1:
+            # "1{}" hands the pool to an empty block and takes it straight back
+            rval.pop()
+            continue
+        rval.append(inst)
+    return rval
+
+def canRaiseVerbosity(ilist:List[RunnableUnit])->bool:
+    # Only a V with a literal 0 argument is known not to turn printing on
+    found = False
+    def check(sub:List[RunnableUnit])->List[RunnableUnit]:
+        nonlocal found
+        for i, inst in enumerate(sub):
+            if isinstance(inst, RunV) and not (i > 0 and isinstance(sub[i-1], IntLiteral) and sub[i-1].val == 0):
+                found = True
+        return sub
+    mapBlocks(ilist, check)
+    return found
+
+def stripVerbosity(ilist:List[RunnableUnit])->List[RunnableUnit]:
+    rval = []
+    for inst in ilist:
+        if type(inst) is RunCurlyBlock:
+            inst = made(QuietCurlyBlock(inst.ilist), inst.script_i)
+        elif type(inst) is RunSquareBlock:
+            curly = inst.curly_block
+            if curly is not None:
+                curly = made(QuietCurlyBlock(curly.ilist), getattr(curly, 'script_i', inst.script_i))
+            inst = made(QuietSquareBlock(inst.filt_ilist, curly), inst.script_i)
+        elif type(inst) in QUIET_VARIANTS:
+            quiet = QUIET_VARIANTS[type(inst)].__new__(QUIET_VARIANTS[type(inst)])
+            quiet.__dict__.update(inst.__dict__)
+            inst = quiet
+        rval.append(inst)
+    return rval
+
+def optimize(e:Executor)->Executor:
+    ilist = mapBlocks(e.instructions, foldConstants)
+    ilist = mapBlocks(ilist, mergeFilters)
+    ilist = mapBlocks(ilist, dropNoOps)
+    if not canRaiseVerbosity(ilist):
+        # Only runs that start at verbosity 0 stay quiet throughout; the Executor keeps ilist for the others
+        return Executor(mapBlocks(ilist, stripVerbosity), e.debug_script, ilist)
+    return Executor(ilist, e.debug_script)
+
+def describeInstruction(inst:RunnableUnit)->str:
+    args = ' '.join('%s=%s'%(k, v) for k, v in vars(inst).items()
+                    if k != 'script_i' and (v is None or isinstance(v, (int, bool))))
+    return ('%s %s'%(type(inst).__name__, args)).strip()
+
+def dumpIR(e:Executor)->str:
+    lines = []
+    def dump(ilist:List[RunnableUnit], depth:int):
+        for inst in ilist:
+            lineno, line = e.getGlobalScriptLineForPosition(inst.script_i)
+            lines.append('%-50s # line %d: %s'%('    '*depth + describeInstruction(inst), lineno, line.strip()[:50]))
+            if isinstance(inst, RunCurlyBlock):
+                dump(inst.ilist, depth+1)
+            elif isinstance(inst, RunSquareBlock):
+                dump(inst.filt_ilist, depth+1)
+                if inst.curly_block is not None:
+                    lines.append('    '*depth + 'then ' + describeInstruction(inst.curly_block))
+                    dump(inst.curly_block.ilist, depth+1)
+    dump(e.instructions, 0)
+    return '\n'.join(lines)
@@ -0,0 +1,56 @@
+import DiceRNG as DiceRNGModule
+import Runtime
+from concurrent.futures import ProcessPoolExecutor
+from numpy import random
+from DiceRNG import DiceRNG
+from DicePool import DicePool
+from Runtime import ExecState, RunContext, RunCurlyBlock
+
+# Splits the reps of top level curly blocks across a pool of worker processes.
+#
+# Reps are cut into fixed size chunks and every chunk gets its own RNG stream spawned from one master seed. Since the
+# chunking doesn't depend on how many workers there are, the merged result for a given seed is the same whatever the
+# worker count.
+
+CHUNK_REPS = 4096
+
+def settings()->tuple:
+    # The runtime settings a worker needs, passed explicitly since spawned workers don't inherit module state
+    return Runtime.POOL_CLASS, Runtime.BATCH_ENABLED, DiceRNGModule.COUNT_MIN_DICE
+
+def initWorker(pool_class, batch_enabled:bool, count_min_dice):
+    # Runs once in each worker process
+    Runtime.POOL_CLASS = pool_class
+    Runtime.BATCH_ENABLED = batch_enabled
+    DiceRNGModule.COUNT_MIN_DICE = count_min_dice
+
+def runChunk(block:RunCurlyBlock, debug_script:str, pool_arg:DicePool, reps:int, seed, verbosity:int)->DicePool:
+    # Runs in the worker process
+    estate = ExecState(Runtime.POOL_CLASS(), [], 0, debug_script, RunContext(verbosity, DiceRNG(seed)))
+    return block.runReps(estate, pool_arg, reps)
+
+class ParallelRunner:
+    def __init__(self, workers:int, seed:int=None):
+        self.workers = workers
+        self.seed_seq = random.SeedSequence(seed)
+        self.pool = ProcessPoolExecutor(max_workers=workers, initializer=initWorker, initargs=settings())
+    def runReps(self, block:RunCurlyBlock, estate:ExecState, pool_arg:DicePool, reps:int)->DicePool:
+        # Every block run gets its own child sequence so repeated blocks don't reuse streams
+        block_seq = self.seed_seq.spawn(1)[0]
+        starts = range(0, reps, CHUNK_REPS)
+        seeds = block_seq.spawn(len(starts))
+        futures = [self.pool.submit(runChunk, block, estate.debug_script, pool_arg, min(CHUNK_REPS, reps - start),
+                                    chunk_seq, estate.ctx.verbosity)
+                   for start, chunk_seq in zip(starts, seeds)]
+        agg_pool = Runtime.POOL_CLASS()
+        for f in futures:
+            agg_pool.addPool(f.result())
+        return agg_pool
+    def close(self):
+        self.pool.shutdown()
+    def __enter__(self):
+        Runtime.TOP_LEVEL_RUNNER = self
+        return self
+    def __exit__(self, *exc):
+        Runtime.TOP_LEVEL_RUNNER = None
+        self.close()
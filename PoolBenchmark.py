@@ -0,0 +1,65 @@
+import timeit
+import ArrayPool as array_pool
+import DicePool as dice_pool
+import Runtime
+from numpy import random
+from ArrayPool import ArrayPool
+from Compiler import Compiler
+from DicePool import DicePool
+
+# Micro-benchmark of the pool implementations. Each line is the time for one operation, averaged over many runs.
+# For the per-rep script it also counts pool copies, and how many of them copy-on-write never had to make.
+
+OPERATIONS = {
+    'build from dice': 'cls(dice)',
+    'len'            : 'len(pool)',
+    'sum'            : 'pool.sum()',
+    'getGeqSubset(4)': 'pool.getGeqSubset(4)',
+    'keepGeq(4)'     : 'pool.copy().keepGeq(4)',
+    'getTop(10)'     : 'pool.getTop(10)',
+    'addPool'        : 'pool.copy().addPool(pool)',
+    'copy'           : 'pool.copy()',
+}
+
+SCRIPT = """1000{
+    100D6
+    [1-]{CD6}
+    [6+]{*2}
+    3+
+    CD6
+    [[5+]] {CD6}
+    5+
+    C
+}"""
+
+def timeOperation(cls, stmt:str, n_dice:int, number:int=200)->float:
+    dice = random.randint(1, 7, n_dice)
+    env = {'cls': cls, 'dice': dice, 'pool': cls(dice)}
+    return min(timeit.repeat(stmt, globals=env, number=number, repeat=3)) / number
+
+def timeScript(cls)->float:
+    Runtime.POOL_CLASS = cls
+    Runtime.BATCH_ENABLED = False
+    e = Compiler(SCRIPT).compile()
+    return min(timeit.repeat(e.run, number=1, repeat=3))
+
+def countCopies(cls)->dict:
+    # Copy counters for one run of the per-rep script
+    stats = {DicePool: dice_pool.COPY_STATS, ArrayPool: array_pool.COPY_STATS}[cls]
+    Runtime.POOL_CLASS = cls
+    Runtime.BATCH_ENABLED = False
+    e = Compiler(SCRIPT).compile()
+    stats['copies'] = stats['materialized'] = 0
+    e.run()
+    return dict(stats)
+
+if __name__ == '__main__':
+    classes = [DicePool, ArrayPool]
+    for n_dice in (100, 100000):
+        print('%-18s'%('%d dice'%n_dice) + ''.join('%14s'%cls.__name__ for cls in classes))
+        for name, stmt in OPERATIONS.items():
+            print('%-18s'%name + ''.join('%12.2fus'%(1e6*timeOperation(cls, stmt, n_dice)) for cls in classes))
+    print('%-18s'%'per-rep script' + ''.join('%13.3fs'%timeScript(cls) for cls in classes))
+    copies = [countCopies(cls) for cls in classes]
+    print('%-18s'%'copies' + ''.join('%14d'%c['copies'] for c in copies))
+    print('%-18s'%'copies avoided' + ''.join('%14d'%(c['copies'] - c['materialized']) for c in copies))
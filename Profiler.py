@@ -0,0 +1,98 @@
+import time
+from dataclasses import dataclass
+from typing import *
+from Optimizer import made, mapBlocks
+from Runtime import BatchExecState, ExecState, Executor, RunnableUnit
+
+# Script level profiler. profile() returns a copy of the program with every instruction wrapped in a ProfiledUnit,
+# which times it and records how many dice it saw. The unwrapped program is left alone, so nothing is paid for
+# profiling unless it's asked for.
+#
+# Self time is the instruction's time minus the time spent in the instructions nested inside it. Batched
+# instructions handle many reps per call, so calls and dice are counted per rep.
+
+@dataclass
+class InstructionStats:
+    script_i: int
+    name: str
+    calls: int = 0
+    cum_time: float = 0.0
+    self_time: float = 0.0
+    dice_in: int = 0
+    dice_out: int = 0
+
+class Profile:
+    def __init__(self, e:Executor):
+        self.e = e
+        self.stats = [] # type: List[InstructionStats]
+        self.child_time = [] # Time spent in nested instructions, one entry per instruction being run
+    def wrap(self, inst:RunnableUnit)->RunnableUnit:
+        name = type(inst).__name__
+        for prefix in ('Quiet', 'Run'):
+            name = name[len(prefix):] if name.startswith(prefix) else name
+        st = InstructionStats(inst.script_i, name)
+        self.stats.append(st)
+        return made(ProfiledUnit(inst, self, st), inst.script_i)
+    def begin(self)->float:
+        self.child_time.append(0.0)
+        return time.perf_counter()
+    def end(self, start:float, st:InstructionStats, calls:int, dice_in:int, dice_out:int):
+        elapsed = time.perf_counter() - start
+        child = self.child_time.pop()
+        if self.child_time:
+            self.child_time[-1] += elapsed
+        st.calls += calls
+        st.cum_time += elapsed
+        st.self_time += elapsed - child
+        st.dice_in += dice_in
+        st.dice_out += dice_out
+    def total(self)->float:
+        return sum(st.self_time for st in self.stats)
+    def report(self, top:int=20)->str:
+        total = self.total() or 1.0
+        by_line = {}
+        for st in self.stats:
+            lineno, line = self.e.getGlobalScriptLineForPosition(st.script_i)
+            entry = by_line.setdefault(lineno, [0.0, 0, line])
+            entry[0] += st.self_time
+            entry[1] += st.calls
+        lines = ["Profile: %0.4fs in instructions"%self.total(), "Hot lines:",
+                 "%6s %10s %6s %10s  %s"%('line', 'self', '%', 'calls', 'script')]
+        for lineno, (self_time, calls, line) in sorted(by_line.items(), key=lambda kv: -kv[1][0])[:top]:
+            lines.append("%6d %9.4fs %5.1f%% %10d  %s"%(lineno, self_time, 100*self_time/total, calls, line.strip()))
+        lines += ["Instructions:",
+                  "%6s %-14s %10s %10s %10s %10s %10s"%('line', 'op', 'calls', 'self', 'cum', 'dice in', 'dice out')]
+        for st in sorted(self.stats, key=lambda st: -st.self_time)[:top]:
+            if st.calls == 0:
+                continue
+            lineno, line = self.e.getGlobalScriptLineForPosition(st.script_i)
+            lines.append("%6d %-14s %10d %9.4fs %9.4fs %10.1f %10.1f"%(lineno, st.name, st.calls, st.self_time,
+                         st.cum_time, st.dice_in/st.calls, st.dice_out/st.calls))
+        return '\n'.join(lines)
+
+class ProfiledUnit(RunnableUnit):
+    def __init__(self, inst:RunnableUnit, profile:Profile, st:InstructionStats):
+        self.inst = inst
+        self.profile = profile
+        self.st = st
+    def run(self, estate:ExecState, *args):
+        dice_in = len(estate.pool)
+        start = self.profile.begin()
+        try:
+            self.inst.run(estate, *args)
+        finally:
+            self.profile.end(start, self.st, 1, dice_in, len(estate.pool))
+    def runBatch(self, bstate:BatchExecState, *args):
+        rows = bstate.pool.rows
+        dice_in = int(bstate.pool.counts.sum())
+        start = self.profile.begin()
+        try:
+            self.inst.runBatch(bstate, *args)
+        finally:
+            self.profile.end(start, self.st, rows, dice_in, int(bstate.pool.counts.sum()))
+    def runReps(self, *args):
+        return self.inst.runReps(*args)
+
+def profile(e:Executor)->Tuple[Executor, Profile]:
+    p = Profile(e)
+    return Executor(mapBlocks(e.instructions, lambda ilist: [p.wrap(inst) for inst in ilist]), e.debug_script), p
@@ -1,11 +1,70 @@
-from dataclasses import dataclass
+import numpy as np
+import DiceRNG
+import Graph
+import Stats
+import time
+from dataclasses import dataclass, field
+from BatchPool import BatchPool, BatchUnsupported
 from DicePool import DicePool
-from Graph import makeBarGraph
-from numpy import random
-from typing import List, Iterable, Union
+from Trace import TraceSink
+from typing import List, Iterable, TextIO, Union
 
-#FIXME: Not reset between invocations
-VERBOSITY_GLOBAL = 0
+# The settings below are shared by every run in the process. What a single run changes or draws from lives in its
+# RunContext instead.
+# Run the reps of curly blocks all at once on BatchPools where possible
+BATCH_ENABLED = True
+BATCH_REPS    = 2048
+# Pool implementation used by the interpreter. ArrayPool.ArrayPool is a drop-in alternative to DicePool.
+POOL_CLASS = DicePool
+# When set, the reps of top level curly blocks are handed to this object's runReps instead (see Parallel.py)
+TOP_LEVEL_RUNNER = None
+# When set, curly blocks ask this object's runReps first and are only interpreted if it returns None (see Memo.py)
+OUTCOME_CACHE = None
+# Executor.stream reports on top level blocks this often by default, starting with a chunk of STREAM_FIRST_REPS reps
+STREAM_INTERVAL_S = 0.25
+STREAM_FIRST_REPS = 64
+
+def rollPool(rng:DiceRNG.DiceRNG, n_dice:int, n_sides:int)->DicePool:
+    # A pool of n_dice dice with n_sides sides. Big rolls are drawn as face counts, see DiceRNG.COUNT_MIN_DICE.
+    if rng.useCounts(n_dice, n_sides):
+        return POOL_CLASS.fromCounts(1, rng.rollCounts(n_dice, n_sides))
+    return POOL_CLASS(rng.roll(n_dice, n_sides))
+
+@dataclass
+class RunContext:
+    # Everything a run changes or draws from besides its pools and stack. Each top level run gets its own, and every
+    # block inside it shares it, so runs in different threads don't see each other's verbosity, dice or output.
+    verbosity: int = 0
+    # The shared DiceRNG.RNG by default, so DiceRNG.seed() seeds runs that don't bring their own
+    rng      : DiceRNG.DiceRNG = field(default_factory=lambda: DiceRNG.RNG)
+    out      : TextIO = None # Where printed output goes. None is whatever sys.stdout is at the time.
+    graphs   : list = None   # If set, G appends its graph's data here instead of using Graph's output
+    # If set, verbose output goes to this Trace.TraceSink as records instead of being printed
+    trace    : TraceSink = None
+    reps     : List[int] = field(default_factory=list) # Rep of each curly block being run, outermost first
+    sampled  : bool = True # Whether the trace's sampling keeps the current outermost rep
+    def print(self, *args):
+        print(*args, file=self.out)
+    def enterRep(self, rep:int):
+        self.reps.append(rep)
+        if len(self.reps) == 1:
+            self.sampled = self.trace.sampled(rep)
+    def leaveRep(self):
+        self.reps.pop()
+        if not self.reps:
+            self.sampled = True
+    def record(self, kind:str, estate:'ExecState', text:str, with_pool:bool)->dict:
+        pool = None
+        if with_pool:
+            pool = [[int(k), int(v)] for k, v in sorted(Stats.poolCounts(estate.pool).items())]
+        return {'kind': kind, 'script_i': estate.script_i, 'nest_level': estate.nest_level, 'reps': list(self.reps),
+                'pool_size': len(estate.pool), 'pool': pool,
+                'stack': [int(v) for v in estate.arg_stack], 'text': text}
+    def graph(self, pool:DicePool):
+        if self.graphs is not None:
+            self.graphs.append(Graph.barGraphData(pool))
+        else:
+            Graph.makeBarGraph(pool)
 
 @dataclass
 class ExecState:
@@ -13,22 +72,73 @@ class ExecState:
     arg_stack   : List[int]
     nest_level  : int
     debug_script: str
+    ctx         : RunContext = field(default_factory=RunContext)
+    script_i    : int = -1 # Instruction being run, only kept up to date while tracing
     def shouldPrint(self):
-        global VERBOSITY_GLOBAL
-        return VERBOSITY_GLOBAL > self.nest_level
+        return self.ctx.verbosity > self.nest_level and self.ctx.sampled
     def nestPrint(self, *args):
-        print('    '*self.nest_level, *args)
+        if self.ctx.trace is not None:
+            self.ctx.trace.add(self.ctx.record('msg', self, ' '.join(str(a) for a in args), False))
+        else:
+            self.ctx.print('    '*self.nest_level, *args)
+
+@dataclass
+class BatchExecState:
+    # Like ExecState, but for many reps at once. Each arg stack entry holds one value per rep.
+    pool        : BatchPool
+    arg_stack   : List[np.ndarray]
+    nest_level  : int
+    debug_script: str
+    ctx         : RunContext = field(default_factory=RunContext)
+    def outputPool(self)->BatchPool:
+        # What a curly block aggregates from this state
+        if len(self.arg_stack):
+            return BatchPool.fromValues(self.arg_stack)
+        return self.pool
+
+@dataclass
+class Progress:
+    # Partial result of a curly block, yielded by Executor.stream
+    script_i: int       # Position of the block's instruction in the script
+    done    : int       # Reps finished so far
+    reps    : int       # Reps the block will run
+    pool    : DicePool  # Aggregate of the finished reps
+    elapsed : float     # Seconds since the block started
+    stopped : bool = False
+    @property
+    def final(self)->bool:
+        return self.done >= self.reps
+    def summary(self)->dict:
+        # Stats.summary of the pool so far, or {} if it's empty
+        counts = Stats.poolCounts(self.pool)
+        return Stats.summary(counts) if counts else {}
+    def stop(self):
+        # End the block early with the reps done so far, and carry on with the rest of the script
+        self.stopped = True
 
 class RunnableUnit:
     def setDebugParams(self, script_i:int):
         self.script_i = script_i # Index of this instruction in the script
     def run(self, estate:ExecState):
         raise NotImplemented("Should be overridden by subclass")
+    def stream(self, estate:ExecState, every_reps:int=None, every_s:float=None)->Iterable[Progress]:
+        # Like run, but yields Progress while the instruction's reps are running. Only blocks have reps.
+        self.run(estate)
+        return ()
+    def runBatch(self, bstate:BatchExecState):
+        raise BatchUnsupported("%s has no batched implementation"%type(self).__name__)
 
 class Executor:
-    def __init__(self, instructions:Iterable[RunnableUnit], debug_script:str):
+    def __init__(self, instructions:Iterable[RunnableUnit], debug_script:str,
+                 verbose_instructions:Iterable[RunnableUnit]=None):
         self.instructions = instructions
         self.debug_script = debug_script
+        # What runs that start verbose use instead, if instructions had their verbosity checks stripped
+        self.verbose_instructions = verbose_instructions
+    def instructionsFor(self, ctx:RunContext)->Iterable[RunnableUnit]:
+        if ctx.verbosity > 0 and self.verbose_instructions is not None:
+            return self.verbose_instructions
+        return self.instructions
     def getGlobalScriptLineForPosition(self, pos):
         total_len = 0
         for lineno, line in enumerate(self.debug_script.splitlines()):
@@ -36,16 +146,65 @@ class Executor:
             if total_len >= pos:
                 return lineno+1, line # Line numbers count from 1, not 0
         return 0, ''
-    def run(self, pool_override:DicePool=None, nest_level=0)->ExecState:
-        s = ExecState(DicePool() if pool_override is None else pool_override.copy(), [],
-                      nest_level, self.debug_script)
-        for inst in self.instructions:
+    def reportError(self, inst:RunnableUnit, ctx:RunContext):
+        lineno, line = self.getGlobalScriptLineForPosition(inst.script_i)
+        ctx.print("Runtime error on line %d:"%lineno)
+        ctx.print(line)
+    def run(self, pool_override:DicePool=None, nest_level=0, arg_stack:List[int]=None,
+            ctx:RunContext=None)->ExecState:
+        # arg_stack starts the run with values already on the stack, e.g. when carrying on from a snapshot. Blocks
+        # pass their ctx on to the runs inside them; a run without one starts a fresh context.
+        s = ExecState(POOL_CLASS() if pool_override is None else pool_override.copy(),
+                      [] if arg_stack is None else list(arg_stack), nest_level, self.debug_script,
+                      RunContext() if ctx is None else ctx)
+        if s.ctx.trace is not None:
+            return self.runTraced(s)
+        for inst in self.instructionsFor(s.ctx):
             try:
                 inst.run(s) # The instructions will mutate s
             except Exception as e:
-                lineno, line = self.getGlobalScriptLineForPosition(inst.script_i)
-                print("Runtime error on line %d:"%lineno)
-                print(line)
+                self.reportError(inst, s.ctx)
+                raise(e)
+        return s
+    def runTraced(self, s:ExecState)->ExecState:
+        # run, adding a record of the pool and stack after every instruction that would have printed
+        for inst in self.instructionsFor(s.ctx):
+            s.script_i = inst.script_i
+            try:
+                inst.run(s)
+            except Exception as e:
+                self.reportError(inst, s.ctx)
+                raise(e)
+            if s.shouldPrint():
+                s.ctx.trace.add(s.ctx.record('inst', s, type(inst).__name__, True))
+        return s
+    def stream(self, pool_override:DicePool=None, nest_level=0, every_reps:int=None,
+               every_s:float=STREAM_INTERVAL_S, ctx:RunContext=None)->Iterable[Progress]:
+        # Generator version of run. Top level blocks yield a Progress every every_reps reps, or about every every_s
+        # seconds when every_reps is None. Closing the generator abandons the run; Progress.stop() only ends the
+        # block it came from. The generator returns the final ExecState.
+        s = ExecState(POOL_CLASS() if pool_override is None else pool_override.copy(), [],
+                      nest_level, self.debug_script, RunContext() if ctx is None else ctx)
+        for inst in self.instructionsFor(s.ctx):
+            try:
+                for progress in inst.stream(s, every_reps, every_s):
+                    progress.script_i = inst.script_i
+                    yield progress
+            except Exception as e:
+                self.reportError(inst, s.ctx)
+                raise(e)
+        return s
+    def runBatch(self, pool_override:BatchPool, nest_level=0, arg_stack:List[np.ndarray]=None,
+                 ctx:RunContext=None)->BatchExecState:
+        s = BatchExecState(pool_override.copy(), [] if arg_stack is None else list(arg_stack), nest_level,
+                           self.debug_script, RunContext() if ctx is None else ctx)
+        for inst in self.instructions:
+            try:
+                inst.runBatch(s)
+            except BatchUnsupported:
+                raise
+            except Exception as e:
+                self.reportError(inst, s.ctx)
                 raise(e)
         return s
 
@@ -56,6 +215,23 @@ class IntLiteral(IntValue):
         self.val = val
     def run(self, estate:ExecState):
         estate.arg_stack.append(self.val)
+    def runBatch(self, bstate:BatchExecState):
+        bstate.arg_stack.append(np.full(bstate.pool.rows, self.val, dtype=np.int64))
+
+class IntParam(IntValue):
+    # "$name" in a script. Parameters are swapped for literals before running (see Sweep.bindParams), so this only
+    # runs when a parameter was left unbound.
+    def __init__(self, name:str, default:int=None):
+        self.name = name
+        self.default = default
+    def value(self)->int:
+        if self.default is None:
+            raise RuntimeError("Parameter $%s has no value, give it one with --param %s=VALUE"%(self.name, self.name))
+        return self.default
+    def run(self, estate:ExecState):
+        estate.arg_stack.append(self.value())
+    def runBatch(self, bstate:BatchExecState):
+        bstate.arg_stack.append(np.full(bstate.pool.rows, self.value(), dtype=np.int64))
 
 class RunS(IntValue):
     def run(self, estate:ExecState):
@@ -63,6 +239,8 @@ class RunS(IntValue):
         if estate.shouldPrint():
             estate.nestPrint("Sum is %d"%s)
         estate.arg_stack.append(s)
+    def runBatch(self, bstate:BatchExecState):
+        bstate.arg_stack.append(bstate.pool.sum())
 
 
 class RunC(IntValue):
@@ -71,26 +249,34 @@ class RunC(IntValue):
         estate.arg_stack.append(c)
         if estate.shouldPrint():
             estate.nestPrint("Count is %d"%c)
+    def runBatch(self, bstate:BatchExecState):
+        bstate.arg_stack.append(bstate.pool.count())
 
 class RunD(RunnableUnit):
     def run(self, estate:ExecState):
         n_sides = estate.arg_stack.pop()
         n_dice  = estate.arg_stack.pop()
-        estate.pool = DicePool(random.randint(1, n_sides + 1, n_dice))
+        estate.pool = rollPool(estate.ctx.rng, n_dice, n_sides)
         if estate.shouldPrint():
             estate.nestPrint("Rolled %dD%d, got:" % (n_dice, n_sides))
             estate.nestPrint(estate.pool)
+    def runBatch(self, bstate:BatchExecState):
+        n_sides = bstate.arg_stack.pop()
+        n_dice  = bstate.arg_stack.pop()
+        bstate.pool = BatchPool.fromRolls(n_dice, n_sides, bstate.ctx.rng)
 
 class RunGeq(RunnableUnit):
     def run(self, estate:ExecState):
         thresh = estate.arg_stack.pop()
         start_len = len(estate.pool)
-        estate.pool = estate.pool.getGeqSubset(thresh)
+        estate.pool.keepGeq(thresh)
         if estate.shouldPrint():
             estate.nestPrint("Pass on %d+" % thresh)
             end_len = len(estate.pool)
             removed = start_len - end_len
             estate.nestPrint("Removed %d dice, leaving %d" % (removed, end_len))
+    def runBatch(self, bstate:BatchExecState):
+        bstate.pool = bstate.pool.getGeqSubset(bstate.arg_stack.pop())
 
 class RunPlusX(RunnableUnit):
     def run(self, estate:ExecState):
@@ -98,17 +284,21 @@ class RunPlusX(RunnableUnit):
         estate.pool.addDie(die)
         if estate.shouldPrint():
             estate.nestPrint("Added +%d to pool" % die)
+    def runBatch(self, bstate:BatchExecState):
+        bstate.pool.addValues(bstate.arg_stack.pop())
 
 class RunLeq(RunnableUnit):
     def run(self, estate:ExecState):
         thresh = estate.arg_stack.pop()
         start_len = len(estate.pool)
-        estate.pool = estate.pool.getLeqSubset(thresh)
+        estate.pool.keepLeq(thresh)
         if estate.shouldPrint():
             estate.nestPrint("Pass on %d-" % thresh)
             end_len = len(estate.pool)
             removed = start_len - end_len
             estate.nestPrint("Removed %d dice, leaving %d" % (removed, end_len))
+    def runBatch(self, bstate:BatchExecState):
+        bstate.pool = bstate.pool.getLeqSubset(bstate.arg_stack.pop())
 
 class RunMult(RunnableUnit):
     def run(self, estate:ExecState):
@@ -116,6 +306,8 @@ class RunMult(RunnableUnit):
         estate.pool.mulInt(factor)
         if estate.shouldPrint():
             estate.nestPrint("Multiplied pool by %d"%factor)
+    def runBatch(self, bstate:BatchExecState):
+        bstate.pool.mulInt(bstate.arg_stack.pop())
 
 class RunMinusX(RunnableUnit):
     def run(self, estate:ExecState):
@@ -123,44 +315,49 @@ class RunMinusX(RunnableUnit):
         estate.pool.addDie(die)
         if estate.shouldPrint():
             estate.nestPrint("Added %d to pool" % die)
+    def runBatch(self, bstate:BatchExecState):
+        bstate.pool.addValues(-1*bstate.arg_stack.pop())
 
 class RunH(RunnableUnit):
     def run(self, estate:ExecState):
         count = estate.arg_stack.pop()
-        estate.pool = estate.pool.getTop(count)
+        estate.pool.keepTop(count)
         if estate.shouldPrint():
             estate.nestPrint("Grabbing top %d dice"%count)
+    def runBatch(self, bstate:BatchExecState):
+        bstate.pool = bstate.pool.getTop(bstate.arg_stack.pop())
 
 class RunL(RunnableUnit):
     def run(self, estate:ExecState):
         count = estate.arg_stack.pop()
-        estate.pool = estate.pool.getBottom(count)
+        estate.pool.keepBottom(count)
         if estate.shouldPrint():
             estate.nestPrint("Grabbing bottom %d dice"%count)
+    def runBatch(self, bstate:BatchExecState):
+        bstate.pool = bstate.pool.getBottom(bstate.arg_stack.pop())
 
 class RunV(RunnableUnit):
     def run(self, estate:ExecState):
-        global VERBOSITY_GLOBAL
-        VERBOSITY_GLOBAL = estate.arg_stack.pop()
-        estate.nestPrint("Verbosity set to %d"%VERBOSITY_GLOBAL)
+        estate.ctx.verbosity = estate.arg_stack.pop()
+        estate.nestPrint("Verbosity set to %d"%estate.ctx.verbosity)
 
 class RunG(RunnableUnit):
     def run(self, estate:ExecState):
         if estate.shouldPrint():
             estate.nestPrint("Graphing...")
-        makeBarGraph(estate.pool)
+        estate.ctx.graph(estate.pool)
 
 class RunP(RunnableUnit):
     def run(self, estate:ExecState):
-        if estate.shouldPrint():
-            print("Pool: ", estate.pool)
-            print("Stack: ", estate.arg_stack)
+        # A trace already records the pool and stack after every instruction
+        if estate.shouldPrint() and estate.ctx.trace is None:
+            estate.ctx.print("Pool: ", estate.pool)
+            estate.ctx.print("Stack: ", estate.arg_stack)
 
 class RunCurlyBlock(RunnableUnit):
     def __init__(self, ilist:Iterable[RunnableUnit]):
         self.ilist = ilist
     def run(self, estate:ExecState, pool_override:DicePool=None):
-        e = Executor(self.ilist, estate.debug_script)
         reps = estate.arg_stack.pop()
         if pool_override is not None:
             pool_arg = pool_override.copy()
@@ -171,18 +368,105 @@ class RunCurlyBlock(RunnableUnit):
             if estate.shouldPrint():
                 estate.nestPrint("Rep target is 0, not running sub block")
             return
-        agg_pool = DicePool()
-        for i in range(reps):
+        if estate.nest_level == 0 and TOP_LEVEL_RUNNER is not None and not estate.shouldPrint():
+            agg_pool = TOP_LEVEL_RUNNER.runReps(self, estate, pool_arg, reps)
+        else:
+            agg_pool = self.runReps(estate, pool_arg, reps)
+        estate.pool.addPool(agg_pool)
+        if estate.shouldPrint():
+            estate.nestPrint("Sub-block finished %d reps, added %d values" %(reps,len(agg_pool)))
+    def stream(self, estate:ExecState, every_reps:int=None, every_s:float=None,
+               pool_override:DicePool=None)->Iterable[Progress]:
+        # run, with the reps cut into chunks and a Progress yielded after each. Chunks are every_reps long, or are
+        # sized from the last chunk's time to take about every_s. Verbose blocks run in one chunk.
+        reps = estate.arg_stack.pop()
+        if pool_override is not None:
+            pool_arg = pool_override.copy()
+        else:
+            pool_arg = estate.pool.copy()
+            estate.pool.clear()
+        if reps == 0:
             if estate.shouldPrint():
-                estate.nestPrint("Sub-block run %d of %d" % (i,reps))
-            sub_s = e.run(pool_arg, estate.nest_level+1)
-            if len(sub_s.arg_stack):
-                agg_pool.addDice(sub_s.arg_stack)
+                estate.nestPrint("Rep target is 0, not running sub block")
+            return
+        top_level = estate.nest_level == 0 and TOP_LEVEL_RUNNER is not None and not estate.shouldPrint()
+        agg_pool = POOL_CLASS()
+        done = 0
+        chunk = reps if estate.shouldPrint() else every_reps or STREAM_FIRST_REPS
+        start = time.perf_counter()
+        while done < reps:
+            n = min(chunk, reps - done)
+            chunk_start = time.perf_counter()
+            if top_level:
+                agg_pool.addPool(TOP_LEVEL_RUNNER.runReps(self, estate, pool_arg, n))
             else:
-                agg_pool.addPool(sub_s.pool)
+                agg_pool.addPool(self.runReps(estate, pool_arg, n))
+            done += n
+            now = time.perf_counter()
+            progress = Progress(getattr(self, 'script_i', -1), done, reps, agg_pool.copy(), now - start)
+            yield progress
+            if progress.stopped:
+                break
+            if every_reps is None and every_s is not None:
+                # Grow by at most ten times per chunk, so one slow rep can't make a chunk run for ages
+                chunk = max(1, min(int(n * every_s / max(now - chunk_start, 1e-6)), 10*n))
         estate.pool.addPool(agg_pool)
         if estate.shouldPrint():
-            estate.nestPrint("Sub-block finished %d reps, added %d values" %(reps,len(agg_pool)))
+            estate.nestPrint("Sub-block finished %d reps, added %d values" %(done,len(agg_pool)))
+    def runReps(self, estate:ExecState, pool_arg:DicePool, reps:int)->DicePool:
+        if OUTCOME_CACHE is not None and not estate.shouldPrint():
+            agg_pool = OUTCOME_CACHE.runReps(self, estate, pool_arg, reps)
+            if agg_pool is not None:
+                return agg_pool
+        e = Executor(self.ilist, estate.debug_script)
+        agg_pool = None
+        if BATCH_ENABLED and not estate.shouldPrint():
+            agg_pool = self.runBatched(e, pool_arg, reps, estate.nest_level, estate.ctx)
+        if agg_pool is None:
+            agg_pool = POOL_CLASS()
+            tracing = estate.ctx.trace is not None
+            for i in range(reps):
+                if tracing:
+                    estate.ctx.enterRep(i)
+                if estate.shouldPrint():
+                    estate.nestPrint("Sub-block run %d of %d" % (i,reps))
+                sub_s = e.run(pool_arg, estate.nest_level+1, ctx=estate.ctx)
+                if tracing:
+                    estate.ctx.leaveRep()
+                if len(sub_s.arg_stack):
+                    agg_pool.addDice(sub_s.arg_stack)
+                else:
+                    agg_pool.addPool(sub_s.pool)
+        return agg_pool
+    def runBatched(self, e:Executor, pool_arg:DicePool, reps:int, nest_level:int,
+                   ctx:RunContext)->Union[DicePool, None]:
+        # Run all reps together, BATCH_REPS at a time. Returns None if the block can't be batched.
+        agg_pool = POOL_CLASS()
+        try:
+            for start in range(0, reps, BATCH_REPS):
+                rows = min(BATCH_REPS, reps - start)
+                sub_s = e.runBatch(BatchPool.fromPool(pool_arg, rows), nest_level+1, ctx=ctx)
+                agg_pool.addPool(sub_s.outputPool().totals(POOL_CLASS))
+        except BatchUnsupported:
+            return None
+        return agg_pool
+    def runBatch(self, bstate:BatchExecState, pool_override:BatchPool=None):
+        e = Executor(self.ilist, bstate.debug_script)
+        reps = bstate.arg_stack.pop()
+        if pool_override is not None:
+            pool_arg = pool_override
+        else:
+            pool_arg = bstate.pool.copy()
+            bstate.pool.clear()
+        if not reps.any():
+            return
+        saved = bstate.ctx.rng.repeatRows(reps)
+        try:
+            sub_s = e.runBatch(pool_arg.repeatRows(reps), bstate.nest_level+1, ctx=bstate.ctx)
+        finally:
+            # Also when the nested run gives up with BatchUnsupported, so the rng isn't left expanded
+            bstate.ctx.rng.restoreRows(saved)
+        bstate.pool.addPool(sub_s.outputPool().reduceRows(reps))
 
 class RunSquareBlock(RunnableUnit):
     def __init__(self, filt_ilist:Iterable[RunnableUnit], curly_block:Union[RunCurlyBlock, None]):
@@ -190,7 +474,7 @@ class RunSquareBlock(RunnableUnit):
         self.curly_block = curly_block
     def run(self, estate:ExecState):
         e = Executor(self.filt_ilist, estate.debug_script)
-        substate = e.run(estate.pool, estate.nest_level+1)
+        substate = e.run(estate.pool, estate.nest_level+1, ctx=estate.ctx)
         if estate.shouldPrint():
             estate.nestPrint("Removing %d values from outer pool"%len(substate.pool))
         estate.pool.subPool(substate.pool)
@@ -198,3 +482,21 @@ class RunSquareBlock(RunnableUnit):
             if estate.shouldPrint():
                 estate.nestPrint("Passing %d values to inner code block"%len(substate.pool))
             self.curly_block.run(estate, substate.pool)
+    def stream(self, estate:ExecState, every_reps:int=None, every_s:float=None)->Iterable[Progress]:
+        if self.curly_block is None:
+            self.run(estate)
+            return
+        e = Executor(self.filt_ilist, estate.debug_script)
+        substate = e.run(estate.pool, estate.nest_level+1, ctx=estate.ctx)
+        if estate.shouldPrint():
+            estate.nestPrint("Removing %d values from outer pool"%len(substate.pool))
+        estate.pool.subPool(substate.pool)
+        if estate.shouldPrint():
+            estate.nestPrint("Passing %d values to inner code block"%len(substate.pool))
+        yield from self.curly_block.stream(estate, every_reps, every_s, substate.pool)
+    def runBatch(self, bstate:BatchExecState):
+        e = Executor(self.filt_ilist, bstate.debug_script)
+        substate = e.runBatch(bstate.pool, bstate.nest_level+1, ctx=bstate.ctx)
+        bstate.pool.subPool(substate.pool)
+        if self.curly_block is not None:
+            self.curly_block.runBatch(bstate, substate.pool)
@@ -0,0 +1,273 @@
+import math
+import numpy as np
+import DiceRNG
+import Runtime
+import Stats
+from typing import *
+from BatchPool import BatchPool, BatchUnsupported
+from DicePool import DicePool
+from Runtime import ExecState, Executor, RunCurlyBlock
+
+# Variance reduced dice for the reps of top level curly blocks.
+#
+# Plain runs give every rep independent dice. Here each rep reads its dice from a row of uniform numbers instead, one
+# column per die in the order the rep rolls them (nested blocks included), and the rows of a group of reps are laid
+# out to cover [0, 1) evenly in every column:
+#   stratified  each column of a group of G reps has one number in each of [0, 1/G), [1/G, 2/G), ..., in a random
+#               order (Latin hypercube sampling)
+#   antithetic  reps come in pairs, the second reading 1-u where the first reads u, so face k becomes sides+1-k
+#   qmc         the group's rows are the first G points of the Kronecker sequence frac(i*sqrt(p)), with p the
+#               column's prime, rotated by a random shift per group and column
+# A die with s sides shows face floor(u*s)+1. Each rep's dice are still independent and uniform, so averages over reps
+# are unbiased, but the reps of a group balance each other out and the averages vary less than with plain dice.
+#
+# Groups are independent, so the spread of their averages measures the error the run actually got. The report sets it
+# against the error plain dice would give for as many reps, worked out from the spread of single reps, for the mean,
+# the chance of each value or less, and each value's percentage. The ratio of the two variances is how many times
+# more reps plain dice would need for the same error.
+
+MODES = ('stratified', 'antithetic', 'qmc')
+GROUP_SIZE = {'stratified': 32, 'antithetic': 2, 'qmc': 64}
+MAX_VALUES = 1 << 12 # Widest spread of values the errors per value are worked out for
+
+def primes(n:int)->np.ndarray:
+    # The first n primes
+    limit = max(16, int(n * (math.log(n + 1) + math.log(math.log(n + 3))) + 10))
+    sieve = np.ones(limit, dtype=bool)
+    sieve[:2] = False
+    for i in range(2, int(limit**0.5) + 1):
+        if sieve[i]:
+            sieve[i*i::i] = False
+    return np.flatnonzero(sieve)[:n]
+
+class DesignRNG(DiceRNG.DiceRNG):
+    # Dice for rows reps, read from rows of the design. Randomness comes from gen, the run's own generator, so a
+    # seeded run is still reproducible.
+    def __init__(self, gen:np.random.Generator, mode:str, rows:int, group:int):
+        self.gen = gen
+        self.mode = mode
+        self.rows = rows
+        self.group = group
+        self.groups = -(-rows // group)
+        self.u = np.zeros((rows, 0))
+        self.cursor = np.zeros(rows, dtype=np.int64) # First unused column of each row
+        self.row = 0       # Row the dice are for, when reps run one at a time
+        self.owners = None # Row of each batch row, when reps run batched
+    def useCounts(self, n_dice, n_sides:int)->bool:
+        # Every die needs a column of its own
+        return False
+    def columns(self, needed:int):
+        have = self.u.shape[1]
+        if needed <= have:
+            return
+        k = max(needed - have, have) # At least double, so extending stays cheap
+        shape = (self.groups, self.group, k)
+        if self.mode == 'stratified':
+            new = (np.argsort(self.gen.random(shape), axis=1) + self.gen.random(shape)) / self.group
+        elif self.mode == 'antithetic':
+            first = self.gen.random((self.groups, 1, k))
+            new = np.concatenate((first, 1 - first), axis=1)
+        else:
+            alpha = np.sqrt(primes(have + k)[have:]) % 1
+            new = (self.gen.random((self.groups, 1, k)) + np.arange(self.group)[:, None] * alpha) % 1
+        self.u = np.concatenate((self.u, new.reshape(-1, k)[:self.rows]), axis=1)
+    @staticmethod
+    def faces(u:np.ndarray, n_sides)->np.ndarray:
+        # u can be 1.0 for antithetic dice
+        return np.minimum((u * n_sides).astype(np.int64), n_sides - 1) + 1
+    def roll(self, n_dice:int, n_sides:int)->np.ndarray:
+        if n_sides < 1 or n_dice < 0:
+            return self.gen.integers(1, n_sides + 1, n_dice) # Fails the same way as plain dice
+        start = self.cursor[self.row]
+        self.cursor[self.row] = start + n_dice
+        self.columns(start + n_dice)
+        return self.faces(self.u[self.row, start:start + n_dice], n_sides)
+    def rollRows(self, n_dice:np.ndarray, n_sides:np.ndarray)->np.ndarray:
+        if (n_sides < 1).any():
+            return self.gen.integers(1, np.repeat(n_sides, n_dice) + 1)
+        owners = np.full(len(n_dice), self.row) if self.owners is None else self.owners
+        # Owners never decrease from one batch row to the next, so each row's dice come out together, in order
+        die_owner = np.repeat(owners, n_dice)
+        per_owner = np.bincount(die_owner, minlength=self.rows)
+        first = np.cumsum(per_owner) - per_owner
+        col = np.arange(len(die_owner)) - first[die_owner] + self.cursor[die_owner]
+        self.cursor += per_owner
+        self.columns(int(self.cursor.max()))
+        return self.faces(self.u[die_owner, col], np.repeat(n_sides, n_dice))
+    def repeatRows(self, reps:np.ndarray):
+        saved = self.owners
+        if saved is not None:
+            self.owners = np.repeat(saved, reps)
+        return saved
+    def restoreRows(self, saved):
+        self.owners = saved
+
+class Moments:
+    # Sums over units (single reps, or groups of reps) of each unit's value count N, its sum S, its count C of each
+    # value and count T of values up to each value, and of their squares and products with N. That is all the
+    # standard errors of ratio estimates like sum(S)/sum(N) need.
+    def __init__(self):
+        self.units = 0
+        self.n = np.zeros(2)          # sum(N), sum(N*N)
+        self.s = np.zeros(3)          # sum(S), sum(S*S), sum(S*N)
+        self.offset = 0
+        self.bins = np.zeros((3, 0))  # sum(C), sum(C*C), sum(C*N) for each value from offset up
+        self.tails = np.zeros((3, 0)) # The same for T. Both are None once the values spread over more than MAX_VALUES.
+    def widen(self, low:int, high:int):
+        width = self.bins.shape[1]
+        if width == 0:
+            self.offset = low
+            self.bins = np.zeros((3, high - low + 1))
+            self.tails = np.zeros((3, high - low + 1))
+            return
+        cur_high = self.offset + width - 1
+        left, right = max(self.offset - low, 0), max(high - cur_high, 0)
+        self.bins = np.pad(self.bins, ((0, 0), (left, right)))
+        # No unit so far had a value above cur_high, so T is N from there up
+        self.tails = np.concatenate((np.zeros((3, left)), self.tails, np.repeat(self.tails[:, -1:], right, axis=1)),
+                                    axis=1)
+        self.offset -= left
+    def add(self, n:np.ndarray, s:np.ndarray, counts:np.ndarray=None, offset:int=0):
+        # n and s per unit. counts is units x values, with the count of value offset+i in column i, or None if there
+        # are too many values.
+        n, s = n.astype(float), s.astype(float)
+        self.units += len(n)
+        self.n += (n.sum(), n @ n)
+        self.s += (s.sum(), s @ s, s @ n)
+        if self.bins is None:
+            return
+        if counts is not None and counts.shape[1]:
+            low, high = offset, offset + counts.shape[1] - 1
+            if self.bins.shape[1]:
+                low, high = min(low, self.offset), max(high, self.offset + self.bins.shape[1] - 1)
+            if high - low >= MAX_VALUES:
+                counts = None
+            else:
+                self.widen(offset, offset + counts.shape[1] - 1)
+        if counts is None:
+            self.bins = self.tails = None
+            return
+        full = np.zeros((len(counts), self.bins.shape[1]))
+        start = offset - self.offset
+        full[:, start:start + counts.shape[1]] = counts
+        t = np.cumsum(full, axis=1)
+        self.bins += (full.sum(axis=0), np.einsum('ij,ij->j', full, full), n @ full)
+        self.tails += (t.sum(axis=0), np.einsum('ij,ij->j', t, t), n @ t)
+    def estimate(self, x:np.ndarray)->Tuple[np.ndarray, np.ndarray]:
+        # sum(X)/sum(N) and its standard error, from x = [sum(X), sum(X*X), sum(X*N)]
+        est = x[0] / self.n[0]
+        if self.units < 2:
+            return est, np.full(np.shape(est), np.nan)
+        resid = x[1] - 2*est*x[2] + est*est*self.n[1] # sum((X - est*N)**2)
+        mean_n = self.n[0] / self.units
+        return est, np.sqrt(np.maximum(resid, 0) / (self.units * (self.units - 1))) / mean_n
+
+def countMatrix(counts:List[Dict[int, int]])->Tuple[np.ndarray, int]:
+    # Units x values matrix of value->count tables and the value of its first column, or None if that's too wide
+    keys = [k for c in counts for k in c]
+    if not keys:
+        return np.zeros((len(counts), 0)), 0
+    low, high = min(keys), max(keys)
+    if high - low >= MAX_VALUES:
+        return None, 0
+    matrix = np.zeros((len(counts), high - low + 1))
+    for i, c in enumerate(counts):
+        for k, v in c.items():
+            matrix[i, k - low] = v
+    return matrix, low
+
+class SamplingRunner:
+    def __init__(self, mode:str, group:int=None):
+        if mode not in MODES:
+            raise ValueError("Unknown sampling mode %r, should be one of %s"%(mode, ', '.join(MODES)))
+        if mode == 'antithetic' or group is None:
+            group = GROUP_SIZE[mode]
+        if group < 2:
+            raise ValueError("Sampling groups need at least 2 reps")
+        self.mode = mode
+        self.group = group
+        self.reports = []
+    def runReps(self, block:RunCurlyBlock, estate:ExecState, pool_arg:DicePool, reps:int)->DicePool:
+        e = Executor(block.ilist, estate.debug_script)
+        plain, grouped = Moments(), Moments()
+        agg_pool = Runtime.POOL_CLASS()
+        rng = estate.ctx.rng
+        done = 0
+        try:
+            if Runtime.BATCH_ENABLED and not estate.shouldPrint():
+                # Batches hold whole groups, so no group is split between batches
+                chunk = max(Runtime.BATCH_REPS // self.group, 1) * self.group
+                try:
+                    while done < reps:
+                        rows = min(chunk, reps - done)
+                        estate.ctx.rng = design = DesignRNG(rng.gen, self.mode, rows, self.group)
+                        design.owners = np.arange(rows)
+                        sub_s = e.runBatch(BatchPool.fromPool(pool_arg, rows), estate.nest_level+1, ctx=estate.ctx)
+                        out = sub_s.outputPool()
+                        self.addReps(plain, grouped, out.counts.sum(axis=1), out.counts @ out.values(), out.counts,
+                                     out.offset)
+                        agg_pool.addPool(out.totals(Runtime.POOL_CLASS))
+                        done += rows
+                except BatchUnsupported:
+                    pass # The batches run so far stand, the rest are run one at a time
+            while done < reps:
+                rows = min(self.group, reps - done)
+                estate.ctx.rng = design = DesignRNG(rng.gen, self.mode, rows, self.group)
+                outs = []
+                for design.row in range(rows):
+                    sub_s = e.run(pool_arg, estate.nest_level+1, ctx=estate.ctx)
+                    out = Runtime.POOL_CLASS(sub_s.arg_stack) if len(sub_s.arg_stack) else sub_s.pool
+                    outs.append(Stats.poolCounts(out))
+                    agg_pool.addPool(out)
+                self.addReps(plain, grouped, np.array([Stats.total(c) for c in outs], dtype=float),
+                             np.array([sum(k*v for k, v in c.items()) for c in outs], dtype=float), *countMatrix(outs))
+                done += rows
+        finally:
+            estate.ctx.rng = rng
+        lineno, line = Executor([], estate.debug_script).getGlobalScriptLineForPosition(block.script_i)
+        self.reports.append(self.report(lineno, reps, plain, grouped))
+        estate.ctx.print(self.reports[-1])
+        return agg_pool
+    def addReps(self, plain:Moments, grouped:Moments, n:np.ndarray, s:np.ndarray, counts:np.ndarray, offset:int):
+        # Every rep goes into plain, whole groups into grouped
+        plain.add(n, s, counts, offset)
+        groups = len(n) // self.group
+        if groups:
+            grouped.add(self.groupSums(n, groups), self.groupSums(s, groups),
+                        None if counts is None else self.groupSums(counts, groups), offset)
+    def groupSums(self, x:np.ndarray, groups:int)->np.ndarray:
+        # Totals of the first groups whole groups of reps
+        return x[:groups*self.group].reshape(groups, self.group, *x.shape[1:]).sum(axis=1)
+    def report(self, lineno:int, reps:int, plain:Moments, grouped:Moments)->str:
+        head = "Block ending on line %d, %d reps with %s dice"%(lineno, reps, self.mode)
+        if plain.n[0] == 0:
+            return head + ": no values"
+        if grouped.units < 2:
+            return head + ": too few groups of %d reps to estimate the error"%self.group
+        lines = [head + ", %d groups of %d (standard errors):"%(grouped.units, self.group)]
+        mean, plain_err = plain.estimate(plain.s)
+        err = grouped.estimate(grouped.s)[1]
+        lines.append("    mean: %0.4f +- %0.4g, plain dice +- %0.4g%s"%(mean, err, plain_err,
+                                                                   gain(err**2, plain_err**2)))
+        if grouped.bins is None or plain.bins is None:
+            lines.append("    (values spread over more than %d, so no errors per value)"%MAX_VALUES)
+            return '\n'.join(lines)
+        for name, x, plain_x in (("P(value or less)", grouped.tails, plain.tails),
+                                 ("percentage", grouped.bins, plain.bins)):
+            err = 100 * grouped.estimate(x)[1]
+            plain_err = 100 * plain.estimate(plain_x)[1]
+            # The gain is over all values together; the worst single error alone is too noisy to compare
+            lines.append("    %s: worst +- %0.4g points, plain dice +- %0.4g%s"%(
+                         name, np.nanmax(err), np.nanmax(plain_err), gain(np.nansum(err**2), np.nansum(plain_err**2))))
+        return '\n'.join(lines)
+    def __enter__(self):
+        Runtime.TOP_LEVEL_RUNNER = self
+        return self
+    def __exit__(self, *exc):
+        Runtime.TOP_LEVEL_RUNNER = None
+
+def gain(var:float, plain_var:float)->str:
+    # How many times more reps plain dice need for the same error
+    if not var > 0 or not plain_var > 0:
+        return ""
+    return " (plain dice need %0.1fx the reps)"%(plain_var / var)
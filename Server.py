@@ -0,0 +1,111 @@
+import argparse
+import io
+import json
+import os
+import socketserver
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from contextlib import redirect_stdout
+import numpy as np
+import Stats
+from Compiler import Compiler, scriptCacheKey
+from DiceRNG import DiceRNG
+from Evaluate import runScript
+from Optimizer import optimize
+from Runtime import RunContext
+
+# Long running interpreter that keeps the runtime imported and compiled scripts cached, so evaluating a small script
+# costs no more than running it. Requests arrive on a Unix socket, one JSON object per line:
+#   {"script": "2D6 S", "reps": 10000, "seed": 1}
+# reps and seed are optional. With reps, the whole script runs as the body of a "reps{ ... }" block. The reply is a
+# single JSON line holding the printed output, any graphs from G and the final pool.
+#
+# Each connection is handled in its own thread, and each request runs in its own RunContext, so requests from
+# different clients run side by side without sharing dice or output.
+
+DEFAULT_SOCKET = '/tmp/diceroller.sock'
+MAX_CACHED     = 256
+
+class ScriptServer:
+    def __init__(self, max_cached:int=MAX_CACHED):
+        self.executors = OrderedDict() # Script hash -> optimized Executor, least recently used first
+        self.max_cached = max_cached
+        self.lock = threading.Lock() # Guards executors
+    def getExecutor(self, script:str):
+        key = scriptCacheKey(script)
+        if key in self.executors:
+            self.executors.move_to_end(key)
+            return self.executors[key], True
+        e = optimize(Compiler(script).compile())
+        self.executors[key] = e
+        if len(self.executors) > self.max_cached:
+            self.executors.popitem(last=False)
+        return e, False
+    def evaluate(self, request:dict)->dict:
+        start = time.perf_counter()
+        ctx = RunContext(rng=DiceRNG(request.get('seed')), out=io.StringIO(), graphs=[])
+        out = ctx.out
+        try:
+            # Only the compiler prints to stdout, and only while holding the lock
+            with self.lock, redirect_stdout(out):
+                e, cached = self.getExecutor(request['script'])
+            s = runScript(e, ctx, request.get('reps'))
+        except Exception as err:
+            return {'ok': False, 'error': '%s: %s'%(type(err).__name__, err), 'output': out.getvalue(),
+                    'traceback': traceback.format_exc()}
+        counts = Stats.poolCounts(s.pool)
+        return {
+            'ok'         : True,
+            'output'     : out.getvalue(),
+            'graphs'     : ctx.graphs,
+            'stack'      : [int(v) for v in s.arg_stack],
+            'counts'     : {str(k): int(v) for k, v in sorted(counts.items())},
+            'summary'    : Stats.summary(counts) if counts else None,
+            'cached'     : cached,
+            'elapsed'    : time.perf_counter() - start,
+        }
+
+def jsonDefault(obj):
+    # numpy scalars that got into a reply, e.g. from a graph's summary
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError("Object of type %s is not JSON serializable"%type(obj).__name__)
+
+def encodeReply(reply:dict)->bytes:
+    # A reply that can't be serialised still gets an answer, so the client isn't left with a closed socket
+    try:
+        return json.dumps(reply, default=jsonDefault).encode() + b'\n'
+    except (TypeError, ValueError) as err:
+        return json.dumps({'ok': False, 'error': 'Reply could not be encoded: %s'%err,
+                           'output': reply.get('output', '')}, default=str).encode() + b'\n'
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                reply = self.server.script_server.evaluate(json.loads(line))
+            except (ValueError, KeyError) as err:
+                reply = {'ok': False, 'error': 'Bad request: %s'%err}
+            self.wfile.write(encodeReply(reply))
+            self.wfile.flush()
+
+def serve(socket_path:str):
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    with socketserver.ThreadingUnixStreamServer(socket_path, RequestHandler) as server:
+        server.script_server = ScriptServer()
+        print("Serving on %s"%socket_path)
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(socket_path)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve dice scripts over a Unix socket")
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help="Path of the socket to listen on")
+    args = parser.parse_args()
+    serve(args.socket)
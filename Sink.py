@@ -0,0 +1,160 @@
+import argparse
+import numpy as np
+import Runtime
+from typing import *
+from BatchPool import BatchPool, BatchUnsupported
+from DicePool import DicePool
+from Runtime import ExecState, Executor, RunCurlyBlock
+
+# Per-rep results of top level curly blocks, streamed to a .npy file.
+#
+# RepSink plugs in as the top level runner. It runs the reps itself and, besides aggregating them as usual, writes one
+# fixed width record per rep: which block it came from, the rep number, the count, sum, lowest and highest value of
+# the rep's output, and the first stack_width values of its arg stack. Records are gathered in a fixed size buffer
+# and appended to the file a buffer at a time, so memory use doesn't grow with the number of reps.
+#
+# The file is a plain .npy array of records. Its header is rewritten after every flush, so the file can be read at
+# any point, including after a crash, with numpy.load(path, mmap_mode='r') (see load()), which maps it without
+# copying.
+
+BUFFER_RECORDS = 1 << 16
+
+def recordDtype(stack_width:int)->np.dtype:
+    return np.dtype([('block', '<i4'), ('rep', '<i8'), ('count', '<i8'), ('sum', '<i8'), ('min', '<i8'),
+                     ('max', '<i8'), ('stack_len', '<i4'), ('stack', '<i8', (stack_width,))])
+
+def npyHeader(dtype:np.dtype, rows:int, length:int=None)->bytes:
+    # Version 1.0 .npy header for a 1-D array of rows records, padded with spaces to length bytes
+    text = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (rows,)})
+    if length is None:
+        length = -(-(10 + len(text) + 1) // 64) * 64
+    text = text.ljust(length - 10 - 1) + '\n'
+    return b'\x93NUMPY\x01\x00' + np.uint16(len(text)).tobytes() + text.encode('latin1')
+
+class RepSink:
+    def __init__(self, path:str, stack_width:int=4, buffer_records:int=BUFFER_RECORDS):
+        self.path = path
+        self.dtype = recordDtype(stack_width)
+        self.stack_width = stack_width
+        self.buffer = np.zeros(buffer_records, dtype=self.dtype)
+        self.buffered = 0
+        self.written = 0
+        self.next_rep = {} # Block position -> number of its first rep not yet recorded
+        # Room for the largest row count, so the header never changes size
+        self.header_len = len(npyHeader(self.dtype, np.iinfo(np.int64).max))
+        self.f = open(path, 'wb')
+        self.f.write(npyHeader(self.dtype, 0, self.header_len))
+    def runReps(self, block:RunCurlyBlock, estate:ExecState, pool_arg:DicePool, reps:int)->DicePool:
+        e = Executor(block.ilist, estate.debug_script)
+        agg_pool = Runtime.POOL_CLASS()
+        done = 0
+        if Runtime.BATCH_ENABLED:
+            try:
+                while done < reps:
+                    rows = min(Runtime.BATCH_REPS, reps - done)
+                    sub_s = e.runBatch(BatchPool.fromPool(pool_arg, rows), estate.nest_level+1, ctx=estate.ctx)
+                    out = sub_s.outputPool()
+                    self.addBatch(block.script_i, out, sub_s.arg_stack)
+                    agg_pool.addPool(out.totals(Runtime.POOL_CLASS))
+                    done += rows
+            except BatchUnsupported:
+                pass # The reps recorded so far stand, the rest are run one at a time
+        for i in range(done, reps):
+            sub_s = e.run(pool_arg, estate.nest_level+1, ctx=estate.ctx)
+            if len(sub_s.arg_stack):
+                out = Runtime.POOL_CLASS(sub_s.arg_stack)
+            else:
+                out = sub_s.pool
+            self.addRep(block.script_i, out, sub_s.arg_stack)
+            agg_pool.addPool(out)
+        return agg_pool
+    def reserve(self, block:int, n:int)->int:
+        rep = self.next_rep.get(block, 0)
+        self.next_rep[block] = rep + n
+        return rep
+    def addRep(self, block:int, out:DicePool, arg_stack:List[int]):
+        if self.buffered == len(self.buffer):
+            self.flush()
+        rec = self.buffer[self.buffered]
+        counts = {k: v for k, v in out.vals.items() if v}
+        rec['block'] = block
+        rec['rep'] = self.reserve(block, 1)
+        rec['count'] = len(out)
+        rec['sum'] = out.sum()
+        rec['min'] = min(counts) if counts else 0
+        rec['max'] = max(counts) if counts else 0
+        rec['stack_len'] = len(arg_stack)
+        stack = arg_stack[:self.stack_width]
+        rec['stack'] = list(stack) + [0]*(self.stack_width - len(stack))
+        self.buffered += 1
+    def addBatch(self, block:int, out:BatchPool, arg_stack:List[np.ndarray]):
+        rows = out.rows
+        first_rep = self.reserve(block, rows)
+        count = out.counts.sum(axis=1)
+        if out.width:
+            present = out.counts > 0
+            total = out.counts @ out.values()
+            low = np.where(count > 0, out.offset + present.argmax(axis=1), 0)
+            high = np.where(count > 0, out.offset + out.width - 1 - present[:, ::-1].argmax(axis=1), 0)
+        else:
+            total = low = high = np.zeros(rows, dtype=np.int64)
+        stack = np.zeros((rows, self.stack_width), dtype=np.int64)
+        for j, col in enumerate(arg_stack[:self.stack_width]):
+            stack[:, j] = col
+        done = 0
+        while done < rows:
+            if self.buffered == len(self.buffer):
+                self.flush()
+            n = min(rows - done, len(self.buffer) - self.buffered)
+            part = slice(done, done + n)
+            recs = self.buffer[self.buffered:self.buffered + n]
+            recs['block'] = block
+            recs['rep'] = np.arange(first_rep + done, first_rep + done + n)
+            recs['count'] = count[part]
+            recs['sum'] = total[part]
+            recs['min'] = low[part]
+            recs['max'] = high[part]
+            recs['stack_len'] = len(arg_stack)
+            recs['stack'] = stack[part]
+            self.buffered += n
+            done += n
+    def flush(self):
+        self.f.write(self.buffer[:self.buffered].tobytes())
+        self.written += self.buffered
+        self.buffered = 0
+        self.f.seek(0)
+        self.f.write(npyHeader(self.dtype, self.written, self.header_len))
+        self.f.seek(0, 2)
+        self.f.flush()
+    def close(self):
+        if self.f is not None:
+            self.flush()
+            self.f.close()
+            self.f = None
+    def __enter__(self):
+        Runtime.TOP_LEVEL_RUNNER = self
+        return self
+    def __exit__(self, *exc):
+        Runtime.TOP_LEVEL_RUNNER = None
+        self.close()
+
+def load(path:str)->np.ndarray:
+    # Memory mapped view of a sink file's records
+    return np.load(path, mmap_mode='r')
+
+def summarize(records:np.ndarray)->str:
+    lines = []
+    for block in np.unique(records['block']):
+        recs = records[records['block'] == block]
+        line = "Block at %d: %d reps, count mean %0.4f, sum mean %0.4f"%(block, len(recs), recs['count'].mean(),
+                                                                        recs['sum'].mean())
+        if recs['count'].std() > 0 and recs['sum'].std() > 0:
+            line += ", count/sum correlation %0.4f"%np.corrcoef(recs['count'], recs['sum'])[0, 1]
+        lines.append(line)
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Summarise a per-rep results file written with main.py --sink")
+    parser.add_argument('path')
+    args = parser.parse_args()
+    print(summarize(load(args.path)))
@@ -0,0 +1,62 @@
+from collections import Counter
+from typing import *
+
+# Statistics on a pool's value->count table. Nothing here expands a pool into individual values, so the cost depends
+# on the number of distinct values rather than the number of dice.
+
+def poolCounts(pool)->Dict[int, float]:
+    # Value->count for a DicePool/ArrayPool, a value->weight mapping, or a plain iterable of values. Values come back
+    # as plain ints, even from pools built from numpy arrays, so results can go straight into JSON.
+    if hasattr(pool, 'vals'):
+        return {int(k): v for k, v in pool.vals.items() if v}
+    if isinstance(pool, Mapping):
+        return {int(k): v for k, v in pool.items() if v}
+    return {int(k): v for k, v in Counter(pool).items()}
+
+def total(counts:Mapping)->float:
+    return sum(counts.values())
+
+def mean(counts:Mapping)->float:
+    return sum(k*v for k, v in counts.items()) / total(counts)
+
+def variance(counts:Mapping)->float:
+    m = mean(counts)
+    return sum(v*(k - m)**2 for k, v in counts.items()) / total(counts)
+
+def percentages(counts:Mapping)->Dict[int, float]:
+    t = total(counts)
+    return {k: 100*counts[k] / t for k in sorted(counts)}
+
+def quantile(counts:Mapping, frac:float, val_increment=1.0)->float:
+    # Value such that frac of the bar graph area is to its left, treating each value as a bar val_increment wide.
+    # This is the same graph area method findQuartiles has always used.
+    area_target = total(counts) * frac
+    area = 0.0
+    for val in sorted(counts):
+        new_area = area + counts[val]
+        if new_area > area_target:
+            bar_height = counts[val] / val_increment
+            bar_left_edge = val - (0.5*val_increment)
+            return bar_left_edge + ((area_target - area) / bar_height)
+        area = new_area
+    return max(counts) + 0.5*val_increment
+
+def cdf(counts:Mapping, x:float)->float:
+    # Probability of a value <= x
+    return sum(v for k, v in counts.items() if k <= x) / total(counts)
+
+def exceedance(counts:Mapping, x:float)->float:
+    # Probability of a value >= x
+    return sum(v for k, v in counts.items() if k >= x) / total(counts)
+
+def summary(counts:Mapping, val_increment=1.0)->Dict[str, float]:
+    return {
+        'count'   : total(counts),
+        'mean'    : mean(counts),
+        'variance': variance(counts),
+        'min'     : min(counts),
+        'max'     : max(counts),
+        'q1'      : quantile(counts, 0.25, val_increment),
+        'median'  : quantile(counts, 0.5,  val_increment),
+        'q3'      : quantile(counts, 0.75, val_increment),
+    }
@@ -0,0 +1,133 @@
+import itertools
+import math
+import Runtime
+import Stats
+from typing import *
+from BatchPool import BatchPool, BatchUnsupported
+from Optimizer import canRaiseVerbosity, made, mapBlocks, optimize
+from Runtime import *
+
+# Parameter sweeps. A script names its parameters with "$name" (or "$name=default") wherever an integer can go, and
+# a sweep runs it for every combination of the values given for them.
+#
+# Variants of a script only differ after the first instruction that uses a swept parameter. The top level
+# instructions before it are run once, and every variant carries on from a snapshot of the pool and argument stack
+# they leave. With reps the script is treated as the body of "reps{ script }": the shared prefix is run for all reps
+# at once (batched where possible) and each variant's suffix picks up from that snapshot, BATCH_REPS reps at a time.
+
+def parseValues(spec:str)->Tuple[str, List[int]]:
+    # "name=2,3,5" or "name=2:6" (inclusive)
+    name, _, values = spec.partition('=')
+    if not name or not values:
+        raise ValueError("Sweep %r should look like save=2:6 or save=2,4,6"%spec)
+    if ':' in values:
+        low, high = values.split(':')
+        return name.lstrip('$'), list(range(int(low), int(high) + 1))
+    return name.lstrip('$'), [int(v) for v in values.split(',')]
+
+def usesParams(inst:RunnableUnit, names:Iterable[str])->bool:
+    found = False
+    def check(ilist:List[RunnableUnit])->List[RunnableUnit]:
+        nonlocal found
+        found = found or any(isinstance(i, IntParam) and i.name in names for i in ilist)
+        return ilist
+    mapBlocks([inst], check)
+    return found
+
+def paramNames(e:Executor)->List[str]:
+    names = []
+    def check(ilist:List[RunnableUnit])->List[RunnableUnit]:
+        names.extend(i.name for i in ilist if isinstance(i, IntParam) and i.name not in names)
+        return ilist
+    mapBlocks(e.instructions, check)
+    return names
+
+def unboundParams(e:Executor)->List[str]:
+    # Parameters with no default, which need a value before the script can run
+    names = []
+    def check(ilist:List[RunnableUnit])->List[RunnableUnit]:
+        names.extend(i.name for i in ilist if isinstance(i, IntParam) and i.default is None and i.name not in names)
+        return ilist
+    mapBlocks(e.instructions, check)
+    return names
+
+def bindParams(e:Executor, values:Dict[str, int])->Executor:
+    # Copy of e with the named parameters swapped for literals, so the optimiser can fold them
+    def bind(ilist:List[RunnableUnit])->List[RunnableUnit]:
+        return [made(IntLiteral(values[i.name]), i.script_i) if isinstance(i, IntParam) and i.name in values else i
+                for i in ilist]
+    return Executor(mapBlocks(e.instructions, bind), e.debug_script)
+
+class Sweep:
+    def __init__(self, e:Executor, grid:Dict[str, List[int]], reps:int=None, optimized:bool=True):
+        unknown = [name for name in grid if name not in paramNames(e)]
+        if unknown:
+            raise ValueError("The script has no parameter $%s"%unknown[0])
+        unbound = [name for name in unboundParams(e) if name not in grid]
+        if unbound:
+            raise ValueError("Parameter $%s has no value, give it one with --param %s=VALUE"%(unbound[0], unbound[0]))
+        self.grid = grid
+        self.reps = reps
+        self.optimized = optimized and not canRaiseVerbosity(e.instructions)
+        split = next((i for i, inst in enumerate(e.instructions) if usesParams(inst, grid)), len(e.instructions))
+        self.prefix = self.prepare(Executor(e.instructions[:split], e.debug_script))
+        self.suffix = Executor(e.instructions[split:], e.debug_script)
+        self.split = split
+        self.total = len(e.instructions)
+    def prepare(self, e:Executor)->Executor:
+        return optimize(e) if self.optimized else e
+    def variants(self)->List[Dict[str, int]]:
+        names = list(self.grid)
+        return [dict(zip(names, values)) for values in itertools.product(*(self.grid[n] for n in names))]
+    def run(self, ctx:RunContext=None)->List[Tuple[Dict[str, int], DicePool]]:
+        # Returns each variant's values and output pool
+        ctx = RunContext() if ctx is None else ctx
+        variants = self.variants()
+        suffixes = [self.prepare(bindParams(self.suffix, v)) for v in variants]
+        if self.reps is None:
+            snapshot = self.prefix.run(ctx=ctx)
+            outputs = [self.outputPool(e.run(snapshot.pool, 0, snapshot.arg_stack, ctx)) for e in suffixes]
+        else:
+            outputs = self.runReps(suffixes, ctx)
+        return list(zip(variants, outputs))
+    @staticmethod
+    def outputPool(s:ExecState)->DicePool:
+        # What a curly block would aggregate from s
+        if len(s.arg_stack):
+            return Runtime.POOL_CLASS(s.arg_stack)
+        return s.pool
+    def runReps(self, suffixes:List[Executor], ctx:RunContext)->List[DicePool]:
+        outputs = [Runtime.POOL_CLASS() for e in suffixes]
+        if Runtime.BATCH_ENABLED:
+            try:
+                for start in range(0, self.reps, Runtime.BATCH_REPS):
+                    rows = min(Runtime.BATCH_REPS, self.reps - start)
+                    snapshot = self.prefix.runBatch(BatchPool.empty(rows), 1, ctx=ctx)
+                    for e, agg_pool in zip(suffixes, outputs):
+                        sub_s = e.runBatch(snapshot.pool, 1, snapshot.arg_stack, ctx)
+                        agg_pool.addPool(sub_s.outputPool().totals(Runtime.POOL_CLASS))
+                return outputs
+            except BatchUnsupported:
+                outputs = [Runtime.POOL_CLASS() for e in suffixes]
+        for start in range(0, self.reps, Runtime.BATCH_REPS):
+            snapshots = [self.prefix.run(None, 1, ctx=ctx) for i in range(min(Runtime.BATCH_REPS, self.reps - start))]
+            for e, agg_pool in zip(suffixes, outputs):
+                for snapshot in snapshots:
+                    agg_pool.addPool(self.outputPool(e.run(snapshot.pool, 1, snapshot.arg_stack, ctx)))
+        return outputs
+    def report(self, results:List[Tuple[Dict[str, int], DicePool]])->str:
+        names = list(self.grid)
+        lines = ["Shared prefix: %d of %d top level instructions run once for %d variants"%(
+                 self.split, self.total, len(results)),
+                 ''.join('%8s'%('$' + n) for n in names) + '%10s %10s %10s %8s %8s %8s'%(
+                 'count', 'mean', 'sd', 'q1', 'median', 'q3')]
+        for values, pool in results:
+            row = ''.join('%8d'%values[n] for n in names)
+            counts = Stats.poolCounts(pool)
+            if not counts:
+                lines.append(row + '%10d'%0)
+                continue
+            summary = Stats.summary(counts)
+            lines.append(row + '%10d %10.4f %10.4f %8.2f %8.2f %8.2f'%(summary['count'], summary['mean'],
+                         math.sqrt(summary['variance']), summary['q1'], summary['median'], summary['q3']))
+        return '\n'.join(lines)
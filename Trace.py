@@ -0,0 +1,166 @@
+import argparse
+import json
+import struct
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import *
+
+# Structured trace of verbose runs. With a sink in RunContext.trace, everything a verbose run would print goes to the
+# sink as records instead, along with one record per instruction of the pool and stack it left. Printing stays the
+# default; a sink keeps the terminal out of the way and gives output that can be searched and post-processed.
+#
+# A record is a dict:
+#   kind        'inst' after an instruction, 'msg' for a line the run would have printed
+#   script_i    position of the instruction in the script (-1 if unknown)
+#   nest_level  block nesting depth
+#   reps        rep of each enclosing curly block, outermost first
+#   pool_size   number of values in the pool
+#   pool        [value, count] pairs of the pool, for 'inst' records (None for 'msg')
+#   stack       the arg stack
+#   text        the instruction's name for 'inst', the printed line for 'msg'
+#
+# Sinks can sample reps of the outermost block: first_reps keeps only the first K, every_reps one rep in N. Reps that
+# aren't kept skip the verbose code paths entirely, so they run at close to full speed.
+
+class TraceSink(ABC):
+    def __init__(self, first_reps:int=None, every_reps:int=None):
+        self.first_reps = first_reps
+        self.every_reps = every_reps
+        self.count = 0
+    def sampled(self, rep:int)->bool:
+        # Whether rep of the outermost block is traced
+        if self.first_reps is not None and rep >= self.first_reps:
+            return False
+        return self.every_reps is None or rep % self.every_reps == 0
+    def add(self, record:dict):
+        self.count += 1
+        self.write(record)
+    @abstractmethod
+    def write(self, record:dict):
+        pass
+    def close(self):
+        pass
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+
+class RingTrace(TraceSink):
+    # Keeps the last capacity records in memory
+    def __init__(self, capacity:int=10000, first_reps:int=None, every_reps:int=None):
+        super().__init__(first_reps, every_reps)
+        self.buffer = deque(maxlen=capacity)
+    def write(self, record:dict):
+        self.buffer.append(record)
+    def records(self)->List[dict]:
+        return list(self.buffer)
+
+class JsonlTrace(TraceSink):
+    # One JSON object per line, written buffer_records lines at a time
+    def __init__(self, path:str, first_reps:int=None, every_reps:int=None, buffer_records:int=4096):
+        super().__init__(first_reps, every_reps)
+        self.f = open(path, 'w')
+        self.lines = []
+        self.buffer_records = buffer_records
+    def write(self, record:dict):
+        self.lines.append(json.dumps(record))
+        if len(self.lines) >= self.buffer_records:
+            self.flush()
+    def flush(self):
+        if self.lines:
+            self.f.write('\n'.join(self.lines) + '\n')
+            self.lines = []
+    def close(self):
+        if self.f is not None:
+            self.flush()
+            self.f.close()
+            self.f = None
+
+# Binary records: a fixed header, then the reps, the pool pairs, the stack (all int64) and the text (UTF-8)
+BINARY_MAGIC = b'DICETRC1'
+BINARY_HEADER = struct.Struct('<BiHHqIIIB')
+KINDS = ('inst', 'msg')
+
+class BinaryTrace(TraceSink):
+    def __init__(self, path:str, first_reps:int=None, every_reps:int=None, buffer_bytes:int=1 << 20):
+        super().__init__(first_reps, every_reps)
+        self.f = open(path, 'wb')
+        self.f.write(BINARY_MAGIC)
+        self.buffer = bytearray()
+        self.buffer_bytes = buffer_bytes
+    def write(self, record:dict):
+        pool = record['pool']
+        text = record['text'].encode('utf-8')
+        self.buffer += BINARY_HEADER.pack(KINDS.index(record['kind']), record['script_i'], record['nest_level'],
+                                          len(record['reps']), record['pool_size'],
+                                          0 if pool is None else len(pool), len(record['stack']), len(text),
+                                          pool is not None)
+        values = list(record['reps'])
+        if pool is not None:
+            for value, count in pool:
+                values += (value, count)
+        values += record['stack']
+        self.buffer += struct.pack('<%dq'%len(values), *values)
+        self.buffer += text
+        if len(self.buffer) >= self.buffer_bytes:
+            self.flush()
+    def flush(self):
+        self.f.write(self.buffer)
+        self.buffer = bytearray()
+    def close(self):
+        if self.f is not None:
+            self.flush()
+            self.f.close()
+            self.f = None
+
+def readBinary(path:str)->Iterator[dict]:
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(BINARY_MAGIC):
+        raise ValueError("%s is not a binary trace"%path)
+    pos = len(BINARY_MAGIC)
+    while pos < len(data):
+        kind, script_i, nest_level, n_reps, pool_size, n_pool, n_stack, n_text, has_pool = \
+            BINARY_HEADER.unpack_from(data, pos)
+        pos += BINARY_HEADER.size
+        n = n_reps + 2*n_pool + n_stack
+        values = struct.unpack_from('<%dq'%n, data, pos)
+        pos += 8*n
+        text = data[pos:pos + n_text].decode('utf-8')
+        pos += n_text
+        pool = None
+        if has_pool:
+            pool = [list(values[i:i+2]) for i in range(n_reps, n_reps + 2*n_pool, 2)]
+        yield {'kind': KINDS[kind], 'script_i': script_i, 'nest_level': nest_level, 'reps': list(values[:n_reps]),
+               'pool_size': pool_size, 'pool': pool,
+               'stack': list(values[n_reps + 2*n_pool:]), 'text': text}
+
+def formatRecord(record:dict)->str:
+    # 'msg' records come out as the run would have printed them
+    indent = '    '*record['nest_level']
+    if record['kind'] == 'msg':
+        return indent + ' ' + record['text']
+    pool = ', '.join('%d: %d'%(value, count) for value, count in record['pool'])
+    return '%s @%d %s rep %s: %d values {%s} stack %s'%(indent, record['script_i'], record['text'],
+           '/'.join(str(r) for r in record['reps']) or '-', record['pool_size'], pool, record['stack'])
+
+def openTrace(spec:str, first_reps:int=None, every_reps:int=None)->TraceSink:
+    # spec is "ring:CAPACITY", "jsonl:PATH" or "bin:PATH"
+    kind, _, arg = spec.partition(':')
+    if kind not in ('ring', 'jsonl', 'bin'):
+        raise ValueError("Unknown trace \"%s\", use ring:CAPACITY, jsonl:FILE or bin:FILE"%spec)
+    if kind == 'ring':
+        return RingTrace(int(arg) if arg else 10000, first_reps, every_reps)
+    if not arg:
+        raise ValueError("Trace \"%s\" needs a file name, eg. %s:trace.%s"%(spec, kind, kind))
+    if kind == 'jsonl':
+        return JsonlTrace(arg, first_reps, every_reps)
+    return BinaryTrace(arg, first_reps, every_reps)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Print a binary trace written with main.py --trace bin:FILE")
+    parser.add_argument('path')
+    parser.add_argument('--jsonl', action='store_true', help="Print the records as JSON lines instead of text")
+    args = parser.parse_args()
+    for record in readBinary(args.path):
+        print(json.dumps(record) if args.jsonl else formatRecord(record))
@@ -1,17 +1,276 @@
+import argparse
 import sys
-from Compiler import Compiler
+from Compiler import Compiler, compileCached
 
-#import cProfile
-#import pstats
+def runWithProgress(e, every_s:float, every_reps:int):
+    # Runs e, printing a line for every partial result and redrawing a live histogram for each top level block
+    import Graph
+    live = {}
+    for p in e.stream(every_reps=every_reps, every_s=every_s):
+        lineno, line = e.getGlobalScriptLineForPosition(p.script_i)
+        summary = p.summary()
+        if summary:
+            print("Line %d: %d/%d reps in %0.2fs, mean %0.4f, median %0.2f, %d values"%(
+                  lineno, p.done, p.reps, p.elapsed, summary['mean'], summary['median'], summary['count']))
+        else:
+            print("Line %d: %d/%d reps in %0.2fs, no values yet"%(lineno, p.done, p.reps, p.elapsed))
+        if Graph.GRAPH_BACKEND == 'show':
+            graph = live.setdefault(p.script_i, Graph.LiveBarGraph())
+            graph.update(p.pool, title='Line %d after %d of %d reps'%(lineno, p.done, p.reps))
+    for graph in live.values():
+        graph.close()
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print("Please provide the name of the script you want to run on the command line")
-        exit(0)
-    cmp = Compiler(open(sys.argv[1]).read())
-    e = cmp.compile()
-    e.run()
-    #cProfile.run('e.run()', 'out.dat')
-    #p = pstats.Stats('out.dat')
-    #p.sort_stats('cumulative')
-    #p.print_stats()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Compile and run a dice script")
+    parser.add_argument('script', help="The name of the script you want to run")
+    parser.add_argument('--exact', action='store_true',
+                        help="Compute the exact output distribution instead of sampling")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="Split the reps of top level blocks across this many processes")
+    parser.add_argument('--seed', type=int, default=None,
+                        help="Seed for the random number generator")
+    parser.add_argument('--pool', choices=['dict', 'array'], default='dict',
+                        help="Pool implementation: dict (DicePool) or array (ArrayPool, faster for big pools)")
+    parser.add_argument('--cache-dir', default=None,
+                        help="Cache compiled scripts in this directory, so unchanged scripts skip compilation")
+    parser.add_argument('--no-optimize', action='store_true',
+                        help="Run the compiler's instruction list as-is, without the optimisation passes")
+    parser.add_argument('--dump-ir', action='store_true',
+                        help="Print the instruction list before and after optimisation")
+    parser.add_argument('--graph', default='show',
+                        help="Where G sends graphs: show, none, png:FILE, csv:FILE or json:FILE")
+    parser.add_argument('--converge', action='append', default=None, metavar='TARGET',
+                        help="Run top level blocks until an estimate is this precise, ignoring their rep count: "
+                             "mean:0.01, q0.9:0.5 (a quantile) or bins:0.1 (percentage points). Can be repeated.")
+    parser.add_argument('--confidence', type=float, default=0.95, help="Confidence level for --converge")
+    parser.add_argument('--max-reps', type=int, default=10**7, help="Most reps --converge will run per block")
+    parser.add_argument('--profile', action='store_true',
+                        help="Time every instruction and print the script's hot lines. Runs in one process.")
+    parser.add_argument('--codegen', action='store_true',
+                        help="Compile the script to a Python function instead of interpreting it, where possible")
+    parser.add_argument('--progress', type=float, default=None, metavar='SECONDS',
+                        help="Report on top level blocks about this often while they run, and with --graph show, "
+                             "draw their histograms as they fill in")
+    parser.add_argument('--progress-reps', type=int, default=None, metavar='N',
+                        help="Report on top level blocks every N reps instead of by time")
+    parser.add_argument('--count-min-dice', type=int, default=None, metavar='N',
+                        help="Draw rolls of N or more dice as one multinomial over the faces (default 64). "
+                             "0 rolls every die separately.")
+    parser.add_argument('--memo', action='store_true',
+                        help="Cache the outcome distribution of curly blocks per input pool and sample from it")
+    parser.add_argument('--memo-budget', type=float, default=64, metavar='MB', help="Memory budget for --memo")
+    parser.add_argument('--memo-learn', type=int, default=None, metavar='N',
+                        help="With --memo, learn blocks that can't be computed exactly from N interpreted reps")
+    parser.add_argument('--sink', default=None, metavar='FILE',
+                        help="Write one record per rep of every top level block to FILE, a .npy array")
+    parser.add_argument('--sink-stack', type=int, default=4, metavar='N',
+                        help="How many arg stack values --sink keeps per rep")
+    parser.add_argument('--checkpoint', default=None, metavar='FILE',
+                        help="Save the run's progress to FILE while top level blocks run, so --resume can carry on "
+                             "from it if the run is stopped. FILE is removed once the run finishes.")
+    parser.add_argument('--checkpoint-every', type=float, default=60, metavar='SECONDS',
+                        help="How often --checkpoint saves")
+    parser.add_argument('--resume', action='store_true',
+                        help="Carry on from the --checkpoint file if there is one. Gives the same result as a run "
+                             "that was never stopped.")
+    parser.add_argument('--trace', default=None, metavar='SINK',
+                        help="Send verbose output to a trace instead of printing it: ring:N keeps the last N records "
+                             "in memory and prints them at the end, jsonl:FILE writes JSON lines, bin:FILE a compact "
+                             "binary file that \"python Trace.py FILE\" prints")
+    parser.add_argument('--trace-first', type=int, default=None, metavar='K',
+                        help="Only trace the first K reps of top level blocks")
+    parser.add_argument('--trace-every', type=int, default=None, metavar='N',
+                        help="Only trace one in N reps of top level blocks")
+    parser.add_argument('--sampling', choices=['stratified', 'antithetic', 'qmc'], default=None,
+                        help="Roll the dice of top level blocks' reps in balanced groups instead of independently, and "
+                             "report each block's standard errors next to what plain dice would give")
+    parser.add_argument('--sampling-group', type=int, default=None, metavar='N',
+                        help="Reps per group for --sampling stratified (default 32) or qmc (default 64)")
+    parser.add_argument('--param', action='append', default=[], metavar='NAME=VALUE',
+                        help="Give the script's $NAME parameter a value. Can be repeated.")
+    parser.add_argument('--sweep', action='append', default=None, metavar='NAME=VALUES',
+                        help="Run the script for each value of $NAME, given as 2:6 or 2,4,6, and print a table of "
+                             "results. Repeat for a grid over several parameters.")
+    parser.add_argument('--reps', type=int, default=None,
+                        help="With --sweep, run the script as the body of \"REPS{ script }\"")
+    args = parser.parse_args()
+    progress = args.progress is not None or args.progress_reps is not None
+    if progress and (args.exact or args.profile or args.converge):
+        parser.error("--progress can't be combined with --exact, --profile or --converge")
+    if args.profile and (args.workers or args.codegen or args.sink):
+        parser.error("--profile can't be combined with --workers, --codegen or --sink")
+    if args.sink and (args.exact or args.converge or args.workers):
+        parser.error("--sink can't be combined with --exact, --converge or --workers")
+    if args.resume and not args.checkpoint:
+        parser.error("--resume needs --checkpoint")
+    if args.checkpoint and (args.exact or args.profile or args.converge or progress or args.workers or args.sink
+                            or args.memo or args.codegen or args.sweep):
+        parser.error("--checkpoint can't be combined with --exact, --profile, --converge, --progress, --workers, "
+                     "--sink, --memo, --codegen or --sweep")
+    if args.trace and (args.exact or args.profile or args.converge or progress or args.workers or args.sink
+                       or args.checkpoint or args.codegen or args.sweep):
+        parser.error("--trace can't be combined with --exact, --profile, --converge, --progress, --workers, --sink, "
+                     "--checkpoint, --codegen or --sweep")
+    if (args.trace_first is not None or args.trace_every is not None) and not args.trace:
+        parser.error("--trace-first and --trace-every need --trace")
+    if args.sampling and (args.exact or args.profile or args.converge or progress or args.workers or args.sink
+                          or args.checkpoint or args.memo or args.trace or args.sweep):
+        parser.error("--sampling can't be combined with --exact, --profile, --converge, --progress, --workers, "
+                     "--sink, --checkpoint, --memo, --trace or --sweep")
+    if args.sampling_group is not None and not args.sampling:
+        parser.error("--sampling-group needs --sampling")
+    if args.memo and args.workers:
+        parser.error("--memo can't be combined with --workers")
+    if args.sweep and (args.exact or args.profile or args.converge or progress or args.workers):
+        parser.error("--sweep can't be combined with --exact, --profile, --converge, --progress or --workers")
+    if args.converge:
+        from Converge import Target
+        try:
+            for spec in args.converge:
+                Target(spec)
+        except ValueError as err:
+            parser.error(str(err))
+    import Graph
+    Graph.setGraphOutput(args.graph)
+    if args.count_min_dice is not None:
+        import DiceRNG
+        DiceRNG.COUNT_MIN_DICE = args.count_min_dice or None
+    if args.pool == 'array':
+        import Runtime
+        from ArrayPool import ArrayPool
+        Runtime.POOL_CLASS = ArrayPool
+    script = open(args.script).read()
+    if args.cache_dir:
+        e = compileCached(script, args.cache_dir)
+    else:
+        cmp = Compiler(script)
+        e = cmp.compile()
+    if args.param:
+        from Sweep import bindParams
+        e = bindParams(e, {name.lstrip('$'): int(value) for name, _, value in (p.partition('=') for p in args.param)})
+    if args.sweep:
+        from Sweep import Sweep, parseValues
+        if args.seed is not None:
+            import DiceRNG
+            DiceRNG.seed(args.seed)
+        try:
+            sweep = Sweep(e, dict(parseValues(spec) for spec in args.sweep), args.reps, not args.no_optimize)
+        except ValueError as err:
+            print(err)
+            sys.exit(1)
+        print(sweep.report(sweep.run()))
+        sys.exit(0)
+    from Sweep import unboundParams
+    unbound = unboundParams(e)
+    if unbound:
+        print("Parameter $%s has no value, give it one with --param %s=VALUE"%(unbound[0], unbound[0]))
+        sys.exit(1)
+    if args.exact:
+        from Exact import ExactExecutor, ExactUnsupported
+        try:
+            result = ExactExecutor(e).run()
+        except ExactUnsupported as err:
+            print(err)
+            sys.exit(1)
+        print(result.report())
+        sys.exit(0)
+    if not args.no_optimize:
+        from Optimizer import dumpIR, optimize
+        optimized = optimize(e)
+        if args.dump_ir:
+            print("Compiled:")
+            print(dumpIR(e))
+            print("Optimized:")
+            print(dumpIR(optimized))
+        e = optimized
+    elif args.dump_ir:
+        from Optimizer import dumpIR
+        print(dumpIR(e))
+    if args.codegen:
+        from Codegen import CodegenUnsupported, generate
+        try:
+            e = generate(e)
+            if args.dump_ir:
+                print("Generated:")
+                print(e.source)
+        except CodegenUnsupported as err:
+            print("Not compiling to Python: %s"%err)
+    if args.memo:
+        import Runtime
+        from Memo import OutcomeCache
+        Runtime.OUTCOME_CACHE = OutcomeCache(int(args.memo_budget * (1 << 20)), args.memo_learn)
+    if args.profile:
+        from Profiler import profile
+        e, prof = profile(e)
+        if args.seed is not None:
+            import DiceRNG
+            DiceRNG.seed(args.seed)
+        e.run()
+        print(prof.report())
+    elif args.workers > 0:
+        from Parallel import ParallelRunner
+        with ParallelRunner(args.workers, args.seed) as runner:
+            if progress:
+                runWithProgress(e, args.progress, args.progress_reps)
+            elif args.converge:
+                from Converge import ConvergenceRunner
+                with ConvergenceRunner(args.converge, args.confidence, max_reps=args.max_reps, runner=runner):
+                    e.run()
+            else:
+                e.run()
+    else:
+        if args.seed is not None:
+            import DiceRNG
+            DiceRNG.seed(args.seed)
+        if args.checkpoint:
+            import os
+            from Checkpoint import CheckpointMismatch, Checkpointer
+            checkpointer = Checkpointer(args.checkpoint, args.checkpoint_every)
+            try:
+                checkpointer.run(e, args.resume)
+            except CheckpointMismatch as err:
+                print(err)
+                sys.exit(1)
+            print(checkpointer.report())
+            if os.path.exists(args.checkpoint):
+                os.remove(args.checkpoint)
+        elif args.trace:
+            from Runtime import RunContext
+            from Trace import RingTrace, formatRecord, openTrace
+            try:
+                trace = openTrace(args.trace, args.trace_first, args.trace_every)
+            except ValueError as err:
+                print(err)
+                sys.exit(1)
+            with trace:
+                e.run(ctx=RunContext(trace=trace))
+            if isinstance(trace, RingTrace):
+                for record in trace.records():
+                    print(formatRecord(record))
+            print("Trace: %d records"%trace.count)
+        elif args.sampling:
+            from Sampling import SamplingRunner
+            try:
+                runner = SamplingRunner(args.sampling, args.sampling_group)
+            except ValueError as err:
+                print(err)
+                sys.exit(1)
+            with runner:
+                e.run()
+        elif args.sink:
+            from Sink import RepSink
+            with RepSink(args.sink, args.sink_stack):
+                if progress:
+                    runWithProgress(e, args.progress, args.progress_reps)
+                else:
+                    e.run()
+        elif args.converge:
+            from Converge import ConvergenceRunner
+            with ConvergenceRunner(args.converge, args.confidence, max_reps=args.max_reps):
+                e.run()
+        elif progress:
+            runWithProgress(e, args.progress, args.progress_reps)
+        else:
+            e.run()
+    if args.memo:
+        print(Runtime.OUTCOME_CACHE.report())